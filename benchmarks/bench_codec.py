@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import time
+import struct
+import asyncio
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import codec
+from peer import Peer, PeerProtocolMessageTypeError
+from bench_parser import StubTorrent, NUM_PIECES, BLOCK_LENGTH
+
+log = logging.getLogger(__name__)
+
+
+class LegacyPeer(Peer):
+    # Dispatch as it was before the codec module: rebuild the type list,
+    # hex-format the payload for a debug line whether or not it is logged,
+    # and walk an if/elif chain.
+    def handle_message(self, msg_id, payload):
+        msg_types = ['choke', 'unchoke', 'interested', 'not_interested', 'have', 'bitfield', 'request', 'piece', 'cancel', 'port']
+        msg_type = msg_types[msg_id]
+        log.debug('%s: receive_msg: id=%s type=%s payload=%s%s' % (
+            self, msg_id, msg_type, ''.join('%02X' % v for v in payload[:40]),
+            '...' if len(payload) >= 64 else ''))
+        if msg_id == 0:
+            assert(msg_type == 'choke')
+            self.peer_choking = True
+            self.handle_choke()
+        elif msg_id == 1:
+            assert(msg_type == 'unchoke')
+            self.peer_choking = False
+            self.handle_unchoke()
+        elif msg_id == 2:
+            assert(msg_type == 'interested')
+            self.peer_interested = True
+            self.handle_interested()
+        elif msg_id == 3:
+            assert(msg_type == 'not_interested')
+            self.peer_interested = False
+            self.upload_queue.clear()
+        elif msg_id == 4:
+            assert(msg_type == 'have')
+            (index,) = struct.unpack('!L', payload)
+            self.handle_have(index)
+        elif msg_id == 5:
+            assert(msg_type == 'bitfield')
+            self.receive_bitfield(payload)
+        elif msg_id == 6:
+            assert(msg_type == 'request')
+            (index, begin, length) = struct.unpack('!LLL', payload)
+            self.handle_request(index, begin, length)
+        elif msg_id == 7:
+            assert(msg_type == 'piece')
+            (index, begin) = struct.unpack_from('!LL', payload)
+            self.handle_piece(index, begin, payload[8:])
+        elif msg_id == 8:
+            assert(msg_type == 'cancel')
+            (index, begin, length) = struct.unpack('!LLL', payload)
+            self.handle_cancel(index, begin, length)
+        elif msg_id == 9:
+            assert(msg_type == 'port')
+        else:
+            raise PeerProtocolMessageTypeError('Unrecognized message id: %s' % msg_id)
+
+
+def legacy_build_message(msg_type, **params):
+    msg_id = None
+    payload = b''
+    if msg_type == 'interested':
+        msg_id = 2
+    elif msg_type == 'have':
+        msg_id = 4
+        payload = struct.pack('!L', params['index'])
+    elif msg_type == 'request':
+        msg_id = 6
+        payload = struct.pack('!LLL', params['index'], params['begin'], params['length'])
+    elif msg_type == 'cancel':
+        msg_id = 8
+        payload = struct.pack('!LLL', params['index'], params['begin'], params['length'])
+    length_prefix = len(payload) + 1
+    fmt = '!LB%ds' % len(payload)
+    return struct.pack(fmt, length_prefix, msg_id, payload)
+
+
+class CountingConnection():
+    def __init__(self):
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+
+
+class StubConnectionManager():
+    def __init__(self, loop):
+        self.loop = loop
+
+
+def build_control_stream(num_messages, piece_every):
+    # Mostly haves and cancels, the control traffic of a busy swarm, with a
+    # block now and then.
+    block = bytes(BLOCK_LENGTH)
+    msgs = []
+    for i in range(num_messages):
+        index = i % NUM_PIECES
+        if piece_every and i % piece_every == 0:
+            msgs.append(codec.encode_piece_header(index, 0, BLOCK_LENGTH) + block)
+        elif i % 4 == 3:
+            msgs.append(codec.encode_cancel(index, 0, BLOCK_LENGTH))
+        elif i % 16 == 5:
+            msgs.append(codec.NOT_INTERESTED_MESSAGE)
+        else:
+            msgs.append(codec.encode_have(index))
+    return b''.join(msgs)
+
+
+def run_for(func, min_time):
+    ops = 0
+    start = time.perf_counter()
+    while True:
+        ops += func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return ops / elapsed
+
+
+def bench_decode(name, num_messages, piece_every, min_time):
+    stream = build_control_stream(num_messages, piece_every)
+    peer = (LegacyPeer if name == 'legacy' else Peer)(StubTorrent(), '127.0.0.1', 0)
+    peer.reset()
+    peer.is_started = True
+    peer.peer_choking = False
+    view = memoryview(stream)
+    chunk = 2**16
+
+    def feed():
+        ofs = 0
+        while ofs < len(stream):
+            buf = peer.get_buffer(chunk)
+            nbytes = min(len(buf), chunk, len(stream) - ofs)
+            buf[:nbytes] = view[ofs:ofs+nbytes]
+            peer.buffer_updated(nbytes)
+            ofs += nbytes
+        return num_messages
+    return {'benchmark': 'decode', 'codec': name, 'piece_every': piece_every,
+            'msgs_per_s': round(run_for(feed, min_time), 1)}
+
+
+def bench_encode(name, batch, min_time):
+    # One loop iteration queues `batch` requests and haves, as a burst of
+    # unchokes or a completed piece would.
+    loop = asyncio.new_event_loop()
+    torrent = StubTorrent()
+    torrent.conn_man = StubConnectionManager(loop)
+    peer = Peer(torrent, '127.0.0.1', 0)
+    peer.reset()
+    peer.is_started = True
+    peer.peer_choking = False
+    peer.conn = CountingConnection()
+
+    def send_legacy():
+        for i in range(batch):
+            peer.conn.write(legacy_build_message('request', index=i, begin=0, length=BLOCK_LENGTH))
+            peer.conn.write(legacy_build_message('have', index=i))
+
+    def send_codec():
+        for i in range(batch):
+            peer.send_message(codec.encode_request(i, 0, BLOCK_LENGTH))
+            peer.send_message(codec.encode_have(i))
+
+    send = send_legacy if name == 'legacy' else send_codec
+
+    sent = 0
+
+    def run():
+        nonlocal sent
+        loop.call_soon(send)
+        loop.call_soon(loop.stop)
+        loop.run_forever()
+        sent += 2 * batch
+        return 2 * batch
+    msgs_per_s = run_for(run, min_time)
+    loop.close()
+    return {'benchmark': 'encode', 'codec': name, 'batch': batch,
+            'msgs_per_s': round(msgs_per_s, 1),
+            'msgs_per_write': round(sent / peer.conn.writes, 1)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Peer wire codec throughput in messages per second')
+    parser.add_argument('--messages', type=int, default=4096, help='messages per decoded stream')
+    parser.add_argument('--piece-every', type=int, default=16,
+                        help='one piece message in N, 0 for control messages only')
+    parser.add_argument('--batch', type=int, default=32, help='requests and haves queued per loop iteration')
+    parser.add_argument('--min-time', type=float, default=1.0)
+    parser.add_argument('--json', action='store_true', help='print results as json lines')
+    args = parser.parse_args(argv)
+
+    for name in ('legacy', 'codec'):
+        for result in (bench_decode(name, args.messages, args.piece_every, args.min_time),
+                       bench_encode(name, args.batch, args.min_time)):
+            if args.json:
+                print(json.dumps(result))
+            elif result['benchmark'] == 'decode':
+                print('decode {codec:7s} {msgs_per_s:12.1f} msgs/s'.format(**result))
+            else:
+                print('encode {codec:7s} {msgs_per_s:12.1f} msgs/s  {msgs_per_write:6.1f} msgs/write'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
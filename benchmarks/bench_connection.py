@@ -0,0 +1,130 @@
+import os
+import sys
+import time
+import json
+import asyncio
+import argparse
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from connection import ConnectionManagerAsyncio, ConnectionManagerThreaded
+
+CHUNK = b'\x00' * 2**14
+
+
+def run_source(port, rate, ready):
+    async def handle(reader, writer):
+        interval = len(CHUNK) / rate if rate else 0
+        deadline = time.monotonic()
+        try:
+            while True:
+                writer.write(CHUNK)
+                await writer.drain()
+                if interval:
+                    deadline += interval
+                    await asyncio.sleep(max(0, deadline - time.monotonic()))
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(handle, '127.0.0.1', port, backlog=1024)
+        ready.set()
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+class CountingPeer():
+    def __init__(self, port):
+        self.ip = '127.0.0.1'
+        self.port = port
+        self.nbytes = 0
+        self.failed = False
+        self.recv_view = memoryview(bytearray(2**16))
+
+    def handle_connection_made(self, conn):
+        pass
+
+    def handle_connection_failed(self):
+        self.failed = True
+
+    def handle_connection_lost(self):
+        pass
+
+    def get_buffer(self, sizehint=-1):
+        return self.recv_view
+
+    def buffer_updated(self, nbytes):
+        self.nbytes += nbytes
+
+    def handle_data_received(self, data):
+        self.nbytes += len(data)
+
+
+def measure(conn_man_cls, port, num_peers, duration):
+    conn_man = conn_man_cls()
+    peers = [CountingPeer(port) for _ in range(num_peers)]
+    for peer in peers:
+        conn_man.connect_peer(peer)
+
+    if isinstance(conn_man, ConnectionManagerAsyncio):
+        conn_man.loop.call_later(duration, conn_man.stop_event_loop)
+    else:
+        threading.Timer(duration, conn_man.stop_event_loop).start()
+
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    conn_man.start_event_loop()
+    wall = time.monotonic() - wall_start
+    cpu = time.process_time() - cpu_start
+    if not isinstance(conn_man, ConnectionManagerAsyncio):
+        for conn in conn_man.conns:
+            conn.thread.join()
+
+    nbytes = sum(p.nbytes for p in peers)
+    return {
+        'manager': conn_man_cls.__name__,
+        'peers': num_peers,
+        'failed': sum(p.failed for p in peers),
+        'wall_s': round(wall, 3),
+        'cpu_s': round(cpu, 3),
+        'cpu_pct': round(100.0 * cpu / wall, 1),
+        'mb_per_s': round(nbytes / wall / 2**20, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare connection managers on loopback')
+    parser.add_argument('--peers', type=int, nargs='+', default=[1, 8, 32, 128])
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--rate', type=float, default=256 * 1024,
+                        help='bytes/s sent per peer, 0 for unlimited')
+    parser.add_argument('--port', type=int, default=51413)
+    parser.add_argument('--json', action='store_true', help='print results as json lines')
+    args = parser.parse_args(argv)
+
+    ready = multiprocessing.Event()
+    source = multiprocessing.Process(target=run_source, args=(args.port, args.rate, ready), daemon=True)
+    source.start()
+    ready.wait()
+
+    try:
+        for num_peers in args.peers:
+            for cls in (ConnectionManagerThreaded, ConnectionManagerAsyncio):
+                result = measure(cls, args.port, num_peers, args.duration)
+                if args.json:
+                    print(json.dumps(result))
+                else:
+                    print('{manager:28s} peers={peers:<5d} cpu={cpu_pct:6.1f}% '
+                          'throughput={mb_per_s:8.2f} MB/s failed={failed}'.format(**result))
+    finally:
+        source.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+import os
+import sys
+import json
+import mmap
+import time
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import contextlib
+
+import bencodepy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import codec
+from settings import SETTINGS
+from client import Client
+from dht import DHT
+from bench_swarm import FakeSeeder, make_torrent, write_metainfo
+
+
+class PexSeeder(FakeSeeder):
+    # A seeder that speaks BEP 10 and tells every client about pex_peers.
+    def __init__(self, *args, pex_peers=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pex_peers = pex_peers
+
+    def reserved(self):
+        return codec.encode_reserved([codec.EXTENSION_PROTOCOL_BIT])
+
+    def handle_connected(self, conn):
+        handshake = bencodepy.encode({b'm': {b'ut_pex': 1}, b'p': self.port})
+        conn.writer.write(codec.encode_extended(codec.EXTENDED_HANDSHAKE, handshake))
+
+    def handle_message(self, conn, msg_id, message):
+        if msg_id != codec.EXTENDED or message[1] != codec.EXTENDED_HANDSHAKE:
+            return
+        ut_pex = bencodepy.decode(message[2:]).get(b'm', {}).get(b'ut_pex')
+        if ut_pex:
+            added = b''.join(codec.encode_compact_peer(ip, port) for (ip, port) in self.pex_peers)
+            msg = bencodepy.encode({b'added': added, b'added.f': b'\x12' * len(self.pex_peers)})
+            conn.writer.write(codec.encode_extended(ut_pex, msg))
+
+
+async def serve_swarm(config, report):
+    # DHT nodes bootstrap from the first one. The first seeder is only
+    # announced in the DHT and the second is only known through the first
+    # seeder's ut_pex message.
+    with open(config['data_path'], 'rb') as f:
+        data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    loop = asyncio.get_running_loop()
+    nodes = []
+    for i in range(config['dht_nodes']):
+        bootstrap = [('127.0.0.1', nodes[0].port)] if nodes else []
+        node = DHT(loop, 0, bootstrap=bootstrap)
+        node.start('127.0.0.1')
+        await node.wait_open()
+        nodes.append(node)
+    for node in nodes[1:]:
+        await node.bootstrap()
+
+    args = (data, config['info_hash'], config['piece_length'], config['num_pieces'])
+    pex_seeder = FakeSeeder(*args)
+    await pex_seeder.start()
+    dht_seeder = PexSeeder(*args, pex_peers=[('127.0.0.1', pex_seeder.port)])
+    await dht_seeder.start()
+    await nodes[-1].get_peers(config['info_hash'], announce_port=dht_seeder.port)
+    report({
+        'bootstrap': ('127.0.0.1', nodes[0].port),
+        'dht_seeder': ('127.0.0.1', dht_seeder.port),
+        'pex_seeder': ('127.0.0.1', pex_seeder.port),
+        'table_sizes': [len(node.table) for node in nodes],
+    })
+    await asyncio.Event().wait()
+
+
+def start_swarm(config):
+    (result, ready) = ({}, threading.Event())
+
+    def report(value):
+        result.update(value)
+        ready.set()
+    threading.Thread(target=lambda: asyncio.run(serve_swarm(config, report)), daemon=True).start()
+    ready.wait()
+    return result
+
+
+class DiscoveryClient(Client):
+    def __init__(self, swarm, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.swarm = swarm
+        self.found = {}
+        self.completed = False
+        self.start = time.monotonic()
+
+    def watch(self, torrent, interval=0.01):
+        # Note when each seeder first shows up among the known peers.
+        for name in ('dht_seeder', 'pex_seeder'):
+            if name not in self.found and torrent.registry.get(*self.swarm[name]):
+                self.found[name] = time.monotonic() - self.start
+        if len(self.found) < 2:
+            self.conn_man.loop.call_later(interval, self.watch, torrent)
+
+    def torrent_on_completed(self, torrent):
+        self.completed = True
+        super().torrent_on_completed(torrent)
+
+
+def measure(args, workdir):
+    (info, info_hash) = make_torrent(workdir, args.size, args.piece_length)
+    config = {
+        'data_path': os.path.join(workdir, 'seed', info[b'name'].decode()),
+        'info_hash': info_hash,
+        'piece_length': args.piece_length,
+        'num_pieces': len(info[b'pieces']) // 20,
+        'dht_nodes': args.dht_nodes,
+    }
+    swarm = start_swarm(config)
+    # Nothing listens on the tracker port, so peers can only come from
+    # the DHT and peer exchange.
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        dead_tracker = 'http://127.0.0.1:%d/announce' % s.getsockname()[1]
+    torrent_path = os.path.join(workdir, 'discovery.torrent')
+    write_metainfo(torrent_path, info, dead_tracker)
+
+    SETTINGS['listen_port'] = 0
+    SETTINGS['dht'] = True
+    SETTINGS['dht_port'] = 0
+    SETTINGS['dht_bootstrap'] = [swarm['bootstrap']]
+    SETTINGS['tracker_retry_interval'] = 3600.0
+    client = DiscoveryClient(swarm, output_destination=os.path.join(workdir, 'out'))
+    torrent = client.add_torrent(torrent_path)
+    client.conn_man.loop.call_later(args.timeout, client.on_all_torrent_completed)
+    client.conn_man.loop.call_soon(client.watch, torrent)
+    with contextlib.redirect_stdout(sys.stderr):
+        client.start_torrents()
+    elapsed = time.monotonic() - client.start
+
+    def delivered(name):
+        peer = torrent.registry.get(*swarm[name])
+        if peer is None:
+            return 0
+        # Sessions still open when the loop stopped have not been added up.
+        return peer.delivered + (peer.download_rate.total if peer in torrent.registry.active else 0)
+    return {
+        'benchmark': 'discovery',
+        'completed': client.completed,
+        'elapsed': round(elapsed, 3),
+        'size': args.size,
+        'dht_nodes': args.dht_nodes,
+        'dht_node_tables': swarm['table_sizes'],
+        'client_dht_nodes': len(client.dht.table),
+        'dht_peer_found': round(client.found['dht_seeder'], 3) if 'dht_seeder' in client.found else None,
+        'pex_peer_found': round(client.found['pex_seeder'], 3) if 'pex_seeder' in client.found else None,
+        'dht_peer_bytes': delivered('dht_seeder'),
+        'pex_peer_bytes': delivered('pex_seeder'),
+        'pex_peers_received': torrent.pex.peers_received,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Find peers through local DHT nodes and peer exchange with no working tracker')
+    parser.add_argument('--size', type=int, default=16 * 2**20, help='torrent size in bytes')
+    parser.add_argument('--piece-length', type=int, default=2**18)
+    parser.add_argument('--dht-nodes', type=int, default=16)
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--json', action='store_true', help='print results as json lines')
+    parser.add_argument('--output', help='append json lines to this file')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='bench_discovery_')
+    try:
+        result = measure(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print('completed={completed} in {elapsed}s; dht peer found after {dht_peer_found}s '
+              '({dht_peer_bytes} bytes), pex peer after {pex_peer_found}s ({pex_peer_bytes} bytes); '
+              'client knows {client_dht_nodes} DHT nodes'.format(**result))
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+    if not result['completed'] or result['dht_peer_found'] is None or result['pex_peer_found'] is None:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
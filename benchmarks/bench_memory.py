@@ -0,0 +1,147 @@
+import os
+import sys
+import gc
+import json
+import time
+import argparse
+import tracemalloc
+
+import bencodepy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from metainfo import Metainfo, PieceHashes
+from picker import PiecePicker
+from peer import Peer
+
+SHA_LEN = 20
+
+
+class StubTorrent():
+    def __init__(self, metainfo):
+        self.metainfo = metainfo
+
+
+def build_torrent(num_pieces, num_files, piece_length):
+    total = num_pieces * piece_length
+    file_length = total // num_files
+    files = [{b'length': file_length, b'path': [b'dir%d' % (i % 16), b'file%d.bin' % i]}
+             for i in range(num_files - 1)]
+    files.append({b'length': total - file_length * (num_files - 1), b'path': [b'last.bin']})
+    info = {
+        b'name': b'synthetic',
+        b'piece length': piece_length,
+        b'pieces': os.urandom(num_pieces * SHA_LEN),
+        b'files': files,
+    }
+    return bencodepy.encode({b'announce': b'http://127.0.0.1/announce', b'info': info})
+
+
+def allocated(func):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = func()
+    nbytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return (obj, nbytes)
+
+
+def legacy_hashes(pieces_shas):
+    return [pieces_shas[i:i+SHA_LEN] for i in range(0, len(pieces_shas), SHA_LEN)]
+
+
+def legacy_segments(files, offset, length):
+    for file_index, f in enumerate(files):
+        if length <= 0:
+            break
+        file_end = f['offset'] + f['length']
+        if offset >= file_end:
+            continue
+        file_offset = offset - f['offset']
+        seg_length = min(length, file_end - offset)
+        yield (file_index, file_offset, seg_length)
+        offset += seg_length
+        length -= seg_length
+
+
+def time_segments(func, num_pieces, min_time):
+    iterations = 0
+    start = time.perf_counter()
+    while True:
+        for index in range(0, num_pieces, max(1, num_pieces // 1000)):
+            list(func(index))
+            iterations += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+    return round(iterations / elapsed, 1)
+
+
+def measure(num_pieces, num_files, piece_length, min_time):
+    bencontent = build_torrent(num_pieces, num_files, piece_length)
+    (metainfo, _) = allocated(lambda: Metainfo(bencontent))
+    pieces_shas = bencodepy.decode(bencontent)[b'info'][b'pieces']
+
+    (_, hashes_list) = allocated(lambda: legacy_hashes(pieces_shas))
+    # Copy the blob so the buffer is counted, not shared with the decoder.
+    (_, hashes_buffer) = allocated(lambda: PieceHashes(bytearray(pieces_shas)))
+    (_, bitfield_list) = allocated(lambda: [False for _ in range(num_pieces)])
+
+    def new_peer():
+        peer = Peer(StubTorrent(metainfo), '127.0.0.1', 6881)
+        peer.reset()
+        return peer
+    (peer, peer_total) = allocated(new_peer)
+    (_, idle_peer) = allocated(lambda: Peer(StubTorrent(metainfo), '127.0.0.1', 6881))
+    (_, bitfield_bitarray) = allocated(lambda: peer.peer_pieces.copy())
+    (_, picker) = allocated(lambda: PiecePicker(num_pieces))
+
+    piece_length = metainfo.info['piece_length']
+    return {
+        'num_pieces': num_pieces,
+        'num_files': num_files,
+        'hashes_list_bytes': hashes_list,
+        'hashes_buffer_bytes': hashes_buffer,
+        'bitfield_list_bytes': bitfield_list,
+        'bitfield_bitarray_bytes': bitfield_bitarray,
+        'peer_idle_bytes': idle_peer,
+        'peer_connected_bytes': peer_total,
+        'peer_recv_buffer_bytes': len(peer.recv_buffer),
+        'picker_bytes': picker,
+        'segments_linear_per_s': time_segments(
+            lambda i: legacy_segments(metainfo.files, i * piece_length, metainfo.get_piece_length(i)),
+            num_pieces, min_time),
+        'segments_bisect_per_s': time_segments(metainfo.piece_segments, num_pieces, min_time),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Memory use of per-torrent and per-peer state')
+    parser.add_argument('--pieces', type=int, default=100000)
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--piece-length', type=int, default=2**14)
+    parser.add_argument('--min-time', type=float, default=0.5)
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args(argv)
+
+    result = measure(args.pieces, args.files, args.piece_length, args.min_time)
+    if args.json:
+        print(json.dumps(result))
+        return
+    kib = lambda n: '%10.1f KiB' % (n / 2**10)
+    print('%d pieces, %d files' % (result['num_pieces'], result['num_files']))
+    print('piece hashes   list of bytes   %s' % kib(result['hashes_list_bytes']))
+    print('piece hashes   one buffer      %s' % kib(result['hashes_buffer_bytes']))
+    print('bitfield       list of bools   %s' % kib(result['bitfield_list_bytes']))
+    print('bitfield       bitarray        %s' % kib(result['bitfield_bitarray_bytes']))
+    print('peer           known, idle     %s' % kib(result['peer_idle_bytes']))
+    print('peer           connected       %s  (recv buffer %s)' % (
+        kib(result['peer_connected_bytes']), kib(result['peer_recv_buffer_bytes']).strip()))
+    print('picker                         %s' % kib(result['picker_bytes']))
+    print('piece segments linear scan     %10.1f lookups/s' % result['segments_linear_per_s'])
+    print('piece segments bisect index    %10.1f lookups/s' % result['segments_bisect_per_s'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+import time
+import struct
+import asyncio
+import argparse
+
+import bencodepy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from metainfo import Metainfo
+from torrent import Torrent
+from peer import Peer
+from bench_parser import StubTorrent
+
+BLOCK_LENGTH = 2**14
+
+
+class StubConnectionManager():
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+
+
+class StubStorage():
+    base_dir = ''
+    files = []
+
+
+class StubVerifier():
+    def __init__(self):
+        self.submitted = 0
+
+    def submit(self, data, expected_sha, callback):
+        self.submitted += 1
+
+
+def build_metainfo(num_pieces, num_files, piece_length):
+    total = num_pieces * piece_length
+    file_length = total // num_files
+    files = [{b'length': file_length, b'path': [b'file%d.bin' % i]} for i in range(num_files - 1)]
+    files.append({b'length': total - file_length * (num_files - 1), b'path': [b'last.bin']})
+    info = {b'name': b'micro', b'piece length': piece_length,
+            b'pieces': os.urandom(20 * num_pieces), b'files': files}
+    return bencodepy.encode({b'announce': b'http://127.0.0.1/announce', b'info': info})
+
+
+def run_for(func, min_time):
+    iterations = 0
+    ops = 0
+    start = time.perf_counter()
+    while True:
+        ops += func()
+        iterations += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+    return (ops, elapsed)
+
+
+def bench_parse_message(min_time):
+    # Small control messages dominate message counts; one in eight is a
+    # 16 KiB block so the copy path is exercised too.
+    msgs = []
+    for i in range(1024):
+        if i % 8 == 0:
+            msgs.append(struct.pack('!LBLL', 9 + BLOCK_LENGTH, 7, i % 64, 0) + bytes(BLOCK_LENGTH))
+        else:
+            msgs.append(struct.pack('!LBL', 5, 4, i % 64))
+    stream = b''.join(msgs)
+    peer = Peer(StubTorrent(), '127.0.0.1', 0)
+    peer.reset()
+    peer.is_started = True
+    peer.peer_choking = False
+    view = memoryview(stream)
+    chunk = 2**16
+
+    def feed():
+        ofs = 0
+        while ofs < len(stream):
+            buf = peer.get_buffer(chunk)
+            nbytes = min(len(buf), chunk, len(stream) - ofs)
+            buf[:nbytes] = view[ofs:ofs+nbytes]
+            peer.buffer_updated(nbytes)
+            ofs += nbytes
+        return len(msgs)
+    (ops, elapsed) = run_for(feed, min_time)
+    return {'benchmark': 'parse_message', 'ops_per_s': round(ops / elapsed, 1),
+            'mb_per_s': round(ops / len(msgs) * len(stream) / elapsed / 2**20, 2)}
+
+
+def bench_handle_block(min_time, num_pieces=256, piece_length=2**18):
+    metainfo = Metainfo(build_metainfo(num_pieces, 1, piece_length))
+    block = bytes(BLOCK_LENGTH)
+    conn_man = StubConnectionManager()
+
+    def download():
+        torrent = Torrent(conn_man, metainfo, StubStorage(), StubVerifier(), None)
+        peer = Peer(torrent, '127.0.0.1', 0)
+        peer.reset()
+        nblocks = 0
+        for piece_index in range(num_pieces):
+            torrent.start_piece(piece_index)
+            for begin in range(0, piece_length, BLOCK_LENGTH):
+                torrent.handle_block(peer, piece_index, begin, block)
+                nblocks += 1
+        return nblocks
+    (ops, elapsed) = run_for(download, min_time)
+    conn_man.loop.close()
+    return {'benchmark': 'handle_block', 'ops_per_s': round(ops / elapsed, 1),
+            'mb_per_s': round(ops * BLOCK_LENGTH / elapsed / 2**20, 2)}
+
+
+def bench_metainfo(min_time, num_pieces=10000, num_files=100):
+    bencontent = build_metainfo(num_pieces, num_files, 2**18)
+
+    def parse():
+        Metainfo(bencontent)
+        return 1
+    (ops, elapsed) = run_for(parse, min_time)
+    return {'benchmark': 'metainfo_parse', 'ops_per_s': round(ops / elapsed, 1),
+            'num_pieces': num_pieces, 'num_files': num_files}
+
+
+BENCHMARKS = {
+    'parse_message': bench_parse_message,
+    'handle_block': bench_handle_block,
+    'metainfo': bench_metainfo,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the hot paths')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='benchmarks to run (%s), all by default' % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--min-time', type=float, default=1.0)
+    parser.add_argument('--json', action='store_true', help='print results as json lines')
+    parser.add_argument('--output', help='append json lines to this file')
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmark: %s' % ', '.join(sorted(unknown)))
+
+    results = []
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        result = BENCHMARKS[name](args.min_time)
+        results.append(result)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('%-16s %14.1f ops/s%s' % (result['benchmark'], result['ops_per_s'],
+                                            '  %10.2f MB/s' % result['mb_per_s'] if 'mb_per_s' in result else ''))
+    if args.output:
+        with open(args.output, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import time
+import struct
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from peer import Peer
+from rate import TokenBucket
+
+BLOCK_LENGTH = 2**14
+NUM_PIECES = 1024
+
+
+class StubPicker():
+    def peer_has(self, piece_index):
+        pass
+
+
+class StubMetainfo():
+    info = {'pieces': [b'\x00' * 20] * NUM_PIECES}
+
+
+class StubScheduler():
+    download_bucket = TokenBucket()
+
+
+class StubTorrent():
+    def __init__(self):
+        self.metainfo = StubMetainfo()
+        self.picker = StubPicker()
+        self.complete_pieces = [True] * NUM_PIECES
+        self.wanted_pieces = [False] * NUM_PIECES
+        self.scheduler = StubScheduler()
+        self.nbytes = 0
+
+    def handle_block(self, peer, piece_index, begin, block):
+        self.nbytes += len(block)
+
+    def next_request(self, peer):
+        raise AssertionError('no requests expected')
+
+
+class LegacyPeer(Peer):
+    # The receive path before the zero-copy buffer: concatenate every recv,
+    # then slice the message and the payload out of the joined bytes.
+    def handle_data_received(self, recv_data):
+        data = self.legacy_buffer + recv_data
+        while data:
+            nbytes = self.parse_message(data)
+            if nbytes == 0:
+                break
+            data = data[nbytes:]
+        self.legacy_buffer = data
+
+    def parse_message(self, data):
+        if len(data) < 4:
+            return 0
+        length_prefix = struct.unpack('!L', data[:4])[0]
+        if length_prefix == 0:
+            return 4
+        if 4 + length_prefix > len(data):
+            return 0
+        message = data[4:4+length_prefix]
+        self.handle_message(int(message[0]), message[1:])
+        return 4 + length_prefix
+
+
+def build_stream(num_blocks):
+    block = os.urandom(BLOCK_LENGTH)
+    msgs = []
+    for i in range(num_blocks):
+        (index, begin) = divmod(i * BLOCK_LENGTH, 2**18)
+        msgs.append(struct.pack('!LBLL', 9 + BLOCK_LENGTH, 7, index % NUM_PIECES, begin) + block)
+        if i % 16 == 0:
+            msgs.append(struct.pack('!LBL', 5, 4, index % NUM_PIECES))
+            msgs.append(struct.pack('!L', 0))
+    return b''.join(msgs)
+
+
+def feed_legacy(peer, stream, chunk):
+    for ofs in range(0, len(stream), chunk):
+        peer.handle_data_received(stream[ofs:ofs+chunk])
+
+
+def feed_recv_into(peer, stream, chunk):
+    view = memoryview(stream)
+    ofs = 0
+    while ofs < len(stream):
+        buf = peer.get_buffer(chunk)
+        nbytes = min(len(buf), chunk, len(stream) - ofs)
+        buf[:nbytes] = view[ofs:ofs+nbytes]
+        peer.buffer_updated(nbytes)
+        ofs += nbytes
+
+
+def measure(name, stream, chunk, min_time):
+    torrent = StubTorrent()
+    if name == 'legacy':
+        peer = LegacyPeer(torrent, '127.0.0.1', 0)
+        peer.legacy_buffer = b''
+        feed = feed_legacy
+    else:
+        peer = Peer(torrent, '127.0.0.1', 0)
+        feed = feed_recv_into
+    peer.reset()
+    peer.is_started = True
+    peer.peer_choking = False
+
+    iterations = 0
+    start = time.perf_counter()
+    while True:
+        feed(peer, stream, chunk)
+        iterations += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+    assert torrent.nbytes == iterations * (len(stream) // (BLOCK_LENGTH + 13)) * BLOCK_LENGTH
+    return {
+        'parser': name,
+        'chunk': chunk,
+        'mb_per_s': round(iterations * len(stream) / elapsed / 2**20, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Wire message parser throughput')
+    parser.add_argument('--blocks', type=int, default=1024, help='piece messages per stream')
+    parser.add_argument('--chunks', type=int, nargs='+', default=[4096, 65536],
+                        help='bytes delivered per recv')
+    parser.add_argument('--min-time', type=float, default=1.0)
+    parser.add_argument('--json', action='store_true', help='print results as json lines')
+    args = parser.parse_args(argv)
+
+    stream = build_stream(args.blocks)
+    for chunk in args.chunks:
+        for name in ('legacy', 'recv_into'):
+            result = measure(name, stream, chunk, args.min_time)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print('{parser:10s} chunk={chunk:<6d} {mb_per_s:10.1f} MB/s'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
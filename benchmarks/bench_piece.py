@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from piece import PieceBuffer
+
+BLOCK_LENGTH = 2**14
+
+
+def assemble_list(piece_length, blocks):
+    piece_blocks = []
+    for (begin, block) in blocks:
+        if any(v[0] == begin for v in piece_blocks):
+            continue
+        piece_blocks.append((begin, block))
+        if sum(len(v[1]) for v in piece_blocks) == piece_length:
+            break
+    piece_blocks.sort(key=lambda v: v[0])
+    return bytes(v for (_, block) in piece_blocks for v in block)
+
+
+def assemble_buffer(piece_length, blocks):
+    piece_buffer = PieceBuffer(0, piece_length, BLOCK_LENGTH)
+    for (begin, block) in blocks:
+        if piece_buffer.add_block(begin, block) and piece_buffer.is_complete():
+            break
+    return piece_buffer.data
+
+
+def measure(func, piece_length, min_time):
+    data = os.urandom(piece_length)
+    # Deliver the blocks out of order, as several pipelined peers would.
+    blocks = [(begin, data[begin:begin+BLOCK_LENGTH]) for begin in range(0, piece_length, BLOCK_LENGTH)]
+    blocks = blocks[1::2] + blocks[0::2]
+    assert bytes(func(piece_length, blocks)) == data
+
+    iterations = 0
+    start = time.perf_counter()
+    while True:
+        func(piece_length, blocks)
+        iterations += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+    return {
+        'assembly': func.__name__,
+        'piece_length': piece_length,
+        'pieces_per_s': round(iterations / elapsed, 1),
+        'mb_per_s': round(iterations * piece_length / elapsed / 2**20, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Piece assembly micro-benchmark')
+    parser.add_argument('--piece-lengths', type=int, nargs='+', default=[2**14, 2**18, 2**22])
+    parser.add_argument('--min-time', type=float, default=1.0)
+    parser.add_argument('--json', action='store_true', help='print results as json lines')
+    args = parser.parse_args(argv)
+
+    for piece_length in args.piece_lengths:
+        for func in (assemble_list, assemble_buffer):
+            result = measure(func, piece_length, args.min_time)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print('{assembly:16s} piece={piece_length:<8d} {pieces_per_s:10.1f} pieces/s '
+                      '{mb_per_s:10.2f} MB/s'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,465 @@
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import shutil
+import socket
+import hashlib
+import asyncio
+import argparse
+import collections
+import resource
+import tempfile
+import threading
+import contextlib
+import subprocess
+import multiprocessing
+
+import bencodepy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from settings import SETTINGS
+from client import Client
+from fake_tracker import FakeTracker
+
+HANDSHAKE = struct.Struct('!B19s8s20s20s')
+LENGTH_PREFIX = struct.Struct('!L')
+REQUEST_PAYLOAD = struct.Struct('!LLL')
+PIECE_MESSAGE_HEADER = struct.Struct('!LBLL')
+
+
+def make_torrent(directory, size, piece_length, name='synthetic.bin'):
+    seed_dir = os.path.join(directory, 'seed')
+    os.makedirs(seed_dir, exist_ok=True)
+    hashes = []
+    with open(os.path.join(seed_dir, name), 'wb') as f:
+        for offset in range(0, size, piece_length):
+            piece = os.urandom(min(piece_length, size - offset))
+            hashes.append(hashlib.sha1(piece).digest())
+            f.write(piece)
+    info = {b'name': name.encode(), b'length': size, b'piece length': piece_length,
+            b'pieces': b''.join(hashes)}
+    return (info, hashlib.sha1(bencodepy.encode(info)).digest())
+
+
+def write_metainfo(path, info, announce):
+    with open(path, 'wb') as f:
+        f.write(bencodepy.encode({b'announce': announce.encode(), b'info': info}))
+
+
+class FakeSeeder():
+    def __init__(self, data, info_hash, piece_length, num_pieces, latency=0.0, bandwidth=0, choke='never'):
+        self.data = data
+        self.info_hash = info_hash
+        self.piece_length = piece_length
+        self.num_pieces = num_pieces
+        self.latency = latency
+        self.bandwidth = bandwidth
+        # 'never' unchokes on interest, 'delay:N' waits N seconds first and
+        # 'periodic:N' toggles the choke every N seconds.
+        (self.choke_mode, _, choke_arg) = choke.partition(':')
+        self.choke_interval = float(choke_arg or 0)
+        self.server = None
+        self.port = None
+
+    async def start(self, host='127.0.0.1'):
+        self.server = await asyncio.start_server(self.handle_peer, host, 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def reserved(self):
+        return bytes(8)
+
+    def handle_connected(self, conn):
+        pass
+
+    def handle_message(self, conn, msg_id, message):
+        pass
+
+    def bitfield(self):
+        bitfield = bytearray(b'\xff' * ((self.num_pieces + 7) // 8))
+        spare = len(bitfield) * 8 - self.num_pieces
+        if spare:
+            bitfield[-1] = (0xff << spare) & 0xff
+        return bytes(bitfield)
+
+    async def handle_peer(self, reader, writer):
+        conn = SeederConnection(self, writer)
+        try:
+            await reader.readexactly(HANDSHAKE.size)
+            writer.write(HANDSHAKE.pack(19, b'BitTorrent protocol', self.reserved(), self.info_hash,
+                                        b'-FS0001-%012d' % self.port))
+            bitfield = self.bitfield()
+            writer.write(LENGTH_PREFIX.pack(1 + len(bitfield)) + b'\x05' + bitfield)
+            self.handle_connected(conn)
+            conn.sender = asyncio.ensure_future(conn.send_blocks())
+            while True:
+                (length,) = LENGTH_PREFIX.unpack(await reader.readexactly(4))
+                if length == 0:
+                    continue
+                message = await reader.readexactly(length)
+                msg_id = message[0]
+                if msg_id == 2:
+                    conn.handle_interested()
+                elif msg_id == 6:
+                    conn.handle_request(*REQUEST_PAYLOAD.unpack_from(message, 1))
+                elif msg_id == 8:
+                    conn.handle_cancel(*REQUEST_PAYLOAD.unpack_from(message, 1))
+                else:
+                    self.handle_message(conn, msg_id, message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            conn.close()
+        writer.close()
+
+
+class SeederConnection():
+    def __init__(self, seeder, writer):
+        self.seeder = seeder
+        self.writer = writer
+        self.queue = collections.deque()
+        self.wakeup = asyncio.Event()
+        self.choking = True
+        self.interested = False
+        self.choke_task = None
+        self.sender = None
+        self.closed = False
+
+    def handle_interested(self):
+        if self.interested:
+            return
+        self.interested = True
+        mode = self.seeder.choke_mode
+        if mode == 'never':
+            self.set_choking(False)
+        else:
+            self.choke_task = asyncio.ensure_future(self.run_choker(mode))
+
+    async def run_choker(self, mode):
+        await asyncio.sleep(self.seeder.choke_interval)
+        self.set_choking(False)
+        while mode == 'periodic' and not self.closed:
+            await asyncio.sleep(self.seeder.choke_interval)
+            self.set_choking(not self.choking)
+
+    def set_choking(self, choking):
+        if self.closed:
+            return
+        self.choking = choking
+        if choking:
+            # A choke discards every pending request (BEP 3).
+            self.queue.clear()
+        self.writer.write(LENGTH_PREFIX.pack(1) + (b'\x00' if choking else b'\x01'))
+
+    def handle_request(self, index, begin, length):
+        if self.choking:
+            return
+        self.queue.append((time.monotonic() + self.seeder.latency, index, begin, length))
+        self.wakeup.set()
+
+    def handle_cancel(self, index, begin, length):
+        for entry in self.queue:
+            if entry[1:] == (index, begin, length):
+                self.queue.remove(entry)
+                break
+
+    async def send_blocks(self):
+        seeder = self.seeder
+        next_send = time.monotonic()
+        while not self.closed:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            (due, index, begin, length) = self.queue[0]
+            now = time.monotonic()
+            wait = max(due, next_send) - now
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            self.queue.popleft()
+            offset = index * seeder.piece_length + begin
+            self.writer.write(PIECE_MESSAGE_HEADER.pack(9 + length, 7, index, begin))
+            self.writer.write(seeder.data[offset:offset+length])
+            if seeder.bandwidth:
+                next_send = max(next_send, now) + length / seeder.bandwidth
+            await self.writer.drain()
+
+    def close(self):
+        self.closed = True
+        for task in (self.choke_task, self.sender):
+            if task:
+                task.cancel()
+
+
+async def serve_swarm(config, report):
+    with open(config['data_path'], 'rb') as f:
+        data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    seeders = []
+    for i in range(config['seeders']):
+        seeder = FakeSeeder(data, config['info_hash'], config['piece_length'], config['num_pieces'],
+                            config['latency'], config['bandwidth'], config['choke'])
+        await seeder.start()
+        seeders.append(seeder)
+    tracker = FakeTracker([('127.0.0.1', s.port) for s in seeders], quiet=True)
+    await tracker.start()
+    report({'tracker': 'http://127.0.0.1:%d/announce' % tracker.http_port,
+            'ports': [s.port for s in seeders]})
+    await asyncio.Event().wait()
+
+
+def run_swarm_process(config, conn):
+    asyncio.run(serve_swarm(config, conn.send))
+
+
+def run_swarm_thread(config, result, ready):
+    def report(value):
+        result.update(value)
+        ready.set()
+    asyncio.run(serve_swarm(config, report))
+
+
+def start_swarm(config, inprocess):
+    if inprocess:
+        (result, ready) = ({}, threading.Event())
+        threading.Thread(target=run_swarm_thread, args=(config, result, ready), daemon=True).start()
+        ready.wait()
+        return (result, None)
+    (parent_conn, child_conn) = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=run_swarm_process, args=(config, child_conn), daemon=True)
+    process.start()
+    return (parent_conn.recv(), process)
+
+
+class BenchClient(Client):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.first_piece_time = None
+        self.completed = False
+        self.stream_done = None
+
+    def piece_on_complete(self, torrent):
+        if self.first_piece_time is None:
+            self.first_piece_time = time.monotonic()
+
+    def torrent_on_completed(self, torrent):
+        self.completed = True
+        super().torrent_on_completed(torrent)
+        if self.stream_done:
+            self.on_all_torrent_completed()
+
+    def handle_stream_done(self):
+        self.stream_done = True
+        if self.completed:
+            self.on_all_torrent_completed()
+
+
+def play_stream(client, torrent, data_path, offset, rate, result, chunk=2**16, stall_threshold=0.05):
+    # Reads the file through the stream server from another thread, as a
+    # player would: from offset on, at rate bytes/s or as fast as it comes.
+    # A chunk that arrives more than stall_threshold after the player
+    # wanted it counts as a stall.
+    while client.stream_server.port is None:
+        time.sleep(0.01)
+    sha = hashlib.sha1()
+    (first_byte, stalls, stall_time) = (None, 0, 0.0)
+    start = time.monotonic()
+    with socket.create_connection(('127.0.0.1', client.stream_server.port)) as sock:
+        sock.sendall(b'GET /%s/0/stream HTTP/1.1\r\nHost: localhost\r\nRange: bytes=%d-\r\n\r\n'
+                     % (torrent.metainfo.info_hash.hex().encode(), offset))
+        f = sock.makefile('rb')
+        status = f.readline()
+        while f.readline() not in (b'\r\n', b''):
+            pass
+        while True:
+            data = f.read(chunk)
+            now = time.monotonic()
+            if not data:
+                break
+            if first_byte is None:
+                first_byte = now - start
+                due = now
+            elif now > due + stall_threshold:
+                stalls += 1
+                stall_time += now - due
+                due = now
+            sha.update(data)
+            if rate:
+                due += len(data) / rate
+                if due > now:
+                    time.sleep(due - now)
+            else:
+                due = now
+    with open(data_path, 'rb') as f:
+        f.seek(offset)
+        expected = hashlib.sha1(f.read()).digest()
+    result.update({
+        'stream_status': status.split(b' ', 2)[1].decode() if status else None,
+        'stream_ok': sha.digest() == expected,
+        'stream_ttfb': round(first_byte, 3) if first_byte is not None else None,
+        'stream_stalls': stalls,
+        'stream_stall_time': round(stall_time, 3),
+        'stream_elapsed': round(time.monotonic() - start, 3),
+    })
+    client.conn_man.loop.call_soon_threadsafe(client.handle_stream_done)
+
+
+def count_extents(path):
+    # filefrag (e2fsprogs) reports how many extents the file ended up in.
+    try:
+        output = subprocess.run(['filefrag', path], capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    words = output.rsplit(':', 1)[-1].split()
+    return int(words[0]) if words and words[0].isdigit() else None
+
+
+def run_client(torrent_path, out_dir, timeout, stream=None):
+    client = BenchClient(output_destination=out_dir)
+    add_start = time.monotonic()
+    torrent = client.add_torrent(torrent_path)
+    add_time = time.monotonic() - add_start
+    client.conn_man.loop.call_later(timeout, client.on_all_torrent_completed)
+    stream_result = {}
+    if stream:
+        client.stream_done = False
+        client.stream_server.start(0)
+        threading.Thread(target=play_stream, args=(client, torrent) + stream + (stream_result,),
+                         daemon=True).start()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.monotonic()
+    with contextlib.redirect_stdout(sys.stderr):
+        client.start_torrents()
+    elapsed = time.monotonic() - start
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (end_usage.ru_utime - usage.ru_utime) + (end_usage.ru_stime - usage.ru_stime)
+    if stream:
+        stream_result['stream_server_stalls'] = client.stream_server.stalls
+    cache = client.cache.stats()
+    extents = [count_extents(f['path']) for f in torrent.storage.files]
+    return dict(stream_result, **{
+        'completed': client.completed,
+        'elapsed': round(elapsed, 3),
+        'mb_per_s': round(torrent.downloaded / elapsed / 2**20, 2) if client.completed else None,
+        'cpu_s': round(cpu, 3),
+        'cpu_pct': round(100.0 * cpu / elapsed, 1),
+        'peak_rss_mb': round(end_usage.ru_maxrss / 1024.0, 1),
+        'time_to_first_piece': (round(client.first_piece_time - start, 3)
+                                if client.first_piece_time else None),
+        'hash_failures': torrent.hash_failures,
+        'tail_piece_latency': torrent.stats()['tail_piece_latency'],
+        'disk_writes': cache['writes'],
+        'cache_flushes': cache['flushes'],
+        'flush_time_mean': round(cache['flush_time']['sum'] / cache['flushes'], 4) if cache['flushes'] else None,
+        'allocation': SETTINGS['allocation'],
+        'allocate_time': round(add_time, 4),
+        'extents': sum(extents) if None not in extents else None,
+    })
+
+
+def measure(args, workdir):
+    (info, info_hash) = make_torrent(workdir, args.size, args.piece_length)
+    num_pieces = len(info[b'pieces']) // 20
+    config = {
+        'data_path': os.path.join(workdir, 'seed', info[b'name'].decode()),
+        'info_hash': info_hash,
+        'piece_length': args.piece_length,
+        'num_pieces': num_pieces,
+        'seeders': args.seeders,
+        'latency': args.latency,
+        'bandwidth': args.bandwidth * 1024,
+        'choke': args.choke,
+    }
+    (swarm, process) = start_swarm(config, args.inprocess)
+    torrent_path = os.path.join(workdir, 'bench.torrent')
+    write_metainfo(torrent_path, info, swarm['tracker'])
+
+    SETTINGS['listen_port'] = 0
+    SETTINGS['dht'] = False
+    SETTINGS['max_peers'] = max(SETTINGS['max_peers'], args.seeders)
+    if args.cache_size is not None:
+        SETTINGS['cache_size'] = args.cache_size * 2**20
+    SETTINGS['allocation'] = args.allocation
+    stream = None
+    if args.stream:
+        # Like --stream-port, keep the files open for the reader.
+        SETTINGS['seed'] = True
+        stream = (config['data_path'], args.stream_offset, args.stream_rate * 1024)
+    results = []
+    try:
+        for run in range(args.repeat):
+            out_dir = os.path.join(workdir, 'out%d' % run)
+            result = run_client(torrent_path, out_dir, args.timeout, stream)
+            result.update({
+                'benchmark': 'swarm',
+                'run': run,
+                'size': args.size,
+                'piece_length': args.piece_length,
+                'seeders': args.seeders,
+                'seeder_mode': 'thread' if args.inprocess else 'process',
+                'latency': args.latency,
+                'bandwidth_kib': args.bandwidth,
+                'choke': args.choke,
+            })
+            results.append(result)
+            shutil.rmtree(out_dir, ignore_errors=True)
+    finally:
+        if process:
+            process.terminate()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Download from fake seeders on loopback')
+    parser.add_argument('--size', type=int, default=64 * 2**20, help='torrent size in bytes')
+    parser.add_argument('--piece-length', type=int, default=2**18)
+    parser.add_argument('--seeders', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each block is sent')
+    parser.add_argument('--bandwidth', type=int, default=0, help='per-peer upload limit in KiB/s, 0 for none')
+    parser.add_argument('--choke', default='never', help="'never', 'delay:SECONDS' or 'periodic:SECONDS'")
+    parser.add_argument('--inprocess', action='store_true',
+                        help='run the seeders on a thread in this process (CPU figures then include them)')
+    parser.add_argument('--stream', action='store_true',
+                        help='play the file through the HTTP stream server while it downloads')
+    parser.add_argument('--stream-offset', type=int, default=0, help='byte offset the player starts at')
+    parser.add_argument('--stream-rate', type=int, default=0,
+                        help='player bitrate in KiB/s, 0 to read as fast as pieces arrive')
+    parser.add_argument('--cache-size', type=int, help='disk cache in MiB, 0 to write every piece as it completes')
+    parser.add_argument('--allocation', choices=['sparse', 'full', 'none'], default=SETTINGS['allocation'],
+                        help='how the client allocates its output files')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--json', action='store_true', help='print results as json lines')
+    parser.add_argument('--output', help='append json lines to this file')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='bench_swarm_')
+    try:
+        results = measure(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('run={run} seeders={seeders} latency={latency} bandwidth={bandwidth_kib}KiB/s choke={choke}: '
+                  'completed={completed} {mb_per_s} MB/s cpu={cpu_s}s ({cpu_pct}%) '
+                  'peak_rss={peak_rss_mb}MB first_piece={time_to_first_piece}s disk_writes={disk_writes} '
+                  'flushes={cache_flushes} (mean {flush_time_mean}s) allocation={allocation} '
+                  '({allocate_time}s, {extents} extents)'.format(**result))
+            if args.stream:
+                print('  stream from {offset}: ok={stream_ok} ttfb={stream_ttfb}s stalls={stream_stalls} '
+                      '({stream_stall_time}s, {stream_server_stalls} waits at the server) '
+                      'in {stream_elapsed}s'.format(offset=args.stream_offset, **result))
+    if args.output:
+        with open(args.output, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
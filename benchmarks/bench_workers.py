@@ -0,0 +1,127 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from settings import SETTINGS
+from supervisor import Supervisor
+from bench_swarm import make_torrent, write_metainfo, start_swarm
+
+
+@contextlib.contextmanager
+def stdout_to_stderr():
+    # Workers inherit file descriptors, not sys.stdout.
+    sys.stdout.flush()
+    saved = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+def make_swarms(args, workdir):
+    torrent_paths = []
+    processes = []
+    for i in range(args.torrents):
+        directory = os.path.join(workdir, 'swarm%d' % i)
+        (info, info_hash) = make_torrent(directory, args.size, args.piece_length, name='synthetic%d.bin' % i)
+        config = {
+            'data_path': os.path.join(directory, 'seed', info[b'name'].decode()),
+            'info_hash': info_hash,
+            'piece_length': args.piece_length,
+            'num_pieces': len(info[b'pieces']) // 20,
+            'seeders': args.seeders,
+            'latency': 0.0,
+            'bandwidth': 0,
+            'choke': 'never',
+        }
+        (swarm, process) = start_swarm(config, False)
+        processes.append(process)
+        torrent_path = os.path.join(directory, 'bench.torrent')
+        write_metainfo(torrent_path, info, swarm['tracker'])
+        torrent_paths.append(torrent_path)
+    return (torrent_paths, processes)
+
+
+def run_supervisor(torrent_paths, num_workers, out_dir):
+    supervisor = Supervisor(torrent_paths, num_workers, out_dir)
+    # Seeders are only reaped at the end, so this counts the workers.
+    start_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.monotonic()
+    with stdout_to_stderr():
+        supervisor.run()
+    elapsed = time.monotonic() - start
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (usage.ru_utime - start_usage.ru_utime) + (usage.ru_stime - start_usage.ru_stime)
+    stats = supervisor.stats()
+    downloaded = sum(t['downloaded'] for t in stats['torrents'])
+    return {
+        'completed': len(stats['torrents']) == len(torrent_paths) and not any(t['left'] for t in stats['torrents']),
+        'elapsed': round(elapsed, 3),
+        'mb_per_s': round(downloaded / elapsed / 2**20, 2),
+        'children_cpu_s': round(cpu, 3),
+        'hash_failures': sum(t['hash_failures'] for t in stats['torrents']),
+        'loop_max_lag': round(stats['loop']['max_lag'], 4),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Aggregate download throughput against the number of workers')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--torrents', type=int, default=4)
+    parser.add_argument('--size', type=int, default=32 * 2**20, help='bytes per torrent')
+    parser.add_argument('--piece-length', type=int, default=2**18)
+    parser.add_argument('--seeders', type=int, default=2, help='fake seeders per torrent')
+    parser.add_argument('--json', action='store_true', help='print results as json lines')
+    parser.add_argument('--output', help='append json lines to this file')
+    args = parser.parse_args(argv)
+
+    SETTINGS['listen_port'] = 0
+    SETTINGS['dht'] = False
+    SETTINGS['max_active_torrents'] = args.torrents
+    workdir = tempfile.mkdtemp(prefix='bench_workers_')
+    results = []
+    processes = []
+    try:
+        (torrent_paths, processes) = make_swarms(args, workdir)
+        for num_workers in args.workers:
+            out_dir = os.path.join(workdir, 'out%d' % num_workers)
+            result = run_supervisor(torrent_paths, num_workers, out_dir)
+            result.update({
+                'benchmark': 'workers',
+                'workers': num_workers,
+                'torrents': args.torrents,
+                'size': args.size,
+                'cpus': os.cpu_count(),
+            })
+            results.append(result)
+            shutil.rmtree(out_dir, ignore_errors=True)
+    finally:
+        for process in processes:
+            process.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('workers={workers} torrents={torrents}: completed={completed} {mb_per_s} MB/s in {elapsed}s '
+                  'worker cpu={children_cpu_s}s max_lag={loop_max_lag}s'.format(**result))
+    if args.output:
+        with open(args.output, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
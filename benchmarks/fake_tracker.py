@@ -0,0 +1,140 @@
+import sys
+import time
+import random
+import struct
+import asyncio
+import argparse
+import urllib.parse
+
+import bencodepy
+
+UDP_PROTOCOL_ID = 0x41727101980
+UDP_HEADER = struct.Struct('!LL')
+UDP_CONNECT_REQUEST = struct.Struct('!QLL')
+UDP_ANNOUNCE_REQUEST = struct.Struct('!QLL20s20sQQQLLLlH')
+UDP_EVENTS = {0: None, 1: 'completed', 2: 'started', 3: 'stopped'}
+
+
+class FakeTracker():
+    def __init__(self, peers, interval=1800, udp_drop=0, quiet=False):
+        self.peers = peers
+        self.quiet = quiet
+        self.interval = interval
+        # Number of UDP datagrams to ignore, to exercise client retransmits.
+        self.udp_drop = udp_drop
+        self.connection_ids = set()
+        self.announces = []
+        self.http_connections = 0
+        self.http_server = None
+        self.udp_transport = None
+
+    def compact_peers(self):
+        return b''.join(struct.pack('!4sH', bytes(int(v) for v in ip.split('.')), port)
+                        for (ip, port) in self.peers)
+
+    def record(self, scheme, params):
+        params['scheme'] = scheme
+        params['time'] = time.monotonic()
+        self.announces.append(params)
+        if self.quiet:
+            return
+        print('%s announce: event=%s left=%s uploaded=%s downloaded=%s' % (
+            scheme, params.get('event'), params.get('left'), params.get('uploaded'),
+            params.get('downloaded')), flush=True)
+
+    async def start(self, host='127.0.0.1', http_port=0, udp_port=0):
+        loop = asyncio.get_running_loop()
+        self.http_server = await asyncio.start_server(self.handle_http, host, http_port)
+        self.http_port = self.http_server.sockets[0].getsockname()[1]
+        (self.udp_transport, _) = await loop.create_datagram_endpoint(
+            lambda: FakeUDPTrackerProtocol(self), local_addr=(host, udp_port))
+        self.udp_port = self.udp_transport.get_extra_info('sockname')[1]
+
+    def close(self):
+        self.http_server.close()
+        self.udp_transport.close()
+
+    async def handle_http(self, reader, writer):
+        self.http_connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                target = request_line.split()[1].decode('latin-1')
+                query = urllib.parse.parse_qs(urllib.parse.urlsplit(target).query, encoding='latin-1')
+                params = {k: v[0] for (k, v) in query.items()}
+                self.record('http', params)
+                body = bencodepy.encode({b'interval': self.interval, b'peers': self.compact_peers()})
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+                await writer.drain()
+        except (ConnectionError, IndexError):
+            pass
+        writer.close()
+
+    def handle_datagram(self, data, addr):
+        if self.udp_drop > 0:
+            self.udp_drop -= 1
+            return
+        if len(data) == UDP_CONNECT_REQUEST.size:
+            (protocol_id, action, transaction_id) = UDP_CONNECT_REQUEST.unpack(data)
+            if protocol_id != UDP_PROTOCOL_ID or action != 0:
+                return
+            connection_id = random.getrandbits(64)
+            self.connection_ids.add(connection_id)
+            self.udp_transport.sendto(struct.pack('!LLQ', 0, transaction_id, connection_id), addr)
+        elif len(data) >= UDP_ANNOUNCE_REQUEST.size:
+            (connection_id, action, transaction_id, info_hash, peer_id, downloaded, left, uploaded,
+             event, _, _, _, port) = UDP_ANNOUNCE_REQUEST.unpack_from(data)
+            if connection_id not in self.connection_ids:
+                self.udp_transport.sendto(UDP_HEADER.pack(3, transaction_id) + b'unknown connection id', addr)
+                return
+            self.record('udp', {'event': UDP_EVENTS.get(event), 'left': left, 'uploaded': uploaded,
+                                'downloaded': downloaded, 'port': port})
+            seeders = len(self.peers)
+            self.udp_transport.sendto(struct.pack('!LLLLL', 1, transaction_id, self.interval, 0, seeders)
+                                      + self.compact_peers(), addr)
+
+
+class FakeUDPTrackerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def datagram_received(self, data, addr):
+        self.tracker.handle_datagram(data, addr)
+
+
+def parse_peer(value):
+    (ip, port) = value.rsplit(':', 1)
+    return (ip, int(port))
+
+
+async def serve(args):
+    tracker = FakeTracker(args.peer, args.interval, args.udp_drop)
+    await tracker.start(args.host, args.http_port, args.udp_port)
+    print('http://%s:%d/announce udp://%s:%d/announce' % (
+        args.host, tracker.http_port, args.host, tracker.udp_port), flush=True)
+    await asyncio.Event().wait()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Local HTTP and UDP (BEP 15) tracker for tests')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--http-port', type=int, default=0)
+    parser.add_argument('--udp-port', type=int, default=0)
+    parser.add_argument('--peer', type=parse_peer, action='append', default=[],
+                        help='ip:port handed out in every announce response')
+    parser.add_argument('--interval', type=int, default=1800)
+    parser.add_argument('--udp-drop', type=int, default=0,
+                        help='ignore the first N UDP datagrams')
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,204 @@
+import time
+import logging
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from settings import SETTINGS
+from stats import Histogram, LOOP_BUCKETS
+from storage import StorageError
+
+log = logging.getLogger(__name__)
+
+
+class DiskCache():
+    # Verified pieces wait here until they are written as runs of
+    # consecutive pieces, and pieces read for uploads stay in an LRU. Both
+    # share cache_size bytes across every torrent.
+    def __init__(self, loop, size=None):
+        self.loop = loop
+        self.size = SETTINGS['cache_size'] if size is None else size
+        # One writer keeps runs in order and off the event loop.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='flush')
+        self.dirty = {}
+        self.flushing = {}
+        self.clean = collections.OrderedDict()
+        self.dirty_bytes = 0
+        self.flushing_bytes = 0
+        self.clean_bytes = 0
+        self.flush_future = None
+        self.flush_timer = None
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.writes = 0
+        self.bytes_written = 0
+        self.flush_time = Histogram(LOOP_BUCKETS)
+
+    def write_piece(self, storage, piece_index, data):
+        self.dirty.setdefault(storage, {})[piece_index] = data
+        self.dirty_bytes += len(data)
+        self.evict()
+        if self.dirty_bytes + self.flushing_bytes > self.size or self.dirty_bytes >= SETTINGS['cache_flush_bytes']:
+            # Over budget the piece still waits for the running flush rather
+            # than being written here: only the flush thread writes to a
+            # Storage, and the loop must not block on it.
+            self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = self.loop.call_later(SETTINGS['cache_flush_interval'], self.flush)
+
+    def read_block(self, storage, piece_index, begin, length):
+        data = self.lookup(storage, piece_index)
+        if data is not None:
+            self.hits += 1
+            return memoryview(data)[begin:begin+length]
+        self.misses += 1
+        piece_length = storage.metainfo.get_piece_length(piece_index)
+        if piece_length > self.size:
+            return storage.read_block(piece_index, begin, length)
+        # One read for the whole piece; peers usually ask for the rest of
+        # its blocks next.
+        data = bytes(storage.read_block(piece_index, 0, piece_length))
+        self.add_clean(storage, piece_index, data)
+        return memoryview(data)[begin:begin+length]
+
+    def lookup(self, storage, piece_index):
+        for pending in (self.dirty, self.flushing):
+            data = pending.get(storage, {}).get(piece_index)
+            if data is not None:
+                return data
+        key = (storage, piece_index)
+        data = self.clean.get(key)
+        if data is not None:
+            self.clean.move_to_end(key)
+        return data
+
+    def add_clean(self, storage, piece_index, data):
+        key = (storage, piece_index)
+        if key in self.clean:
+            self.clean_bytes -= len(self.clean.pop(key))
+        self.clean[key] = data
+        self.clean_bytes += len(data)
+        self.evict()
+
+    def evict(self):
+        while self.clean and self.dirty_bytes + self.flushing_bytes + self.clean_bytes > self.size:
+            (_, data) = self.clean.popitem(last=False)
+            self.clean_bytes -= len(data)
+
+    def pending_pieces(self, storage):
+        return set(self.dirty.get(storage, ())) | set(self.flushing.get(storage, ()))
+
+    def flush(self):
+        if self.flush_timer:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        # A running flush starts the next one when it is done.
+        if self.flush_future is not None or not self.dirty:
+            return
+        (self.flushing, self.dirty) = (self.dirty, {})
+        (self.flushing_bytes, self.dirty_bytes) = (self.dirty_bytes, 0)
+        runs = [(storage, piece_index, buffers) for (storage, pieces) in self.flushing.items()
+                for (piece_index, buffers) in find_runs(pieces)]
+        future = self.executor.submit(self.write_runs, runs)
+        self.flush_future = future
+        future.add_done_callback(lambda f: self.loop.call_soon_threadsafe(self.handle_flush_done, f))
+
+    @staticmethod
+    def write_runs(runs):
+        start = time.perf_counter()
+        num_writes = 0
+        for (storage, piece_index, buffers) in runs:
+            num_writes += storage.write_pieces(piece_index, buffers)
+        return (time.perf_counter() - start, num_writes)
+
+    def handle_flush_done(self, future, restart=True):
+        if future is not self.flush_future:
+            return
+        self.flush_future = None
+        (flushed, self.flushing) = (self.flushing, {})
+        (nbytes, self.flushing_bytes) = (self.flushing_bytes, 0)
+        try:
+            (elapsed, num_writes) = future.result()
+        except (OSError, StorageError) as e:
+            # Keep the pieces and try again later; newer copies win.
+            log.error('Flushing %d bytes to disk failed: %s' % (nbytes, e))
+            for (storage, pieces) in flushed.items():
+                dirty = self.dirty.setdefault(storage, {})
+                for (piece_index, data) in pieces.items():
+                    if piece_index not in dirty:
+                        dirty[piece_index] = data
+                        self.dirty_bytes += len(data)
+            if restart and self.flush_timer is None:
+                self.flush_timer = self.loop.call_later(SETTINGS['cache_flush_interval'], self.flush)
+            return
+        self.flushes += 1
+        self.writes += num_writes
+        self.bytes_written += nbytes
+        self.flush_time.observe(elapsed)
+        log.debug('flushed %d bytes in %d writes, %.3fs' % (nbytes, num_writes, elapsed))
+        for (storage, pieces) in flushed.items():
+            for (piece_index, data) in pieces.items():
+                self.add_clean(storage, piece_index, data)
+        if restart and (self.dirty_bytes >= SETTINGS['cache_flush_bytes'] or self.dirty_bytes > self.size):
+            self.flush()
+
+    def wait_flushed(self):
+        future = self.flush_future
+        if future is None:
+            return
+        try:
+            future.result()
+        except (OSError, StorageError):
+            pass
+        self.handle_flush_done(future, restart=False)
+
+    def flush_storage(self, storage):
+        # Writes out everything pending for storage before returning.
+        self.wait_flushed()
+        pieces = self.dirty.pop(storage, {})
+        for (piece_index, buffers) in find_runs(pieces):
+            self.writes += storage.write_pieces(piece_index, buffers)
+        nbytes = sum(len(data) for data in pieces.values())
+        self.dirty_bytes -= nbytes
+        self.bytes_written += nbytes
+        if not self.dirty and self.flush_timer:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+    def close_storage(self, storage):
+        self.flush_storage(storage)
+        for key in [key for key in self.clean if key[0] is storage]:
+            self.clean_bytes -= len(self.clean.pop(key))
+
+    def shutdown(self):
+        self.wait_flushed()
+        if self.flush_timer:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        self.executor.shutdown(wait=True)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': self.size,
+            'dirty_bytes': self.dirty_bytes + self.flushing_bytes,
+            'cached_bytes': self.clean_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+            'flushes': self.flushes,
+            'writes': self.writes,
+            'bytes_written': self.bytes_written,
+            'flush_time': self.flush_time.snapshot(),
+        }
+
+
+def find_runs(pieces):
+    # (first piece, [data, ...]) for each run of consecutive piece indexes.
+    runs = []
+    for piece_index in sorted(pieces):
+        if runs and runs[-1][0] + len(runs[-1][1]) == piece_index:
+            runs[-1][1].append(pieces[piece_index])
+        else:
+            runs.append((piece_index, [pieces[piece_index]]))
+    return runs
@@ -0,0 +1,62 @@
+import random
+import logging
+
+from settings import SETTINGS
+
+log = logging.getLogger(__name__)
+
+
+class Choker():
+    def __init__(self, torrent):
+        self.torrent = torrent
+        self.optimistic_peer = None
+        self.round = 0
+        self.timer = None
+
+    def start(self):
+        self.timer = self.torrent.conn_man.loop.call_later(SETTINGS['choke_interval'], self.run)
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def candidates(self):
+        return [p for p in self.torrent.registry.active
+                if p.conn and p.is_started and p.peer_interested]
+
+    def run(self):
+        self.rechoke()
+        self.start()
+
+    def rechoke(self):
+        candidates = self.candidates()
+        if self.round % SETTINGS['optimistic_unchoke_rounds'] == 0 or self.optimistic_peer not in candidates:
+            self.rotate_optimistic(candidates)
+        self.round += 1
+
+        # Tit-for-tat: while downloading, reward the peers that give us the
+        # most; once complete, prefer the peers that take data fastest.
+        if self.torrent.is_complete:
+            key = lambda p: p.upload_rate.rate()
+        else:
+            key = lambda p: p.download_rate.rate()
+        regular = [p for p in candidates if p is not self.optimistic_peer]
+        regular.sort(key=key, reverse=True)
+        unchoked = set(regular[:max(0, SETTINGS['upload_slots'] - 1)])
+        if self.optimistic_peer is not None:
+            unchoked.add(self.optimistic_peer)
+
+        for p in list(self.torrent.registry.active):
+            if p.conn and p.is_started:
+                p.set_choking(p not in unchoked)
+
+    def rotate_optimistic(self, candidates):
+        choked = [p for p in candidates if p.am_choking and p is not self.optimistic_peer]
+        self.optimistic_peer = random.choice(choked) if choked else None
+        log.debug('Optimistic unchoke: %s' % self.optimistic_peer)
+
+    def handle_interested(self, peer):
+        num_unchoked = sum(1 for p in self.torrent.registry.active if p.conn and not p.am_choking)
+        if peer.am_choking and num_unchoked < SETTINGS['upload_slots']:
+            peer.set_choking(False)
@@ -1,67 +1,177 @@
-import os
+import asyncio
 import logging
 
+from settings import SETTINGS
 from metainfo import Metainfo
-from torrent import Torrent
+from storage import Storage
+from torrent import Torrent, match_file_priorities
+from picker import SKIP
+from verifier import PieceVerifier
+from cache import DiskCache
+from scheduler import Scheduler
 from connection import ConnectionManager
+from stats import LoopMonitor, StatsServer
+from stream import StreamServer
+from control import ControlServer
+from dht import DHT
 
 log = logging.getLogger(__name__)
 
 
 class Client():
     def __init__(self, output_destination=None):
+        self.queued_torrent = []
         self.active_torrent = []
         self.finished_torrent = []
+        self.paused_torrent = []
         self.output_destination = output_destination
         self.conn_man = ConnectionManager()
+        self.verifier = PieceVerifier(self.conn_man.loop)
+        self.cache = DiskCache(self.conn_man.loop)
+        self.scheduler = Scheduler(self)
+        self.loop_monitor = LoopMonitor(self.conn_man.loop)
+        self.stats_server = StatsServer(self.conn_man.loop, self.stats)
+        self.stream_server = StreamServer(self)
+        self.dht = None
+        if SETTINGS['dht']:
+            port = SETTINGS['dht_port'] if SETTINGS['dht_port'] is not None else SETTINGS['listen_port']
+            self.dht = DHT(self.conn_man.loop, port)
+            self.dht.start()
+        if SETTINGS['stats_port']:
+            self.stats_server.start(SETTINGS['stats_port'])
+        if SETTINGS['stream_port']:
+            self.stream_server.start(SETTINGS['stream_port'])
+        self.control_server = None
+        if SETTINGS['control_socket']:
+            self.control_server = ControlServer(self)
+            self.control_server.start(SETTINGS['control_socket'])
+        if SETTINGS['listen_port']:
+            self.conn_man.start_listening(SETTINGS['listen_port'], self.handle_incoming_connection)
 
-    def add_torrent(self, filename):
+    def add_torrent(self, filename, file_rules=()):
         with open(filename, 'rb') as f:
             contents = f.read()
         metainfo = Metainfo(contents)
-        torrent = Torrent(self.conn_man, metainfo, self.torrent_on_completed, self.piece_on_complete)
-        self.active_torrent.append(torrent)
+        return self.add_metainfo(metainfo, match_file_priorities(metainfo, file_rules))
+
+    def add_metainfo(self, metainfo, file_priorities):
+        storage = Storage(metainfo, self.output_destination)
+        storage.open(skipped_files={i for (i, p) in enumerate(file_priorities) if p == SKIP})
+        torrent = Torrent(self.conn_man, metainfo, storage, self.verifier, self.scheduler,
+                          self.torrent_on_completed, self.piece_on_complete, self.dht, file_priorities,
+                          self.cache, torrent_on_rechecked=self.torrent_on_rechecked)
+        self.queued_torrent.append(torrent)
+        return torrent
+
+    def remove_torrent(self, torrent):
+        # Stops one torrent while the others keep running.
+        if torrent in self.paused_torrent:
+            self.paused_torrent.remove(torrent)
+            return
+        if torrent in self.queued_torrent:
+            self.queued_torrent.remove(torrent)
+            torrent.fail_piece_waiters()
+            torrent.storage.close()
+            return
+        for torrents in (self.active_torrent, self.finished_torrent):
+            if torrent in torrents:
+                torrents.remove(torrent)
+        torrent.close_torrent()
+        if torrent.tracker:
+            self.conn_man.loop.create_task(torrent.tracker.announce_stopped())
+        self.scheduler.start_queued()
+
+    def pause_torrent(self, torrent):
+        if torrent in self.paused_torrent:
+            return
+        self.remove_torrent(torrent)
+        self.paused_torrent.append(torrent)
+
+    def resume_torrent(self, torrent):
+        # A stopped Torrent cannot be restarted; a new one picks up from its
+        # resume data.
+        self.paused_torrent.remove(torrent)
+        resumed = self.add_metainfo(torrent.metainfo, torrent.file_priorities)
+        self.scheduler.start_queued()
+        return resumed
+
+    def set_file_priorities(self, torrent, file_priorities):
+        torrent.set_file_priorities(file_priorities)
+        if torrent in self.finished_torrent and not torrent.is_complete:
+            self.finished_torrent.remove(torrent)
+            self.active_torrent.append(torrent)
+            self.scheduler.rebalance()
+
+    def handle_incoming_connection(self, conn, info_hash, ip, port):
+        for torrent in self.active_torrent + self.finished_torrent:
+            if torrent.metainfo.info_hash == info_hash:
+                return torrent.handle_incoming_connection(ip, port)
+        return None
 
     def start_torrents(self):
-        for torrent in self.active_torrent:
-            torrent.start_torrent()
-        self.conn_man.start_event_loop()
+        self.scheduler.start()
+        self.loop_monitor.start()
+        try:
+            self.conn_man.start_event_loop()
+        finally:
+            self.scheduler.stop()
+            self.loop_monitor.stop()
+            self.stats_server.stop()
+            self.stream_server.stop()
+            if self.control_server:
+                self.control_server.stop()
+            torrents = self.active_torrent + self.finished_torrent
+            for torrent in torrents:
+                torrent.stop_torrent()
+            self.announce_stopped(torrents)
+            self.cache.shutdown()
+            if self.dht:
+                self.dht.stop()
+
+    def announce_stopped(self, torrents):
+        coros = [t.tracker.announce_stopped() for t in torrents if t.tracker]
+        if coros and not self.conn_man.loop.is_running():
+            self.conn_man.loop.run_until_complete(asyncio.gather(*coros))
+
+    def start_torrent(self, torrent):
+        torrent.start_torrent()
+
+    def torrent_on_rechecked(self, torrent):
+        print('%s: rechecked at %.1f MB/s, %s' % (torrent, torrent.recheck_rate / 2**20, torrent.progress_bar()))
+
+    def stats(self):
+        return {
+            'loop': {
+                'lag': self.loop_monitor.lag.snapshot(),
+                'max_lag': self.loop_monitor.max_lag,
+                'callback_time': self.conn_man.callback_time.snapshot(),
+            },
+            'torrents': [t.stats() for t in self.active_torrent + self.finished_torrent],
+            'queued': [t.metainfo.name for t in self.queued_torrent],
+            'paused': [t.metainfo.name for t in self.paused_torrent],
+            'dht': self.dht.stats() if self.dht else None,
+            'stream': self.stream_server.stats() if self.stream_server.server else None,
+            'cache': self.cache.stats(),
+        }
 
     def piece_on_complete(self, torrent):
         print('%s: %s' % (torrent, torrent.progress_bar()))
 
-    def torrent_on_completed(self, torrent, data):
+    def torrent_on_completed(self, torrent):
         print('Torrent completed!')
-        if torrent.metainfo.info['format'] == 'SINGLE_FILE':
-            self.single_file_save(torrent, data)
-        else:
-            self.multiple_file_save(torrent, data)
-
+        stats = torrent.stats()
+        if stats['tail_piece_latency'] is not None:
+            print('%s: last 1%% of pieces took %.3fs on average, %.3fs max (endgame %s)' % (
+                torrent, stats['tail_piece_latency'], stats['tail_piece_latency_max'],
+                'used' if stats['endgame'] else 'not used'))
         self.active_torrent.remove(torrent)
         self.finished_torrent.append(torrent)
+        self.scheduler.handle_torrent_completed(torrent)
 
-        if not self.active_torrent:
+        # A daemon keeps running for the torrents added later.
+        if not self.active_torrent and not self.queued_torrent and not SETTINGS['seed'] and not self.control_server:
             self.on_all_torrent_completed()
 
     def on_all_torrent_completed(self):
         self.conn_man.stop_event_loop()
-
-    def single_file_save(self, torrent, data):
-        (_, filename) = os.path.split(torrent.metainfo.name)
-        filepath = (os.path.join(os.path.expanduser(self.output_destination), filename) if self.output_destination else filename)
-        with open(filepath, 'wb') as f:
-            f.write(data)
-
-    def multiple_file_save(self, torrent, data):
-        begin = 0
-        base_dir = torrent.metainfo.name
-        base_dir = (os.path.join(os.path.expanduser(self.output_destination), base_dir) if self.output_destination else base_dir)
-        for file_dict in torrent.metainfo.info['files']:
-            filepath = os.path.join(base_dir, file_dict['path'])
-            os.makedirs(os.path.dirname(filepath), exist_ok=True)
-            file_data = data[begin: begin+file_dict['length']]
-            with open(filepath, 'wb') as f:
-                f.write(file_data)
-            begin += file_dict['length']
-        if begin != len(data):
-            log.warn('begin != len(data)')
+        self.verifier.shutdown()
@@ -0,0 +1,162 @@
+import socket
+import struct
+
+CHOKE = 0
+UNCHOKE = 1
+INTERESTED = 2
+NOT_INTERESTED = 3
+HAVE = 4
+BITFIELD = 5
+REQUEST = 6
+PIECE = 7
+CANCEL = 8
+PORT = 9
+# BEP 6 Fast Extension
+SUGGEST_PIECE = 13
+HAVE_ALL = 14
+HAVE_NONE = 15
+REJECT_REQUEST = 16
+ALLOWED_FAST = 17
+# BEP 10 Extension Protocol
+EXTENDED = 20
+EXTENDED_HANDSHAKE = 0
+# Ids we assign, in our extended handshake, to the extensions we support.
+UT_PEX_ID = 1
+
+MESSAGE_TYPES = {
+    CHOKE: 'choke',
+    UNCHOKE: 'unchoke',
+    INTERESTED: 'interested',
+    NOT_INTERESTED: 'not_interested',
+    HAVE: 'have',
+    BITFIELD: 'bitfield',
+    REQUEST: 'request',
+    PIECE: 'piece',
+    CANCEL: 'cancel',
+    PORT: 'port',
+    SUGGEST_PIECE: 'suggest_piece',
+    HAVE_ALL: 'have_all',
+    HAVE_NONE: 'have_none',
+    REJECT_REQUEST: 'reject_request',
+    ALLOWED_FAST: 'allowed_fast',
+    EXTENDED: 'extended',
+}
+
+# (byte, mask) of the extension flags in the handshake reserved bytes.
+FAST_EXTENSION_BIT = (7, 0x04)
+DHT_BIT = (7, 0x01)
+EXTENSION_PROTOCOL_BIT = (5, 0x10)
+
+PSTR = b'BitTorrent protocol'
+HANDSHAKE = struct.Struct('!B19s8s20s20s')
+HANDSHAKE_TAIL = struct.Struct('!8s20s20s')
+
+LENGTH_PREFIX = struct.Struct('!L')
+HAVE_PAYLOAD = struct.Struct('!L')
+PIECE_HEADER = struct.Struct('!LL')
+REQUEST_PAYLOAD = struct.Struct('!LLL')
+PORT_PAYLOAD = struct.Struct('!H')
+COMPACT_PEER = struct.Struct('!4sH')
+
+# Whole messages, length prefix and id included.
+MESSAGE_HEADER = struct.Struct('!LB')
+HAVE_MESSAGE = struct.Struct('!LBL')
+REQUEST_MESSAGE = struct.Struct('!LBLLL')
+PIECE_MESSAGE_HEADER = struct.Struct('!LBLL')
+PORT_MESSAGE = struct.Struct('!LBH')
+
+KEEPALIVE_MESSAGE = LENGTH_PREFIX.pack(0)
+CHOKE_MESSAGE = MESSAGE_HEADER.pack(1, CHOKE)
+UNCHOKE_MESSAGE = MESSAGE_HEADER.pack(1, UNCHOKE)
+INTERESTED_MESSAGE = MESSAGE_HEADER.pack(1, INTERESTED)
+NOT_INTERESTED_MESSAGE = MESSAGE_HEADER.pack(1, NOT_INTERESTED)
+HAVE_ALL_MESSAGE = MESSAGE_HEADER.pack(1, HAVE_ALL)
+HAVE_NONE_MESSAGE = MESSAGE_HEADER.pack(1, HAVE_NONE)
+
+DEBUG_PAYLOAD_BYTES = 40
+
+
+def encode_reserved(bits):
+    reserved = bytearray(8)
+    for (byte, mask) in bits:
+        reserved[byte] |= mask
+    return bytes(reserved)
+
+
+def has_reserved_bit(reserved, bit):
+    (byte, mask) = bit
+    return bool(reserved[byte] & mask)
+
+
+def encode_handshake(info_hash, peer_id, reserved=bytes(8)):
+    return HANDSHAKE.pack(len(PSTR), PSTR, reserved, info_hash, peer_id)
+
+
+def decode_handshake(data):
+    # Returns (pstr, reserved, info_hash, peer_id) from a complete handshake.
+    pstrlen = data[0]
+    return (bytes(data[1:1+pstrlen]),) + HANDSHAKE_TAIL.unpack_from(data, 1 + pstrlen)
+
+
+def encode_have(index):
+    return HAVE_MESSAGE.pack(5, HAVE, index)
+
+
+def encode_bitfield(bitfield):
+    return MESSAGE_HEADER.pack(1 + len(bitfield), BITFIELD) + bitfield
+
+
+def encode_request(index, begin, length):
+    return REQUEST_MESSAGE.pack(13, REQUEST, index, begin, length)
+
+
+def encode_cancel(index, begin, length):
+    return REQUEST_MESSAGE.pack(13, CANCEL, index, begin, length)
+
+
+def encode_piece_header(index, begin, length):
+    return PIECE_MESSAGE_HEADER.pack(9 + length, PIECE, index, begin)
+
+
+def encode_port(port):
+    return PORT_MESSAGE.pack(3, PORT, port)
+
+
+def encode_suggest_piece(index):
+    return HAVE_MESSAGE.pack(5, SUGGEST_PIECE, index)
+
+
+def encode_reject_request(index, begin, length):
+    return REQUEST_MESSAGE.pack(13, REJECT_REQUEST, index, begin, length)
+
+
+def encode_allowed_fast(index):
+    return HAVE_MESSAGE.pack(5, ALLOWED_FAST, index)
+
+
+def encode_extended(ext_id, payload):
+    return MESSAGE_HEADER.pack(2 + len(payload), EXTENDED) + bytes((ext_id,)) + payload
+
+
+def encode_compact_peer(ip, port):
+    return COMPACT_PEER.pack(socket.inet_aton(ip), port)
+
+
+def decode_compact_peers(data):
+    # Trailing bytes that do not make up a whole entry are ignored.
+    return [(socket.inet_ntoa(ip), port)
+            for (ip, port) in COMPACT_PEER.iter_unpack(data[:len(data) - len(data) % COMPACT_PEER.size])]
+
+
+def describe_message(msg_id, payload):
+    # Only called with debug logging on; formats like the old receive log.
+    hexdump = ''.join('%02X' % v for v in payload[:DEBUG_PAYLOAD_BYTES])
+    return 'id=%s type=%s payload=%s%s' % (
+        msg_id, MESSAGE_TYPES.get(msg_id, 'unknown'), hexdump,
+        '...' if len(payload) > DEBUG_PAYLOAD_BYTES else '')
+
+
+def describe_encoded(msg):
+    if len(msg) < 5:
+        return 'keep-alive'
+    return describe_message(msg[4], memoryview(msg)[5:])
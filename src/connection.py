@@ -1,11 +1,127 @@
+import asyncio
 import logging
 import socket
 import queue
 import time
 import threading
 
+from settings import SETTINGS
+from stats import Histogram, LOOP_BUCKETS
+
 log = logging.getLogger(__name__)
 
+
+class ConnectionManagerAsyncio():
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.conns = set()
+        self.loop_active = False
+        self.server = None
+        self.accept_handler = None
+        self.callback_time = Histogram(LOOP_BUCKETS)
+
+    def connect_peer(self, peer):
+        conn = PeerConnectionAsyncio(self, peer)
+        self.conns.add(conn)
+        conn.connect()
+        return conn
+
+    def start_event_loop(self):
+        self.loop_active = True
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop_active = False
+
+    def start_listening(self, port, accept_handler):
+        self.accept_handler = accept_handler
+        self.loop.create_task(self.open_server(port))
+
+    async def open_server(self, port):
+        try:
+            self.server = await self.loop.create_server(
+                lambda: IncomingConnectionAsyncio(self), port=port)
+        except OSError as e:
+            log.warning('Cannot listen on port %d: %s' % (port, e))
+
+    def stop_event_loop(self):
+        for conn in list(self.conns):
+            conn.disconnect()
+        if self.server:
+            self.server.close()
+        self.loop.stop()
+
+class PeerConnectionAsyncio(asyncio.BufferedProtocol):
+    def __init__(self, conn_man, peer):
+        self.conn_man = conn_man
+        self.peer = peer
+        self.is_stopped = False
+        self.transport = None
+        self.connect_task = None
+
+    def connect(self):
+        self.connect_task = self.conn_man.loop.create_task(self.open_connection())
+
+    async def open_connection(self):
+        loop = self.conn_man.loop
+        try:
+            await asyncio.wait_for(
+                loop.create_connection(lambda: self, self.peer.ip, self.peer.port),
+                SETTINGS['connect_timeout'])
+        except (OSError, asyncio.TimeoutError):
+            self.conn_man.conns.discard(self)
+            if not self.is_stopped:
+                self.peer.handle_connection_failed()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.is_stopped:
+            transport.close()
+            return
+        self.peer.handle_connection_made(self)
+
+    def get_buffer(self, sizehint):
+        return self.peer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        start = time.perf_counter()
+        self.peer.buffer_updated(nbytes)
+        self.conn_man.callback_time.observe(time.perf_counter() - start)
+
+    def pause_writing(self):
+        self.peer.handle_write_paused()
+
+    def resume_writing(self):
+        self.peer.handle_write_resumed()
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.conn_man.conns.discard(self)
+        if not self.is_stopped:
+            self.is_stopped = True
+            self.peer.handle_connection_lost()
+
+    def write(self, data):
+        if self.transport:
+            self.transport.write(data)
+
+    def pause_reading(self):
+        if self.transport:
+            self.transport.pause_reading()
+
+    def resume_reading(self):
+        if self.transport:
+            self.transport.resume_reading()
+
+    def disconnect(self):
+        self.is_stopped = True
+        if self.transport:
+            self.transport.close()
+        elif self.connect_task:
+            self.connect_task.cancel()
+        self.conn_man.conns.discard(self)
+
 class ConnectionManagerThreaded():
     def __init__(self):
         self.conns = []
@@ -14,6 +130,7 @@ class ConnectionManagerThreaded():
     def connect_peer(self, peer):
         conn = PeerConnectionThreaded(peer)
         self.conns.append(conn)
+        return conn
 
     def start_event_loop(self):
         self.loop_active = True
@@ -29,6 +146,57 @@ class ConnectionManagerThreaded():
         for conn in self.conns:
             conn.disconnect()
 
+class IncomingConnectionAsyncio(PeerConnectionAsyncio):
+    MAX_HANDSHAKE_LENGTH = 1 + 255 + 48
+
+    def __init__(self, conn_man):
+        PeerConnectionAsyncio.__init__(self, conn_man, None)
+        self.handshake_buffer = bytearray(self.MAX_HANDSHAKE_LENGTH)
+        self.handshake_length = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        if self.peer:
+            return self.peer.get_buffer(sizehint)
+        return memoryview(self.handshake_buffer)[self.handshake_length:]
+
+    def buffer_updated(self, nbytes):
+        if self.peer:
+            self.peer.buffer_updated(nbytes)
+            return
+        self.handshake_length += nbytes
+        needed = 1 + self.handshake_buffer[0] + 48
+        if self.handshake_length < needed:
+            return
+        info_hash = bytes(self.handshake_buffer[needed-40:needed-20])
+        (ip, port) = self.transport.get_extra_info('peername')[:2]
+        peer = self.conn_man.accept_handler(self, info_hash, ip, port)
+        if peer is None:
+            log.info('Rejected incoming connection from %s:%d' % (ip, port))
+            self.is_stopped = True
+            self.transport.close()
+            return
+        self.peer = peer
+        self.conn_man.conns.add(self)
+        peer.handle_connection_made(self)
+        peer.handle_data_received(self.handshake_buffer[:self.handshake_length])
+        self.handshake_buffer = None
+
+    def connection_lost(self, exc):
+        if self.peer:
+            PeerConnectionAsyncio.connection_lost(self, exc)
+        self.transport = None
+
+    def pause_writing(self):
+        if self.peer:
+            self.peer.handle_write_paused()
+
+    def resume_writing(self):
+        if self.peer:
+            self.peer.handle_write_resumed()
+
 class PeerConnectionThreaded():
     def __init__(self, peer):
         self.peer = peer
@@ -165,4 +333,4 @@ class PeerConnectionThreadedThread(threading.Thread):
         self.connection_lost.set()
         self.disconnect_event.set()
 
-ConnectionManager = ConnectionManagerThreaded
\ No newline at end of file
+ConnectionManager = ConnectionManagerAsyncio
\ No newline at end of file
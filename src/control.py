@@ -0,0 +1,289 @@
+import os
+import json
+import math
+import signal
+import socket
+import inspect
+import logging
+
+from settings import SETTINGS
+from picker import PRIORITIES
+from torrent import match_file_priorities, FilePriorityError
+from storage import StorageError
+from metainfo import Metainfo, TorrentDecodeError
+
+log = logging.getLogger(__name__)
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+
+DEFAULT_SOCKET = '~/.torrentclient.sock'
+
+
+class ControlServer():
+    # JSON-RPC 2.0 over a Unix socket, one request or response per line, to
+    # manage the torrents of a running client.
+    def __init__(self, client):
+        self.client = client
+        self.loop = client.conn_man.loop
+        self.server = None
+        self.path = None
+        self.methods = {
+            'add': self.add,
+            'remove': self.remove,
+            'pause': self.pause,
+            'resume': self.resume,
+            'list': self.list_torrents,
+            'priorities': self.priorities,
+            'limits': self.limits,
+            'stats': self.client.stats,
+            'shutdown': self.shutdown,
+        }
+
+    def start(self, path):
+        # Before the event loop runs, so that a daemon that cannot listen
+        # fails at start.
+        path = os.path.expanduser(path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(path)
+            except OSError:
+                pass
+            else:
+                raise ControlError('A daemon is already listening on %s' % path)
+        try:
+            self.server = self.loop.run_until_complete(self.loop.create_unix_server(
+                lambda: ControlProtocol(self), path))
+        except OSError as e:
+            raise ControlError('Cannot listen on %s: %s' % (path, e))
+        os.chmod(path, 0o600)
+        self.path = path
+        self.loop.add_signal_handler(signal.SIGTERM, self.client.on_all_torrent_completed)
+        log.info('Control socket at %s' % path)
+
+    def stop(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+            self.loop.remove_signal_handler(signal.SIGTERM)
+            os.remove(self.path)
+
+    def handle_request(self, request):
+        # Returns the response, or None for a notification.
+        if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+            return error_response(None, INVALID_REQUEST, 'Invalid request')
+        request_id = request.get('id')
+        method = self.methods.get(request['method'])
+        params = request.get('params', {})
+        if method is None:
+            response = error_response(request_id, METHOD_NOT_FOUND, 'No method %s' % request['method'])
+        elif not isinstance(params, (list, dict)):
+            response = error_response(request_id, INVALID_PARAMS, 'params must be an array or an object')
+        else:
+            response = self.call_method(request_id, method, params)
+        return response if 'id' in request else None
+
+    @staticmethod
+    def call_method(request_id, method, params):
+        try:
+            signature = inspect.signature(method)
+            args = signature.bind(*params) if isinstance(params, list) else signature.bind(**params)
+        except TypeError as e:
+            return error_response(request_id, INVALID_PARAMS, str(e))
+        try:
+            return {'jsonrpc': '2.0', 'id': request_id, 'result': method(*args.args, **args.kwargs)}
+        except ControlParamsError as e:
+            return error_response(request_id, INVALID_PARAMS, str(e))
+        except (ControlError, FilePriorityError, StorageError, TorrentDecodeError, OSError) as e:
+            return error_response(request_id, SERVER_ERROR, str(e))
+        except Exception as e:
+            # A bug must not take the connection down with it.
+            log.error('Control method %s failed: %r' % (method.__name__, e))
+            return error_response(request_id, SERVER_ERROR, 'Internal error: %r' % e)
+
+    def all_torrents(self):
+        torrents = []
+        for (state, state_torrents) in (('queued', self.client.queued_torrent),
+                                        ('downloading', self.client.active_torrent),
+                                        ('finished', self.client.finished_torrent),
+                                        ('paused', self.client.paused_torrent)):
+            torrents.extend((t, state) for t in state_torrents)
+        return torrents
+
+    def find_torrent(self, torrent):
+        # By info hash, a unique prefix of it, or name.
+        check_str('torrent', torrent)
+        matches = [t for (t, _) in self.all_torrents()
+                   if t.metainfo.info_hash.hex().startswith(torrent.lower()) or t.metainfo.name == torrent]
+        if len(matches) != 1:
+            raise ControlError('%s matches %d torrents' % (torrent, len(matches)))
+        return matches[0]
+
+    def describe(self, torrent, state):
+        names = dict((v, k) for (k, v) in PRIORITIES.items())
+        return {
+            'info_hash': torrent.metainfo.info_hash.hex(),
+            'name': torrent.metainfo.name,
+            'state': state,
+            'pieces_complete': torrent.picker.num_complete,
+            'pieces_wanted': torrent.picker.num_wanted,
+            'pieces_total': len(torrent.complete_pieces),
+            'left': torrent.bytes_left(),
+            'download_rate': torrent.download_rate.rate(),
+            'num_peers': torrent.num_connected(),
+            'file_priorities': [names[p] for p in torrent.file_priorities],
+        }
+
+    def add(self, path, file_rules=()):
+        check_str('path', path)
+        check_file_rules(file_rules)
+        with open(path, 'rb') as f:
+            metainfo = Metainfo(f.read())
+        for (t, _) in self.all_torrents():
+            if t.metainfo.info_hash == metainfo.info_hash:
+                raise ControlError('%s is already added' % metainfo.name)
+        torrent = self.client.add_metainfo(metainfo, match_file_priorities(metainfo, file_rules))
+        self.client.scheduler.start_queued()
+        return self.describe(torrent, self.state(torrent))
+
+    def remove(self, torrent):
+        torrent = self.find_torrent(torrent)
+        self.client.remove_torrent(torrent)
+        return torrent.metainfo.info_hash.hex()
+
+    def pause(self, torrent):
+        torrent = self.find_torrent(torrent)
+        self.client.pause_torrent(torrent)
+        return self.describe(torrent, 'paused')
+
+    def resume(self, torrent):
+        torrent = self.find_torrent(torrent)
+        if torrent not in self.client.paused_torrent:
+            raise ControlError('%s is not paused' % torrent.metainfo.name)
+        torrent = self.client.resume_torrent(torrent)
+        return self.describe(torrent, self.state(torrent))
+
+    def list_torrents(self):
+        return [self.describe(t, state) for (t, state) in self.all_torrents()]
+
+    def priorities(self, torrent, file_rules):
+        check_file_rules(file_rules)
+        torrent = self.find_torrent(torrent)
+        if torrent in self.client.paused_torrent or torrent in self.client.queued_torrent:
+            raise ControlError('%s is not running' % torrent.metainfo.name)
+        priorities = match_file_priorities(torrent.metainfo, file_rules, torrent.file_priorities)
+        self.client.set_file_priorities(torrent, priorities)
+        return self.describe(torrent, self.state(torrent))
+
+    def limits(self, download_rate=None, upload_rate=None, max_connections=None, max_active=None):
+        # Rates in bytes per second, 0 for none; unset ones are kept.
+        check_limit('download_rate', download_rate, (int, float))
+        check_limit('upload_rate', upload_rate, (int, float))
+        check_limit('max_connections', max_connections, int)
+        check_limit('max_active', max_active, int)
+        scheduler = self.client.scheduler
+        scheduler.set_rate_limits(download_rate, upload_rate)
+        if max_connections is not None:
+            SETTINGS['max_connections'] = max_connections
+        if max_active is not None:
+            SETTINGS['max_active_torrents'] = max_active
+        scheduler.start_queued()
+        return {
+            'download_rate': scheduler.download_bucket.rate,
+            'upload_rate': scheduler.upload_bucket.rate,
+            'max_connections': SETTINGS['max_connections'],
+            'max_active': SETTINGS['max_active_torrents'],
+        }
+
+    def shutdown(self):
+        # After the response is written.
+        self.loop.call_soon(self.client.on_all_torrent_completed)
+        return True
+
+    def state(self, torrent):
+        for (t, state) in self.all_torrents():
+            if t is torrent:
+                return state
+        return None
+
+
+class ControlProtocol():
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.buffer = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        while b'\n' in self.buffer:
+            (line, self.buffer) = self.buffer.split(b'\n', 1)
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = error_response(None, PARSE_ERROR, str(e))
+            else:
+                response = self.server.handle_request(request)
+            if response is not None and self.transport:
+                self.transport.write(json.dumps(response).encode('utf-8') + b'\n')
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+
+def check_str(name, value):
+    if not isinstance(value, str):
+        raise ControlParamsError('%s must be a string' % name)
+
+
+def check_file_rules(file_rules):
+    if not isinstance(file_rules, (list, tuple)):
+        raise ControlParamsError('file_rules must be an array of [pattern, priority] pairs')
+    for rule in file_rules:
+        if (not isinstance(rule, (list, tuple)) or len(rule) != 2 or not all(isinstance(v, str) for v in rule)
+                or rule[1] not in PRIORITIES):
+            raise ControlParamsError('Bad file rule %r: must be [pattern, one of %s]' % (rule, ', '.join(PRIORITIES)))
+
+
+def check_limit(name, value, types):
+    # bool is an int, but never a limit.
+    if value is not None and (isinstance(value, bool) or not isinstance(value, types) or not 0 <= value < math.inf):
+        raise ControlParamsError('%s must be a non-negative %s' % (name, 'integer' if types is int else 'number'))
+
+
+def error_response(request_id, code, message):
+    return {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': code, 'message': message}}
+
+
+def call(path, method, params=None, timeout=30.0):
+    # One request from a client of the daemon; returns the result.
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(os.path.expanduser(path))
+        request = {'jsonrpc': '2.0', 'id': 1, 'method': method, 'params': params or {}}
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(65536)
+            if not chunk:
+                raise ControlError('The daemon closed the connection')
+            data += chunk
+    response = json.loads(data)
+    if 'error' in response:
+        raise ControlError(response['error']['message'])
+    return response['result']
+
+class ControlError(Exception):
+    pass
+class ControlParamsError(ControlError):
+    pass
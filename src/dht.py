@@ -0,0 +1,449 @@
+import os
+import time
+import random
+import socket
+import struct
+import asyncio
+import hashlib
+import logging
+import itertools
+import bencodepy
+
+import codec
+from settings import SETTINGS
+
+log = logging.getLogger(__name__)
+
+K = 8
+ALPHA = 3
+ID_LENGTH = 20
+COMPACT_NODE = struct.Struct('!20s4sH')
+TRANSACTION_ID = struct.Struct('!H')
+# A node that has not been heard from for 15 minutes is questionable
+# and may be replaced by a new one (BEP 5).
+NODE_STALE_TIME = 15 * 60.0
+MAX_NODE_FAILURES = 3
+TOKEN_ROTATE_INTERVAL = 5 * 60.0
+PEER_TTL = 30 * 60.0
+MAX_STORED_PEERS = 200
+MAX_VALUES = 50
+
+ERROR_PROTOCOL = 203
+ERROR_METHOD_UNKNOWN = 204
+
+
+def distance(a, b):
+    return int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')
+
+
+def encode_compact_nodes(nodes):
+    return b''.join(COMPACT_NODE.pack(n.node_id, socket.inet_aton(n.addr[0]), n.addr[1]) for n in nodes)
+
+
+def is_valid_lookup_reply(r):
+    nodes = r.get(b'nodes', b'')
+    values = r.get(b'values', [])
+    token = r.get(b'token')
+    return (isinstance(nodes, bytes) and isinstance(values, list) and all(isinstance(v, bytes) for v in values)
+            and (token is None or isinstance(token, bytes)))
+
+
+def decode_compact_nodes(data):
+    data = data[:len(data) - len(data) % COMPACT_NODE.size]
+    return [(node_id, (socket.inet_ntoa(ip), port))
+            for (node_id, ip, port) in COMPACT_NODE.iter_unpack(data) if port]
+
+
+class Node():
+    def __init__(self, node_id, addr):
+        self.node_id = node_id
+        self.addr = addr
+        self.last_seen = time.monotonic()
+        self.failures = 0
+
+    def __repr__(self):
+        return 'Node(%s, %s:%d)' % (self.node_id.hex()[:8], self.addr[0], self.addr[1])
+
+
+class RoutingTable():
+    def __init__(self, own_id):
+        self.own_id = own_id
+        # buckets[n] holds up to K nodes whose distance from us has bit
+        # length n, so each bucket covers twice the id space of the last.
+        self.buckets = [[] for _ in range(8 * ID_LENGTH + 1)]
+        self.nodes = {}
+        self.addrs = {}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def bucket(self, node_id):
+        return self.buckets[distance(self.own_id, node_id).bit_length()]
+
+    def update(self, node_id, addr):
+        if node_id == self.own_id or len(node_id) != ID_LENGTH:
+            return
+        node = self.nodes.get(node_id)
+        if node is not None:
+            if node.addr != addr:
+                self.addrs.pop(node.addr, None)
+                self.addrs[addr] = node_id
+                node.addr = addr
+            node.last_seen = time.monotonic()
+            node.failures = 0
+            return
+        bucket = self.bucket(node_id)
+        if len(bucket) >= K:
+            # Good nodes are never evicted; a new node only takes the slot
+            # of one that stopped answering or went quiet.
+            worst = max(bucket, key=lambda n: (n.failures, -n.last_seen))
+            if not worst.failures and time.monotonic() - worst.last_seen < NODE_STALE_TIME:
+                return
+            self.remove(worst)
+        node = Node(node_id, addr)
+        bucket.append(node)
+        self.nodes[node_id] = node
+        self.addrs[addr] = node_id
+
+    def remove(self, node):
+        self.bucket(node.node_id).remove(node)
+        del self.nodes[node.node_id]
+        self.addrs.pop(node.addr, None)
+
+    def failed(self, addr):
+        node = self.nodes.get(self.addrs.get(addr))
+        if node is None:
+            return
+        node.failures += 1
+        if node.failures >= MAX_NODE_FAILURES:
+            self.remove(node)
+
+    def closest(self, target, count=K):
+        return sorted(self.nodes.values(), key=lambda n: distance(n.node_id, target))[:count]
+
+
+class DHT():
+    def __init__(self, loop, port=0, node_id=None, bootstrap=None):
+        self.loop = loop
+        self.port = port
+        self.node_id = node_id or os.urandom(ID_LENGTH)
+        self.bootstrap_nodes = SETTINGS['dht_bootstrap'] if bootstrap is None else bootstrap
+        self.table = RoutingTable(self.node_id)
+        self.transport = None
+        self.open_task = None
+        self.transaction_ids = itertools.count(random.randrange(2**16))
+        self.waiters = {}
+        self.peers = {}
+        self.secrets = [os.urandom(16), os.urandom(16)]
+        self.secret_time = time.monotonic()
+        self.torrent_tasks = {}
+        self.maintenance_task = None
+        self.bootstrap_task = None
+        self.queries_received = 0
+        self.queries_sent = 0
+
+    def __repr__(self):
+        return 'DHT(%s, port=%s)' % (self.node_id.hex()[:8], self.port)
+
+    def start(self, host='0.0.0.0'):
+        self.open_task = self.loop.create_task(self.open(host))
+        self.maintenance_task = self.loop.create_task(self.run_maintenance())
+
+    async def open(self, host):
+        try:
+            (self.transport, _) = await self.loop.create_datagram_endpoint(
+                lambda: DHTProtocol(self), local_addr=(host, self.port))
+        except OSError as e:
+            log.warning('Cannot open DHT port %d: %s' % (self.port, e))
+            return False
+        self.port = self.transport.get_extra_info('sockname')[1]
+        log.info('%s: listening' % self)
+        return True
+
+    def stop(self):
+        for task in [self.open_task, self.maintenance_task, self.bootstrap_task] + list(self.torrent_tasks.values()):
+            if task:
+                task.cancel()
+        self.torrent_tasks = {}
+        for waiter in self.waiters.values():
+            if not waiter.done():
+                waiter.cancel()
+        if self.transport:
+            self.transport.close()
+            self.transport = None
+
+    async def wait_open(self):
+        return (await asyncio.shield(self.open_task)) and self.transport is not None
+
+    def add_torrent(self, torrent):
+        if torrent not in self.torrent_tasks:
+            self.torrent_tasks[torrent] = self.loop.create_task(self.run_torrent(torrent))
+
+    def remove_torrent(self, torrent):
+        task = self.torrent_tasks.pop(torrent, None)
+        if task:
+            task.cancel()
+
+    def add_contact(self, addr):
+        # A node learned outside the DHT, e.g. from a peer's port message;
+        # it joins the table once it answers.
+        if self.transport and addr not in self.table.addrs:
+            self.loop.create_task(self.ping(addr))
+
+    async def run_maintenance(self):
+        if not await self.wait_open():
+            return
+        while True:
+            try:
+                if len(self.table) < K:
+                    await self.bootstrap()
+            except Exception as e:
+                log.warning('%s: bootstrap failed: %r' % (self, e))
+            await asyncio.sleep(SETTINGS['dht_retry_interval'])
+
+    async def run_torrent(self, torrent):
+        if not await self.wait_open():
+            return
+        info_hash = torrent.metainfo.info_hash
+        while True:
+            # One bad lookup must not end the search for this torrent.
+            try:
+                if not self.table:
+                    await self.bootstrap()
+                peers = await self.get_peers(info_hash, announce_port=SETTINGS['listen_port'])
+            except Exception as e:
+                log.warning('%s: lookup for %s failed: %r' % (self, torrent, e))
+                await asyncio.sleep(SETTINGS['dht_retry_interval'])
+                continue
+            log.info('%s: %d peers for %s' % (self, len(peers), torrent))
+            for (ip, port) in peers:
+                torrent.add_peer({'ip': ip, 'port': port})
+            if peers and not torrent.is_complete:
+                torrent.fill_peers()
+            await asyncio.sleep(SETTINGS['dht_announce_interval'] if peers else SETTINGS['dht_retry_interval'])
+
+    async def bootstrap(self):
+        # Torrents and the maintenance task share one bootstrap at a time.
+        if self.bootstrap_task is None or self.bootstrap_task.done():
+            self.bootstrap_task = self.loop.create_task(self.run_bootstrap())
+        await asyncio.shield(self.bootstrap_task)
+
+    async def run_bootstrap(self):
+        addrs = []
+        for (host, port) in self.bootstrap_nodes:
+            try:
+                infos = await self.loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            except OSError as e:
+                log.info('%s: cannot resolve %s: %s' % (self, host, e))
+                continue
+            addrs.extend(info[4][:2] for info in infos[:1])
+        await asyncio.gather(*(self.find_node(addr, self.node_id) for addr in addrs), return_exceptions=True)
+        await self.lookup(self.node_id)
+        log.info('%s: bootstrapped with %d nodes' % (self, len(self.table)))
+
+    async def ping(self, addr):
+        try:
+            return await self.query(addr, b'ping', {})
+        except (DHTError, asyncio.TimeoutError):
+            return None
+
+    async def find_node(self, addr, target):
+        return await self.query(addr, b'find_node', {b'target': target})
+
+    async def get_peers(self, info_hash, announce_port=None):
+        (closest, peers) = await self.lookup(info_hash, b'get_peers')
+        if announce_port:
+            await asyncio.gather(*(self.query(addr, b'announce_peer',
+                                              {b'info_hash': info_hash, b'port': announce_port, b'token': token})
+                                   for (_, addr, token) in closest if token),
+                                 return_exceptions=True)
+        return peers
+
+    async def lookup(self, target, method=b'find_node'):
+        # Iterative Kademlia lookup: query the ALPHA closest unqueried nodes
+        # until the K closest that answered are closer than any left to ask.
+        args = {b'info_hash' if method == b'get_peers' else b'target': target}
+        candidates = {n.node_id: n.addr for n in self.table.closest(target)}
+        queried = set()
+        responded = {}
+        peers = set()
+        while True:
+            pending = sorted((i for i in candidates if i not in queried), key=lambda i: distance(i, target))[:ALPHA]
+            best = sorted(responded, key=lambda i: distance(i, target))[:K]
+            if not pending or (len(best) >= K and distance(pending[0], target) > distance(best[-1], target)):
+                break
+            queried.update(pending)
+            results = await asyncio.gather(*(self.query(candidates[i], method, args) for i in pending),
+                                           return_exceptions=True)
+            for (node_id, r) in zip(pending, results):
+                if isinstance(r, BaseException):
+                    if isinstance(r, asyncio.CancelledError):
+                        raise r
+                    continue
+                if not is_valid_lookup_reply(r):
+                    log.debug('%s: malformed %s reply from %s' % (self, method.decode(), candidates[node_id]))
+                    continue
+                responded[node_id] = (candidates[node_id], r.get(b'token'))
+                for (new_id, addr) in decode_compact_nodes(r.get(b'nodes', b'')):
+                    if new_id != self.node_id and new_id not in candidates:
+                        candidates[new_id] = addr
+                for value in r.get(b'values', []):
+                    peers.update(codec.decode_compact_peers(value))
+        closest = sorted(responded.items(), key=lambda item: distance(item[0], target))[:K]
+        return ([(node_id, addr, token) for (node_id, (addr, token)) in closest], peers)
+
+    async def query(self, addr, method, args):
+        if not self.transport:
+            raise DHTError('DHT is not running')
+        tid = TRANSACTION_ID.pack(next(self.transaction_ids) % 2**16)
+        # bencodepy keeps insertion order, and bencoded keys must be sorted.
+        args = dict(args)
+        args[b'id'] = self.node_id
+        msg = {b'a': dict(sorted(args.items())), b'q': method, b't': tid, b'y': b'q'}
+        waiter = self.loop.create_future()
+        self.waiters[tid] = waiter
+        self.queries_sent += 1
+        try:
+            self.transport.sendto(bencodepy.encode(msg), addr)
+            resp = await asyncio.wait_for(waiter, SETTINGS['dht_query_timeout'])
+        except asyncio.TimeoutError:
+            self.table.failed(addr)
+            raise
+        finally:
+            self.waiters.pop(tid, None)
+        if resp.get(b'y') == b'e':
+            raise DHTError('%s error: %r' % (method.decode(), resp.get(b'e')))
+        r = resp.get(b'r')
+        if not isinstance(r, dict) or len(r.get(b'id', b'')) != ID_LENGTH:
+            raise DHTError('Malformed %s response' % method.decode())
+        self.table.update(r[b'id'], addr)
+        return r
+
+    def handle_datagram(self, data, addr):
+        try:
+            msg = bencodepy.decode(data)
+        except bencodepy.DecodingError:
+            return
+        if not isinstance(msg, dict) or b't' not in msg:
+            return
+        kind = msg.get(b'y')
+        if kind == b'q':
+            self.handle_query(msg, addr)
+        elif kind in (b'r', b'e'):
+            waiter = self.waiters.get(msg[b't'])
+            if waiter and not waiter.done():
+                waiter.set_result(msg)
+
+    def handle_query(self, msg, addr):
+        self.queries_received += 1
+        args = msg.get(b'a')
+        handler = self.query_handlers.get(msg.get(b'q'))
+        if not isinstance(args, dict) or len(args.get(b'id', b'')) != ID_LENGTH:
+            self.send_error(msg[b't'], addr, ERROR_PROTOCOL, 'Missing id')
+            return
+        if handler is None:
+            self.send_error(msg[b't'], addr, ERROR_METHOD_UNKNOWN, 'Method Unknown')
+            return
+        try:
+            r = handler(self, args, addr)
+        except DHTError as e:
+            self.send_error(msg[b't'], addr, ERROR_PROTOCOL, str(e))
+            return
+        except (KeyError, TypeError, ValueError, OSError, struct.error):
+            self.send_error(msg[b't'], addr, ERROR_PROTOCOL, 'Protocol Error')
+            return
+        self.table.update(args[b'id'], addr)
+        r[b'id'] = self.node_id
+        self.send(addr, {b'r': dict(sorted(r.items())), b't': msg[b't'], b'y': b'r'})
+
+    def send(self, addr, msg):
+        if self.transport:
+            self.transport.sendto(bencodepy.encode(msg), addr)
+
+    def send_error(self, tid, addr, code, message):
+        self.send(addr, {b'e': [code, message.encode()], b't': tid, b'y': b'e'})
+
+    def on_ping(self, args, addr):
+        return {}
+
+    def on_find_node(self, args, addr):
+        return {b'nodes': encode_compact_nodes(self.table.closest(args[b'target']))}
+
+    def on_get_peers(self, args, addr):
+        info_hash = args[b'info_hash']
+        r = {b'token': self.token(addr[0])}
+        peers = self.stored_peers(info_hash)
+        if peers:
+            r[b'values'] = [codec.encode_compact_peer(ip, port)
+                            for (ip, port) in random.sample(peers, min(len(peers), MAX_VALUES))]
+        else:
+            r[b'nodes'] = encode_compact_nodes(self.table.closest(info_hash))
+        return r
+
+    def on_announce_peer(self, args, addr):
+        if not self.valid_token(args[b'token'], addr[0]):
+            raise DHTError('Bad token')
+        port = addr[1] if args.get(b'implied_port') else args[b'port']
+        info_hash = args[b'info_hash']
+        # Stored values are sent back to every get_peers for the hash.
+        if isinstance(port, bool) or not isinstance(port, int) or not 0 < port < 2**16:
+            raise DHTError('Bad port')
+        if not isinstance(info_hash, bytes) or len(info_hash) != ID_LENGTH:
+            raise DHTError('Bad info_hash')
+        peers = self.peers.setdefault(info_hash, {})
+        if len(peers) < MAX_STORED_PEERS or (addr[0], port) in peers:
+            peers[(addr[0], port)] = time.monotonic() + PEER_TTL
+        return {}
+
+    query_handlers = {
+        b'ping': on_ping,
+        b'find_node': on_find_node,
+        b'get_peers': on_get_peers,
+        b'announce_peer': on_announce_peer,
+    }
+
+    def stored_peers(self, info_hash):
+        peers = self.peers.get(info_hash)
+        if not peers:
+            return []
+        now = time.monotonic()
+        for key in [k for (k, expires) in peers.items() if expires < now]:
+            del peers[key]
+        return list(peers)
+
+    def token(self, ip, secret=None):
+        now = time.monotonic()
+        if now - self.secret_time > TOKEN_ROTATE_INTERVAL:
+            self.secrets = [os.urandom(16), self.secrets[0]]
+            self.secret_time = now
+        return hashlib.sha1((secret or self.secrets[0]) + ip.encode()).digest()[:8]
+
+    def valid_token(self, token, ip):
+        # Tokens handed out before the last rotation are still accepted.
+        return token in (self.token(ip), self.token(ip, self.secrets[1]))
+
+    def stats(self):
+        return {
+            'node_id': self.node_id.hex(),
+            'port': self.port,
+            'nodes': len(self.table),
+            'torrents': len(self.torrent_tasks),
+            'stored_peers': sum(len(p) for p in self.peers.values()),
+            'queries_sent': self.queries_sent,
+            'queries_received': self.queries_received,
+        }
+
+
+class DHTProtocol(asyncio.DatagramProtocol):
+    def __init__(self, dht):
+        self.dht = dht
+
+    def datagram_received(self, data, addr):
+        self.dht.handle_datagram(data, addr[:2])
+
+    def error_received(self, exc):
+        log.debug('%s: %s' % (self.dht, exc))
+
+
+class DHTError(Exception):
+    pass
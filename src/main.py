@@ -3,16 +3,123 @@ import argparse
 import logging
 
 from client import Client
+from control import ControlError, DEFAULT_SOCKET
+from settings import SETTINGS
+from metainfo import Metainfo
+from picker import PRIORITIES
+from storage import StorageError
+from supervisor import Supervisor
+from torrent import file_paths, match_file_priorities
+
+
+def parse_address(value):
+    (host, port) = value.rsplit(':', 1)
+    return (host, int(port))
+
+
+def parse_file_rule(value):
+    (pattern, priority) = value.rsplit('=', 1)
+    if priority not in PRIORITIES:
+        raise argparse.ArgumentTypeError('priority must be one of %s' % ', '.join(PRIORITIES))
+    return (pattern, priority)
+
+
+def list_files(filename, rules):
+    with open(filename, 'rb') as f:
+        metainfo = Metainfo(f.read())
+    names = dict((v, k) for (k, v) in PRIORITIES.items())
+    priorities = match_file_priorities(metainfo, rules)
+    print(metainfo.name)
+    for (file_index, path) in enumerate(file_paths(metainfo)):
+        print('%5d  %-6s %14d  %s' % (file_index, names[priorities[file_index]],
+                                      metainfo.files[file_index]['length'], path))
 
 
 def main(argv=None):
-    argv = sys.argv[1:]
     parser = argparse.ArgumentParser()
-    parser.add_argument('torrent', help='.torrent metainfo file')
+    parser.add_argument('torrents', nargs='*', help='.torrent metainfo files')
     parser.add_argument('--d', type=str, help='output directory')
+    parser.add_argument('--picker', choices=['rarest_first', 'random_first', 'sequential'],
+                        default=SETTINGS['piece_picker'], help='piece selection policy')
+    parser.add_argument('--seed', action='store_true', help='keep seeding after the download completes')
+    parser.add_argument('--port', type=int, default=SETTINGS['listen_port'], help='port to accept peers on')
+    parser.add_argument('--no-endgame', action='store_true', help='disable endgame mode')
+    parser.add_argument('--max-active', type=int, default=SETTINGS['max_active_torrents'],
+                        help='torrents downloading at once, the rest wait in a queue')
+    parser.add_argument('--max-connections', type=int, default=SETTINGS['max_connections'],
+                        help='peer connections across all torrents')
+    parser.add_argument('--download-limit', type=int, default=0, help='global download limit in KiB/s')
+    parser.add_argument('--upload-limit', type=int, default=0, help='global upload limit in KiB/s')
+    parser.add_argument('--cache-size', type=int, default=SETTINGS['cache_size'] // 2**20,
+                        help='MiB of memory for pieces waiting to be written and pieces read for uploads')
+    parser.add_argument('--allocation', choices=['sparse', 'full', 'none'], default=SETTINGS['allocation'],
+                        help='how output files are allocated when they are created')
+    parser.add_argument('--stats-port', type=int, default=0,
+                        help='serve /metrics (Prometheus) and /stats (JSON) on this local port')
+    parser.add_argument('--no-dht', action='store_true', help='do not look for peers in the DHT')
+    parser.add_argument('--dht-port', type=int, help='UDP port of the DHT node, the listen port by default')
+    parser.add_argument('--dht-node', type=parse_address, action='append', default=[],
+                        help='host:port to bootstrap the DHT from instead of the public routers')
+    parser.add_argument('--priority', type=parse_file_rule, action='append', default=[], metavar='FILE=PRIORITY',
+                        help='set the priority (%s) of the files matching FILE, an index or a glob; '
+                             'later rules win' % '/'.join(PRIORITIES))
+    parser.add_argument('--stream-port', type=int, default=0,
+                        help='serve the files over HTTP with Range support on this local port while they '
+                             'download; keeps seeding')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='run the torrents in this many processes; limits are shared between them')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and take commands from torrentctl.py on the control socket')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='control socket of the daemon')
+    parser.add_argument('--list-files', action='store_true', help='list the files with their priorities and exit')
     args = parser.parse_args(argv)
-    client = Client(output_destination=args.d)
-    client.add_torrent(args.torrent)
+    if not args.torrents and not args.daemon:
+        parser.error('the following arguments are required: torrents')
+    if args.workers > 1 and args.daemon:
+        parser.error('--daemon cannot be used with --workers')
+    if args.workers > 1 and args.stream_port:
+        parser.error('--stream-port cannot be used with --workers')
+    if args.list_files:
+        for torrent in args.torrents:
+            list_files(torrent, args.priority)
+        return
+    SETTINGS['max_active_torrents'] = args.max_active
+    SETTINGS['max_connections'] = args.max_connections
+    SETTINGS['download_rate_limit'] = args.download_limit * 1024
+    SETTINGS['upload_rate_limit'] = args.upload_limit * 1024
+    SETTINGS['endgame'] = not args.no_endgame
+    SETTINGS['piece_picker'] = args.picker
+    SETTINGS['seed'] = args.seed
+    SETTINGS['listen_port'] = args.port
+    SETTINGS['stats_port'] = args.stats_port
+    SETTINGS['cache_size'] = args.cache_size * 2**20
+    SETTINGS['allocation'] = args.allocation
+    SETTINGS['stream_port'] = args.stream_port
+    if args.stream_port:
+        # Files must stay open for the players still reading them.
+        SETTINGS['seed'] = True
+    SETTINGS['dht'] = not args.no_dht
+    SETTINGS['dht_port'] = args.dht_port
+    if args.dht_node:
+        SETTINGS['dht_bootstrap'] = args.dht_node
+    if args.workers > 1:
+        Supervisor(args.torrents, args.workers, args.d, args.priority).run()
+        return
+    if args.daemon:
+        SETTINGS['control_socket'] = args.socket
+    try:
+        client = Client(output_destination=args.d)
+    except ControlError as e:
+        sys.exit(str(e))
+    for torrent in args.torrents:
+        try:
+            client.add_torrent(torrent, args.priority)
+        except StorageError as e:
+            sys.exit('%s: %s' % (torrent, e))
+    if args.stream_port:
+        print('Streaming at http://%s:%d/ :' % (SETTINGS['stream_host'], args.stream_port))
+        for url in client.stream_server.file_urls():
+            print(url)
     client.start_torrents()
 
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
 import os
+import bisect
 import hashlib
 import bencodepy
 
@@ -8,17 +9,26 @@ class Metainfo():
             content = bencodepy.decode(bencontent)
         except bencodepy.DecodingError as e:
             raise TorrentDecodeError from e
-        self.announce = content[b'announce'].decode('utf-8')
+        self.announce = content[b'announce'].decode('utf-8') if b'announce' in content else None
+        self.announce_list = self.decode_announce_list(content)
         info_dict = content[b'info']
         self.info_hash = hashlib.sha1(bencodepy.encode(info_dict)).digest()
         self.info = self.decode_info_dict(info_dict)
 
+    def decode_announce_list(self, content):
+        tiers = []
+        for tier in content.get(b'announce-list', []):
+            urls = [url.decode('utf-8') for url in tier if url]
+            if urls:
+                tiers.append(urls)
+        if not tiers and self.announce:
+            tiers.append([self.announce])
+        return tiers
+
     def decode_info_dict(self, d):
         info = {}
         info['piece_length'] = d[b'piece length']
-        SHA_LEN = 20
-        pieces_shas = d[b'pieces']
-        info['pieces'] = [pieces_shas[i:i+SHA_LEN] for i in range(0, len(pieces_shas), SHA_LEN)]
+        info['pieces'] = PieceHashes(d[b'pieces'])
         self.name = d[b'name'].decode('utf-8')
         files = d.get(b'files')
         if not files:
@@ -32,8 +42,43 @@ class Metainfo():
                 path_segments = [v.decode('utf-8') for v in f[b'path']]
                 info['files'].append({'length': f[b'length'], 'path': os.path.join(*path_segments)})
             info['length'] = sum(f['length'] for f in info['files'])
+        self.build_file_index(info)
         return info
 
+    def build_file_index(self, info):
+        if info['format'] == 'SINGLE_FILE':
+            (_, filename) = os.path.split(self.name)
+            file_list = [{'path': filename, 'length': info['length']}]
+        else:
+            file_list = [{'path': os.path.join(self.name, f['path']), 'length': f['length']}
+                         for f in info['files']]
+        self.files = []
+        self.file_offsets = []
+        offset = 0
+        for f in file_list:
+            self.files.append({'path': f['path'], 'length': f['length'], 'offset': offset})
+            self.file_offsets.append(offset)
+            offset += f['length']
+
+    def segments(self, offset, length):
+        # bisect_right lands on the last file starting at or before offset,
+        # which skips any empty files that share its start.
+        file_index = bisect.bisect_right(self.file_offsets, offset) - 1
+        while length > 0 and file_index < len(self.files):
+            f = self.files[file_index]
+            file_offset = offset - f['offset']
+            seg_length = min(length, f['length'] - file_offset)
+            if seg_length > 0:
+                yield (file_index, file_offset, seg_length)
+                offset += seg_length
+                length -= seg_length
+            file_index += 1
+
+    def piece_segments(self, index, begin=0, length=None):
+        if length is None:
+            length = self.get_piece_length(index) - begin
+        return self.segments(index * self.info['piece_length'] + begin, length)
+
     def get_piece_length(self, index):
         num_pieces = len(self.info['pieces'])
         piece_length = self.info['piece_length']
@@ -41,5 +86,26 @@ class Metainfo():
             return (self.info['length'] - (num_pieces - 1) * piece_length)
         return piece_length
 
+class PieceHashes():
+    SHA_LEN = 20
+
+    def __init__(self, pieces_shas):
+        if len(pieces_shas) % self.SHA_LEN:
+            raise TorrentDecodeError('pieces length is not a multiple of %d' % self.SHA_LEN)
+        self.data = bytes(pieces_shas)
+        self.view = memoryview(self.data)
+
+    def __len__(self):
+        return len(self.data) // self.SHA_LEN
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError('piece index out of range')
+        return self.view[index * self.SHA_LEN:(index + 1) * self.SHA_LEN]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
 class TorrentDecodeError(Exception):
     pass
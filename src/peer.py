@@ -1,9 +1,16 @@
-import struct
+import time
+import hashlib
+import socket
 import bitarray
 import logging
-import random
+import bencodepy
+import collections
 
+import codec
+from codec import LENGTH_PREFIX, HAVE_PAYLOAD, PIECE_HEADER, REQUEST_PAYLOAD, PORT_PAYLOAD
 from settings import SETTINGS
+from rate import RateMeter
+import pex
 
 log = logging.getLogger(__name__)
 
@@ -14,267 +21,687 @@ class Peer():
         self.peer_id = peer_id
         self.ip = ip
         self.port = port
+        # Where the peer accepts connections; unknown for an incoming peer
+        # until its extended handshake says.
+        self.listen_port = port
+        self.is_incoming = False
         self.conn = None
-        self.recv_buffer = b''
+        self.is_connecting = False
+        # The connection being made, until it is.
+        self.pending_conn = None
+        self.is_started = False
+
+        # Kept across sessions by the peer registry.
+        self.delivered = 0
+        self.connected_time = 0.0
+        self.session_start = None
+        self.failures = 0
+        self.hash_failures = 0.0
+        self.bad_pieces = 0
+        self.is_banned = False
+
+    def reset(self):
+        self.recv_buffer = bytearray(SETTINGS['recv_buffer_size'])
+        self.recv_view = memoryview(self.recv_buffer)
+        self.recv_start = 0
+        self.recv_end = 0
+        self.recv_wanted = 0
 
         self.is_started = False
-        self.conn_failed = False
         self.am_choking = True
         self.am_interested = False
         self.peer_choking = True
         self.peer_interested = False
+        self.supports_fast = False
+        self.supports_extensions = False
+        self.supports_dht = False
+        self.extension_ids = {}
+        self.pex_sent = set()
 
-        self.peer_pieces = [False for _ in range(len(self.torrent.metainfo.info['pieces']))]
-        self.requested_piece = None
+        num_pieces = len(self.torrent.metainfo.info['pieces'])
+        self.peer_pieces = bitarray.bitarray(num_pieces, endian='big')
+        self.peer_pieces.setall(False)
+        # Pieces the peer lets us request while it chokes us, and the ones
+        # we let it request while we choke it (BEP 6).
+        self.allowed_fast = bitarray.bitarray(num_pieces, endian='big')
+        self.allowed_fast.setall(False)
+        self.granted_fast = set()
+        self.suggested_pieces = collections.deque(maxlen=SETTINGS['max_suggested_pieces'])
+        self.outstanding_requests = {}
+        self.download_rate = RateMeter()
+        self.rtt = None
+        self.last_block_time = None
+
+        self.upload_queue = collections.deque()
+        self.upload_rate = RateMeter()
+        self.write_paused = False
+        self.upload_timer = None
+        self.read_timer = None
+        self.send_buffer = bytearray()
+        self.flush_handle = None
 
     def __repr__(self):
         return ('Peer(ip={ip}, port={port})'.format(**self.__dict__))
 
     def connect(self):
-        self.torrent.conn_man.connect_peer(self)
+        self.reset()
+        self.is_incoming = False
+        self.listen_port = self.port
+        self.is_connecting = True
+        self.pending_conn = self.torrent.conn_man.connect_peer(self)
 
     def run_download(self):
         if not self.is_started:
             self.send_handshake()
         elif self.peer_choking:
-            self.send_message('interested')
-        elif self.requested_piece is not None:
-            pass
+            if not self.am_interested and self.torrent.peer_is_interesting(self):
+                self.am_interested = True
+                self.send_message(codec.INTERESTED_MESSAGE)
+            if self.allowed_fast.any():
+                self.request_blocks()
         else:
+            self.request_blocks()
+
+    def requestable_pieces(self):
+        if not self.peer_choking:
+            return self.peer_pieces
+        return self.peer_pieces & self.allowed_fast
+
+    def request_blocks(self):
+        while (self.conn and (not self.peer_choking or self.supports_fast)
+               and len(self.outstanding_requests) < self.request_queue_depth()):
             try:
-                piece = self.next_piece()
+                (index, begin, length) = self.torrent.next_request(self)
             except PeerNoUnrequestedPiecesError:
-                self.conn.disconnect()
-                self.torrent.handle_peer_stopped(self)
+                if not self.outstanding_requests and not self.torrent.peer_is_interesting(self):
+                    self.handle_not_interesting()
                 return
-
-            self.requested_piece = piece
-            self.torrent.piece_requests[piece].append(self)
-            self.request_new_block(piece, None)
-
-    def next_piece(self):
-        num_pieces = len(self.torrent.metainfo.info['pieces'])
-        for i in range(num_pieces):
-            if (not self.torrent.complete_pieces[i]
-                    and not self.torrent.piece_requests[i]
-                    and self.peer_pieces[i]):
-                return i
-
-        candidates = [i for i in range(num_pieces)
-                      if not self.torrent.complete_pieces[i]
-                      and self.peer_pieces[i]]
-        if not candidates:
-            raise PeerNoUnrequestedPiecesError
-        return random.choice(candidates)
+            # Only a request sent into an empty pipeline measures the round trip
+            # without the queueing delay of the blocks ahead of it.
+            measure_rtt = not self.outstanding_requests
+            self.outstanding_requests[(index, begin)] = (time.monotonic(), measure_rtt)
+            self.send_message(codec.encode_request(index, begin, length))
+
+    def request_queue_depth(self):
+        if self.rtt is None:
+            return SETTINGS['min_request_queue']
+        # Ask for twice the bandwidth-delay product so the queue can grow
+        # geometrically while the measured rate is still ramping up.
+        bdp = self.download_rate.rate() * self.rtt
+        depth = int(2 * bdp / SETTINGS['block_length']) + SETTINGS['min_request_queue']
+        return max(SETTINGS['min_request_queue'], min(SETTINGS['max_request_queue'], depth))
+
+    def is_snubbed(self, now=None):
+        # Unchoked with requests outstanding, yet nothing has arrived lately.
+        if self.peer_choking or not self.outstanding_requests:
+            return False
+        now = time.monotonic() if now is None else now
+        since = self.last_block_time or min(sent for (sent, _) in self.outstanding_requests.values())
+        return now - since > SETTINGS['snub_timeout']
+
+    def stats(self):
+        return {
+            'ip': self.ip,
+            'port': self.port,
+            'download_rate': self.download_rate.rate(),
+            'upload_rate': self.upload_rate.rate(),
+            'downloaded': self.download_rate.total,
+            'uploaded': self.upload_rate.total,
+            'requests_outstanding': len(self.outstanding_requests),
+            'request_queue_depth': self.request_queue_depth(),
+            'rtt': self.rtt,
+            'snubbed': self.is_snubbed(),
+            'am_choking': self.am_choking,
+            'peer_choking': self.peer_choking,
+            'am_interested': self.am_interested,
+            'peer_interested': self.peer_interested,
+            'fast': self.supports_fast,
+        }
 
     def handle_connection_made(self, conn):
+        self.is_connecting = False
+        self.pending_conn = None
+        if self.torrent.is_stopped or self.is_banned:
+            conn.disconnect()
+            return
         self.conn = conn
         log.info('%s: handle_connection_made' % self)
         self.run_download()
 
     def handle_connection_failed(self):
         log.info('%s: handle_connection_failed' % self)
-        self.conn_failed = True
+        self.is_connecting = False
+        self.pending_conn = None
         self.conn = None
         self.torrent.handle_peer_stopped(self)
 
     def handle_connection_lost(self):
         log.info('%s: handle_connection_lost' % self)
-        self.conn_failed = True
         self.conn = None
+        self.cancel_timers()
+        self.torrent.handle_peer_stopped(self)
+
+    def handle_not_interesting(self):
+        if self.am_interested:
+            self.am_interested = False
+            self.send_message(codec.NOT_INTERESTED_MESSAGE)
+        # Keep peers that may still download from us, but drop seeds once
+        # there is nothing left to exchange with them.
+        if not self.peer_interested or self.peer_pieces.all():
+            self.disconnect()
+
+    def disconnect(self):
+        if self.conn:
+            self.flush_messages()
+            self.conn.disconnect()
+            self.conn = None
+        elif self.pending_conn:
+            # Dropped, or banned, before the connection is made.
+            self.pending_conn.disconnect()
+            self.pending_conn = None
+            self.is_connecting = False
+        self.cancel_timers()
+        self.upload_queue.clear()
         self.torrent.handle_peer_stopped(self)
 
     def handle_handshake_ok(self):
+        num_complete = self.torrent.picker.num_complete
+        if self.supports_fast and num_complete == len(self.torrent.complete_pieces):
+            self.send_message(codec.HAVE_ALL_MESSAGE)
+        elif self.supports_fast and num_complete == 0:
+            self.send_message(codec.HAVE_NONE_MESSAGE)
+        elif num_complete:
+            self.send_message(codec.encode_bitfield(self.torrent.bitfield_bytes()))
+        if self.supports_fast:
+            self.grant_allowed_fast()
+        if self.supports_extensions:
+            self.send_extended_handshake()
+        dht = self.torrent.dht
+        if self.supports_dht and dht and dht.transport:
+            self.send_message(codec.encode_port(dht.port))
         self.run_download()
 
+    def grant_allowed_fast(self):
+        try:
+            self.granted_fast = allowed_fast_set(
+                self.ip, self.torrent.metainfo.info_hash, len(self.torrent.complete_pieces),
+                SETTINGS['allowed_fast_set_size'])
+        except OSError:
+            # Not an IPv4 address; the canonical set is only defined for those.
+            return
+        for piece_index in sorted(self.granted_fast):
+            if self.torrent.complete_pieces[piece_index]:
+                self.send_message(codec.encode_allowed_fast(piece_index))
+
     def handle_unchoke(self):
         self.run_download()
 
     def handle_keepalive(self):
         pass
 
-    def handle_data_received(self, recv_data):
-        data = self.recv_buffer + recv_data
-        while data:
-            if not self.is_started:
-                nbytes = self.parse_handshake(data)
+    def get_buffer(self, sizehint=-1):
+        size = len(self.recv_buffer)
+        if size - self.recv_end < size // 4:
+            self.compact_recv_buffer(size if self.recv_start else 2 * size)
+        return self.recv_view[self.recv_end:]
+
+    def buffer_updated(self, nbytes):
+        self.recv_end += nbytes
+        delay = self.torrent.scheduler.download_bucket.consume(nbytes)
+        if delay and self.conn and self.read_timer is None:
+            self.conn.pause_reading()
+            self.read_timer = self.torrent.conn_man.loop.call_later(delay, self.resume_reading)
+        if self.recv_end - self.recv_start < self.recv_wanted:
+            return
+        conn = self.conn
+        while self.recv_start < self.recv_end:
+            if self.is_started:
+                nbytes = self.parse_message(self.recv_start, self.recv_end)
             else:
-                nbytes = self.parse_message(data)
+                data = self.recv_view[self.recv_start:self.recv_end]
+                nbytes = self.parse_handshake(data)
+                data.release()
+            if self.conn is not conn:
+                # A handler disconnected the peer and its pieces are already
+                # released; the rest of the buffer is dropped.
+                self.recv_start = self.recv_end = 0
+                return
             if nbytes == 0:
                 break
-            data = data[nbytes:]
-        self.recv_buffer = data
+            self.recv_start += nbytes
+        if self.recv_start == self.recv_end:
+            self.recv_start = self.recv_end = 0
+
+    def handle_data_received(self, recv_data):
+        recv_data = memoryview(recv_data)
+        conn = self.conn
+        while recv_data and self.conn is conn:
+            buf = self.get_buffer()
+            nbytes = min(len(buf), len(recv_data))
+            buf[:nbytes] = recv_data[:nbytes]
+            self.buffer_updated(nbytes)
+            recv_data = recv_data[nbytes:]
+
+    def compact_recv_buffer(self, size):
+        pending = self.recv_end - self.recv_start
+        if size > len(self.recv_buffer):
+            # Growing a bytearray is not allowed while memoryviews of it are
+            # alive, so a message larger than the buffer gets a new one.
+            recv_buffer = bytearray(size)
+            recv_buffer[:pending] = self.recv_view[self.recv_start:self.recv_end]
+            self.recv_buffer = recv_buffer
+            self.recv_view = memoryview(recv_buffer)
+        else:
+            self.recv_buffer[:pending] = self.recv_buffer[self.recv_start:self.recv_end]
+        self.recv_start = 0
+        self.recv_end = pending
+
+    def handle_piece(self, index, begin, block):
+        now = time.monotonic()
+        request = self.outstanding_requests.pop((index, begin), None)
+        if request is not None:
+            (sent, measure_rtt) = request
+            if measure_rtt:
+                sample = now - sent
+                self.rtt = sample if self.rtt is None else 0.875 * self.rtt + 0.125 * sample
+        self.download_rate.update(len(block), now)
+        self.last_block_time = now
+        self.torrent.handle_block(self, index, begin, block)
+        self.request_blocks()
+
+    def cancel_request(self, index, begin, length):
+        if self.outstanding_requests.pop((index, begin), None) is not None and self.conn:
+            self.send_message(codec.encode_cancel(index, begin, length))
+
+    def handle_choke(self):
+        # Requests for allowed-fast pieces survive a choke; the peer rejects
+        # the rest explicitly, but they are freed for other peers right away.
+        for (index, begin) in list(self.outstanding_requests):
+            if not self.allowed_fast[index]:
+                del self.outstanding_requests[(index, begin)]
+                self.torrent.release_request(index, begin)
+        if self.supports_fast:
+            self.run_download()
+
+    def handle_reject(self, index, begin, length):
+        if self.outstanding_requests.pop((index, begin), None) is None:
+            return
+        log.debug('%s: request rejected: index=%d begin=%d' % (self, index, begin))
+        self.torrent.release_request(index, begin)
+        self.torrent.resume_idle_peers()
+
+    def handle_have_all(self):
+        self.torrent.picker.remove_peer_pieces(self.peer_pieces)
+        self.peer_pieces.setall(True)
+        self.torrent.picker.add_peer_pieces(self.peer_pieces)
+        self.run_download()
+
+    def handle_allowed_fast(self, index):
+        if index >= len(self.allowed_fast) or self.allowed_fast[index]:
+            return
+        self.allowed_fast[index] = True
+        if self.peer_choking and self.peer_pieces[index] and self.torrent.wanted_pieces[index]:
+            self.request_blocks()
+
+    def handle_extended_handshake(self, payload):
+        try:
+            msg = bencodepy.decode(payload)
+        except bencodepy.DecodingError:
+            raise PeerProtocolError('Undecodable extended handshake')
+        if not isinstance(msg, dict):
+            raise PeerProtocolError('Extended handshake is not a dictionary')
+        # Later handshakes update the ids; an id of 0 turns an extension off.
+        for (name, ext_id) in (msg.get(b'm') or {}).items():
+            if isinstance(ext_id, int) and 0 < ext_id < 256:
+                self.extension_ids[name] = ext_id
+            else:
+                self.extension_ids.pop(name, None)
+        port = msg.get(b'p')
+        if isinstance(port, int) and 0 < port < 2**16:
+            self.listen_port = port
+            if self.is_incoming:
+                self.torrent.registry.handle_listen_port(self)
+        if self.extension_ids.get(pex.UT_PEX):
+            self.torrent.pex.send(self)
+
+    def handle_suggest_piece(self, index):
+        if index < len(self.peer_pieces) and self.torrent.wanted_pieces[index]:
+            self.suggested_pieces.append(index)
+
+    def handle_have(self, index):
+        if self.peer_pieces[index]:
+            return
+        self.peer_pieces[index] = True
+        self.torrent.picker.peer_has(index)
+        if self.torrent.wanted_pieces[index] and (self.peer_choking or not self.outstanding_requests):
+            self.run_download()
+
+    def handle_interested(self):
+        self.torrent.choker.handle_interested(self)
+
+    def handle_request(self, index, begin, length):
+        if self.am_choking and index not in self.granted_fast:
+            log.debug('%s: request while choked: index=%d begin=%d' % (self, index, begin))
+            self.reject_request(index, begin, length)
+            return
+        if (length > SETTINGS['max_request_length'] or index >= len(self.torrent.complete_pieces)
+                or not self.torrent.complete_pieces[index]
+                or begin + length > self.torrent.metainfo.get_piece_length(index)):
+            log.info('%s: invalid request: index=%d begin=%d length=%d' % (self, index, begin, length))
+            self.reject_request(index, begin, length)
+            return
+        self.upload_queue.append((index, begin, length))
+        self.serve_requests()
+
+    def handle_cancel(self, index, begin, length):
+        try:
+            self.upload_queue.remove((index, begin, length))
+        except ValueError:
+            return
+        # With the fast extension every request is answered by a piece or a reject.
+        self.reject_request(index, begin, length)
+
+    def reject_request(self, index, begin, length):
+        if self.supports_fast:
+            self.send_message(codec.encode_reject_request(index, begin, length))
+
+    def serve_requests(self):
+        while (self.upload_queue and self.conn and not self.write_paused
+               and self.upload_timer is None):
+            (index, begin, length) = self.upload_queue.popleft()
+            block = self.torrent.read_block(index, begin, length)
+            self.send_piece(index, begin, block)
+            self.upload_rate.update(length)
+            self.torrent.uploaded += length
+            delay = self.torrent.scheduler.upload_bucket.consume(length)
+            if delay:
+                self.upload_timer = self.torrent.conn_man.loop.call_later(delay, self.resume_uploads)
+
+    def resume_uploads(self):
+        self.upload_timer = None
+        self.serve_requests()
+
+    def resume_reading(self):
+        self.read_timer = None
+        if self.conn:
+            self.conn.resume_reading()
+
+    def cancel_timers(self):
+        for timer in (self.upload_timer, self.read_timer, self.flush_handle):
+            if timer is not None:
+                timer.cancel()
+        self.upload_timer = None
+        self.read_timer = None
+        self.flush_handle = None
+        self.send_buffer = bytearray()
+
+    def handle_write_paused(self):
+        self.write_paused = True
+
+    def handle_write_resumed(self):
+        self.write_paused = False
+        self.serve_requests()
+
+    def set_choking(self, choking):
+        if choking == self.am_choking:
+            return
+        self.am_choking = choking
+        if choking:
+            self.send_message(codec.CHOKE_MESSAGE)
+            pending = self.upload_queue
+            self.upload_queue = collections.deque(r for r in pending if r[0] in self.granted_fast)
+            for (index, begin, length) in pending:
+                if index not in self.granted_fast:
+                    self.reject_request(index, begin, length)
+        else:
+            self.send_message(codec.UNCHOKE_MESSAGE)
+
+    def handle_piece_completed(self, piece_index):
+        if self.conn and self.is_started:
+            self.send_message(codec.encode_have(piece_index))
+            if piece_index in self.granted_fast:
+                self.send_message(codec.encode_allowed_fast(piece_index))
 
     def handle_torrent_completed(self):
+        self.outstanding_requests.clear()
+        if SETTINGS['seed'] and self.conn and not self.peer_pieces.all():
+            if self.am_interested:
+                self.am_interested = False
+                self.send_message(codec.NOT_INTERESTED_MESSAGE)
+            return
         if self.conn:
-            self.conn.disconnect()
-        self.requested_piece = None
+            self.disconnect()
 
     def write_message(self, msg):
+        # Small messages queued during one loop iteration (requests, haves)
+        # are coalesced and go out in a single write.
+        if not self.conn:
+            return
+        self.send_buffer += msg
+        if self.flush_handle is None:
+            self.flush_handle = self.torrent.conn_man.loop.call_soon(self.flush_messages)
+
+    def flush_messages(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.send_buffer:
+            return
+        # The transport may keep a reference to what it could not send yet,
+        # so the buffer is handed over rather than cleared.
+        (data, self.send_buffer) = (self.send_buffer, bytearray())
         if self.conn:
-            self.conn.write(msg)
+            self.conn.write(data)
 
     def send_handshake(self):
         log.debug('%s: send_handshake' % self)
-        msg = self.build_handshake(
-            self.torrent.metainfo.info_hash, SETTINGS['peer_id'])
-        self.write_message(msg)
-
-    def send_message(self, msg_type, **params):
+        bits = []
+        if SETTINGS['fast_extension']:
+            bits.append(codec.FAST_EXTENSION_BIT)
+        if SETTINGS['extension_protocol']:
+            bits.append(codec.EXTENSION_PROTOCOL_BIT)
+        if self.torrent.dht:
+            bits.append(codec.DHT_BIT)
+        self.write_message(codec.encode_handshake(
+            self.torrent.metainfo.info_hash, SETTINGS['peer_id'], codec.encode_reserved(bits)))
+
+    def send_message(self, msg):
         if not self.is_started:
             raise PeerConnectionError('Msg sent before recieving handshake')
-        log.debug('%s: send_message: type=%s params=%s' % (self, msg_type, params))
-        if msg_type == 'request' and self.peer_choking:
-            log.debug('Attempted to send message to choking peer')
-            return
-        msg = self.build_message(msg_type, **params)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s: send_message: %s' % (self, codec.describe_encoded(msg)))
         self.write_message(msg)
 
-    def request_new_block(self, piece_index, begin):
-        piece_length = self.torrent.metainfo.get_piece_length(piece_index)
-        begin = 0 if begin is None else begin + SETTINGS['block_length']
-        block_length = min(piece_length - begin, SETTINGS['block_length'])
-        self.send_message('request', index=piece_index, begin=begin, length=block_length)
+    def send_extended_handshake(self):
+        # In sorted key order, which bencodepy does not do by itself.
+        msg = {b'm': {pex.UT_PEX: codec.UT_PEX_ID}}
+        if SETTINGS['listen_port']:
+            msg[b'p'] = SETTINGS['listen_port']
+        msg[b'reqq'] = SETTINGS['max_request_queue']
+        msg[b'v'] = SETTINGS['client_version']
+        self.send_message(codec.encode_extended(codec.EXTENDED_HANDSHAKE, bencodepy.encode(msg)))
+
+    def send_extended(self, name, payload):
+        ext_id = self.extension_ids.get(name)
+        if ext_id:
+            self.send_message(codec.encode_extended(ext_id, payload))
+
+    def send_piece(self, index, begin, block):
+        # The block is written on its own so that a block read from disk is
+        # never copied into the send buffer.
+        self.write_message(codec.encode_piece_header(index, begin, len(block)))
+        self.flush_messages()
+        self.conn.write(block)
 
     def parse_handshake(self, data):
-        pstrlen = int(data[0])
-        handshake_data = data[1: 49 + pstrlen]
-        handshake = self.decode_handshake(pstrlen, handshake_data)
-        if handshake['pstr'] != 'BitTorrent protocol':
+        if not data or len(data) < 49 + data[0]:
+            return 0
+        (pstr, reserved, info_hash, peer_id) = codec.decode_handshake(data)
+        if pstr != codec.PSTR:
             raise PeerProtocolError('Protocol not recognized')
+        if info_hash != self.torrent.metainfo.info_hash:
+            raise PeerProtocolError('Info hash mismatch')
+        self.supports_fast = SETTINGS['fast_extension'] and codec.has_reserved_bit(reserved, codec.FAST_EXTENSION_BIT)
+        self.supports_extensions = (SETTINGS['extension_protocol']
+                                    and codec.has_reserved_bit(reserved, codec.EXTENSION_PROTOCOL_BIT))
+        self.supports_dht = codec.has_reserved_bit(reserved, codec.DHT_BIT)
         self.is_started = True
         log.debug('%s: received_handshake' % self)
         self.handle_handshake_ok()
-        return(1 + len(handshake_data))
+        return 49 + len(pstr)
 
-    def parse_message(self, data):
-        nbytes = 0      
-        if len(data) < 4:
+    def parse_message(self, start, end):
+        # Parses the message at recv_buffer[start:end] where it lies, without
+        # slicing the rest of the buffer; returns its length, or 0 until all
+        # of it is there.
+        if end - start < 4:
             return 0
-        length_prefix = struct.unpack('!L', data[:4])[0]
-        nbytes += 4
-
+        (length_prefix,) = LENGTH_PREFIX.unpack_from(self.recv_buffer, start)
         if length_prefix == 0:
             log.debug('%s: receive_message: keep-alive' % self)
-            return nbytes
+            return 4
 
-        if nbytes + length_prefix > len(data):
+        nbytes = 4 + length_prefix
+        if nbytes > end - start:
+            self.recv_wanted = nbytes
+            if self.recv_wanted > len(self.recv_buffer):
+                self.compact_recv_buffer(self.recv_wanted)
             return 0
-        
-        msg_dict = self.decode_message(data[nbytes:nbytes+length_prefix])
-        nbytes += length_prefix
-        self.handle_message(msg_dict)
+        self.recv_wanted = 0
+
+        msg_id = self.recv_buffer[start+4]
+        payload = self.recv_view[start+5:start+nbytes]
+        self.handle_message(msg_id, payload)
+        payload.release()
         return nbytes
 
-    def handle_message(self, msg_dict):
-        msg_id = msg_dict['msg_id']
-        payload = msg_dict['payload']
-        msg_types = ['choke', 'unchoke', 'interested', 'not_interested', 'have', 'bitfield', 'request', 'piece', 'cancel', 'port']
-        msg_type = msg_types[msg_id]
-
-        log.debug('%s: receive_msg: id=%s type=%s payload=%s%s' % (self, msg_id, msg_type, ''.join('%02X' % v for v in payload[:40]), '...' if len(payload) >= 64 else ''))
-
-        if msg_id == 0:
-            assert(msg_type == 'choke')
-            self.peer_choking = True
-        elif msg_id == 1:
-            assert(msg_type == 'unchoke')
-            self.peer_choking = False
-            self.handle_unchoke()
-        elif msg_id == 2:
-            assert(msg_type == 'interested')
-            self.peer_interested = True
-        elif msg_id == 3:
-            assert(msg_type == 'not_interested')
-            self.peer_interested = False
-        elif msg_id == 4:
-            assert(msg_type == 'have')
-            (index,) = struct.unpack('!L', payload)
-            self.peer_pieces[index] = True
-        elif msg_id == 5:
-            assert(msg_type == 'bitfield')
-            bitfield = payload
-            ba = bitarray.bitarray(endian='big')
-            ba.frombytes(bitfield)
-            num_pieces = len(self.torrent.metainfo.info['pieces'])
-            self.peer_pieces = ba.tolist()[:num_pieces]
-        elif msg_id == 6:
-            assert(msg_type == 'request')
-        elif msg_id == 7:
-            assert(msg_type == 'piece')
-            (index, begin) = struct.unpack('!LL', payload[:8])
-            block = payload[8:]
-            self.torrent.handle_block(self, index, begin, block)
-        elif msg_id == 8:
-            assert(msg_type == 'cancel')
-        elif msg_id == 9:
-            assert(msg_type == 'port')
-        else:
-            raise PeerProtocolMessageTypeError(
-                'Unrecognized message id: %s' % msg_id)
-    
-    @staticmethod
-    def build_handshake(info_hash, peer_id):
-        pstr = b'BitTorrent protocol'
-        fmt = '!B%ds8x20s20s' % len(pstr)
-        msg = struct.pack(fmt, len(pstr), pstr, info_hash, peer_id)
-        return msg
-    
-    @staticmethod
-    def build_message(msg_type, **params):
-        msg_id = None
-        payload = b''
-        if msg_type == 'choke':
-            msg_id = 0
-        elif msg_id == 'unchoke':
-            msg_id = 1
-        elif msg_type == 'interested':
-            msg_id = 2
-        elif msg_type == 'not_interested':
-            msg_id = 3
-        elif msg_type == 'have':
-            msg_id = 4
-        elif msg_type == 'bitfield':
-            msg_id = 5
-        elif msg_type == 'request':
-            msg_id = 6
-            payload = struct.pack('!LLL',
-                                  params['index'], params['begin'],
-                                  params['length'])
-        elif msg_type == 'piece':
-            msg_id = 7
-        elif msg_type == 'cancel':
-            msg_id = 8
-        elif msg_type == 'port':
-            msg_id = 9
-        else:
-            raise PeerProtocolMessageTypeError(
-                'Unrecognized message id: %s' % msg_id)
+    def handle_message(self, msg_id, payload):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s: receive_message: %s' % (self, codec.describe_message(msg_id, payload)))
+        handler = self.message_handlers.get(msg_id)
+        if handler is None:
+            raise PeerProtocolMessageTypeError('Unrecognized message id: %s' % msg_id)
+        handler(self, payload)
 
-        length_prefix = len(payload) + 1
-        fmt = '!LB%ds' % len(payload)
-        msg = struct.pack(fmt, length_prefix, msg_id, payload)
+    def receive_choke(self, payload):
+        self.peer_choking = True
+        self.handle_choke()
 
-        return msg
-    @staticmethod
-    def decode_handshake(pstrlen, data):
-        fmt = '!%ds8x20s20s' % pstrlen
-        fields = struct.unpack(fmt, data)
+    def receive_unchoke(self, payload):
+        self.peer_choking = False
+        self.handle_unchoke()
 
-        return {
-            'pstr': fields[0].decode('utf-8'),
-            'info_hash': fields[1],
-            'peer_id': fields[2]
-        }
-    @staticmethod
-    def decode_message(data):
-        msg_id = int(data[0])
-        payload = data[1:]
+    def receive_interested(self, payload):
+        self.peer_interested = True
+        self.handle_interested()
 
-        return {
-            'msg_id': msg_id,
-            'payload': payload
-        }
+    def receive_not_interested(self, payload):
+        self.peer_interested = False
+        self.upload_queue.clear()
+
+    def receive_have(self, payload):
+        (index,) = HAVE_PAYLOAD.unpack(payload)
+        self.handle_have(index)
+
+    def receive_bitfield(self, payload):
+        ba = bitarray.bitarray(endian='big')
+        ba.frombytes(bytes(payload))
+        num_pieces = len(self.peer_pieces)
+        if len(ba) < num_pieces:
+            raise PeerProtocolError('Bitfield too short: %d bits for %d pieces' % (len(ba), num_pieces))
+        self.torrent.picker.remove_peer_pieces(self.peer_pieces)
+        self.peer_pieces = ba[:num_pieces]
+        self.torrent.picker.add_peer_pieces(self.peer_pieces)
+        self.run_download()
+
+    def receive_request(self, payload):
+        (index, begin, length) = REQUEST_PAYLOAD.unpack(payload)
+        self.handle_request(index, begin, length)
+
+    def receive_piece(self, payload):
+        (index, begin) = PIECE_HEADER.unpack_from(payload)
+        self.handle_piece(index, begin, payload[8:])
+
+    def receive_cancel(self, payload):
+        (index, begin, length) = REQUEST_PAYLOAD.unpack(payload)
+        self.handle_cancel(index, begin, length)
+
+    def receive_port(self, payload):
+        (port,) = PORT_PAYLOAD.unpack(payload)
+        if self.torrent.dht and port:
+            self.torrent.dht.add_contact((self.ip, port))
+
+    def receive_suggest_piece(self, payload):
+        self.require_fast()
+        (index,) = HAVE_PAYLOAD.unpack(payload)
+        self.handle_suggest_piece(index)
+
+    def receive_have_all(self, payload):
+        self.require_fast()
+        self.handle_have_all()
+
+    def receive_have_none(self, payload):
+        self.require_fast()
+        self.run_download()
+
+    def receive_reject_request(self, payload):
+        self.require_fast()
+        (index, begin, length) = REQUEST_PAYLOAD.unpack(payload)
+        self.handle_reject(index, begin, length)
+
+    def receive_allowed_fast(self, payload):
+        self.require_fast()
+        (index,) = HAVE_PAYLOAD.unpack(payload)
+        self.handle_allowed_fast(index)
+
+    def receive_extended(self, payload):
+        if not self.supports_extensions:
+            raise PeerProtocolError('Extended message without the extension protocol')
+        ext_id = payload[0]
+        if ext_id == codec.EXTENDED_HANDSHAKE:
+            self.handle_extended_handshake(bytes(payload[1:]))
+        elif ext_id == codec.UT_PEX_ID:
+            self.torrent.pex.handle_message(self, bytes(payload[1:]))
+        else:
+            log.debug('%s: unknown extended message id %d' % (self, ext_id))
+
+    def require_fast(self):
+        if not self.supports_fast:
+            raise PeerProtocolError('Fast extension message without the fast extension')
+
+    message_handlers = {
+        codec.CHOKE: receive_choke,
+        codec.UNCHOKE: receive_unchoke,
+        codec.INTERESTED: receive_interested,
+        codec.NOT_INTERESTED: receive_not_interested,
+        codec.HAVE: receive_have,
+        codec.BITFIELD: receive_bitfield,
+        codec.REQUEST: receive_request,
+        codec.PIECE: receive_piece,
+        codec.CANCEL: receive_cancel,
+        codec.PORT: receive_port,
+        codec.SUGGEST_PIECE: receive_suggest_piece,
+        codec.HAVE_ALL: receive_have_all,
+        codec.HAVE_NONE: receive_have_none,
+        codec.REJECT_REQUEST: receive_reject_request,
+        codec.ALLOWED_FAST: receive_allowed_fast,
+        codec.EXTENDED: receive_extended,
+    }
+
+
+def allowed_fast_set(ip, info_hash, num_pieces, k):
+    # The canonical allowed-fast set of BEP 6, so both sides of a
+    # reconnect from the same /24 agree on it.
+    k = min(k, num_pieces)
+    x = bytes(bytearray(socket.inet_aton(ip))[:3] + b'\x00') + info_hash
+    allowed = set()
+    while len(allowed) < k:
+        x = hashlib.sha1(x).digest()
+        for i in range(0, 20, 4):
+            if len(allowed) == k:
+                break
+            allowed.add(int.from_bytes(x[i:i+4], 'big') % num_pieces)
+    return allowed
 
 
 class AnnounceFailureError(Exception):
@@ -0,0 +1,79 @@
+import logging
+import bencodepy
+
+import codec
+from settings import SETTINGS
+
+log = logging.getLogger(__name__)
+
+UT_PEX = b'ut_pex'
+# Flags sent with each added peer (BEP 11).
+PEX_SEED = 0x02
+PEX_CONNECTABLE = 0x10
+
+
+class PeerExchange():
+    def __init__(self, torrent):
+        self.torrent = torrent
+        self.timer = None
+        self.peers_received = 0
+
+    def start(self):
+        self.timer = self.torrent.conn_man.loop.call_later(SETTINGS['pex_interval'], self.run)
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def run(self):
+        for peer in list(self.torrent.registry.active):
+            if peer.conn and peer.extension_ids.get(UT_PEX):
+                self.send(peer)
+        self.start()
+
+    def connected_peers(self):
+        # Only peers whose listening port we know can be handed on; BEP 11
+        # messages carry IPv4 addresses in the compact format.
+        return {(p.ip, p.listen_port): p for p in self.torrent.registry.active
+                if p.conn and p.is_started and p.listen_port and ':' not in p.ip}
+
+    def send(self, peer):
+        peers = self.connected_peers()
+        peers.pop((peer.ip, peer.listen_port), None)
+        added = [addr for addr in peers if addr not in peer.pex_sent][:SETTINGS['max_pex_peers']]
+        dropped = [addr for addr in peer.pex_sent if addr not in peers][:SETTINGS['max_pex_peers']]
+        if not added and not dropped:
+            return
+        msg = {
+            b'added': b''.join(codec.encode_compact_peer(*addr) for addr in added),
+            b'added.f': bytes(self.flags(peers[addr]) for addr in added),
+            b'dropped': b''.join(codec.encode_compact_peer(*addr) for addr in dropped),
+        }
+        peer.send_extended(UT_PEX, bencodepy.encode(msg))
+        peer.pex_sent.update(added)
+        peer.pex_sent.difference_update(dropped)
+
+    @staticmethod
+    def flags(peer):
+        flags = 0 if peer.is_incoming else PEX_CONNECTABLE
+        if peer.peer_pieces.all():
+            flags |= PEX_SEED
+        return flags
+
+    def handle_message(self, peer, payload):
+        try:
+            msg = bencodepy.decode(payload)
+        except bencodepy.DecodingError:
+            log.info('%s: undecodable ut_pex message' % peer)
+            return
+        if not isinstance(msg, dict) or not isinstance(msg.get(b'added', b''), bytes):
+            return
+        added = codec.decode_compact_peers(msg.get(b'added', b''))[:SETTINGS['max_pex_peers']]
+        log.debug('%s: ut_pex: %d peers added' % (peer, len(added)))
+        for (ip, port) in added:
+            if port:
+                self.torrent.add_peer({'ip': ip, 'port': port})
+        self.peers_received += len(added)
+        if added and not self.torrent.is_complete:
+            self.torrent.fill_peers()
@@ -0,0 +1,194 @@
+import random
+import logging
+
+from settings import SETTINGS
+
+log = logging.getLogger(__name__)
+
+FREE = 0
+ACTIVE = 1
+COMPLETE = 2
+
+SKIP = 0
+LOW = 1
+NORMAL = 2
+HIGH = 3
+PRIORITIES = {'skip': SKIP, 'low': LOW, 'normal': NORMAL, 'high': HIGH}
+# Wanted priorities, in the order they are picked from.
+PICK_ORDER = (HIGH, NORMAL, LOW)
+
+
+class PiecePicker():
+    def __init__(self, num_pieces, policy=None):
+        self.num_pieces = num_pieces
+        self.policy = policy or SETTINGS['piece_picker']
+        if self.policy not in ('rarest_first', 'random_first', 'sequential'):
+            raise PiecePickerError('Unknown piece picker policy: %s' % self.policy)
+
+        self.state = [FREE for _ in range(num_pieces)]
+        self.availability = [0 for _ in range(num_pieces)]
+        self.priority = bytearray([NORMAL]) * num_pieces
+        # buckets[priority][n] holds the free pieces of that priority that
+        # exactly n connected peers have. Skipped pieces are in no bucket.
+        self.buckets = {priority: [set()] for priority in PICK_ORDER}
+        self.buckets[NORMAL][0].update(range(num_pieces))
+        self.num_complete = 0
+        # Free and wanted pieces only; skipped pieces are never picked.
+        self.num_free = num_pieces
+        self.num_wanted = num_pieces
+        self.sequential_cursor = 0
+        # Pieces a reader is waiting for, by the earliest time one needs
+        # them, and the deadline each holder set.
+        self.deadlines = {}
+        self.deadline_holders = {}
+
+    def pick(self, peer_pieces):
+        if self.policy == 'sequential':
+            return self.pick_sequential(peer_pieces)
+        if self.policy == 'random_first' and self.num_complete < SETTINGS['random_first_pieces']:
+            piece_index = self.pick_random(peer_pieces)
+            if piece_index is not None:
+                return piece_index
+        return self.pick_rarest(peer_pieces)
+
+    def pick_rarest(self, peer_pieces):
+        for priority in PICK_ORDER:
+            for bucket in self.buckets[priority][1:]:
+                for piece_index in bucket:
+                    if peer_pieces[piece_index]:
+                        return piece_index
+        return None
+
+    def pick_random(self, peer_pieces):
+        for priority in PICK_ORDER:
+            if not any(self.buckets[priority]):
+                continue
+            start = random.randrange(self.num_pieces)
+            for i in range(self.num_pieces):
+                piece_index = (start + i) % self.num_pieces
+                if (self.state[piece_index] == FREE and self.priority[piece_index] == priority
+                        and peer_pieces[piece_index]):
+                    return piece_index
+        return None
+
+    def pick_sequential(self, peer_pieces):
+        while (self.sequential_cursor < self.num_pieces
+               and (self.state[self.sequential_cursor] != FREE or self.priority[self.sequential_cursor] == SKIP)):
+            self.sequential_cursor += 1
+        for priority in PICK_ORDER:
+            if not any(self.buckets[priority]):
+                continue
+            for piece_index in range(self.sequential_cursor, self.num_pieces):
+                if (self.state[piece_index] == FREE and self.priority[piece_index] == priority
+                        and peer_pieces[piece_index]):
+                    return piece_index
+        return None
+
+    def urgent_pieces(self):
+        return sorted(self.deadlines, key=self.deadlines.get)
+
+    def set_deadline(self, piece_index, deadline, holder):
+        if self.state[piece_index] == COMPLETE:
+            return
+        holders = self.deadline_holders.setdefault(piece_index, {})
+        holders[holder] = deadline
+        self.deadlines[piece_index] = min(holders.values())
+
+    def clear_deadline(self, piece_index, holder):
+        # The deadline stays while another holder still needs the piece.
+        holders = self.deadline_holders.get(piece_index)
+        if holders is None:
+            return
+        holders.pop(holder, None)
+        if holders:
+            self.deadlines[piece_index] = min(holders.values())
+        else:
+            del self.deadline_holders[piece_index]
+            del self.deadlines[piece_index]
+
+    def add_peer_pieces(self, peer_pieces):
+        for piece_index, has_piece in enumerate(peer_pieces):
+            if has_piece:
+                self.peer_has(piece_index)
+
+    def remove_peer_pieces(self, peer_pieces):
+        for piece_index, has_piece in enumerate(peer_pieces):
+            if has_piece:
+                self.peer_lost(piece_index)
+
+    def peer_has(self, piece_index):
+        self.set_availability(piece_index, self.availability[piece_index] + 1)
+
+    def peer_lost(self, piece_index):
+        self.set_availability(piece_index, self.availability[piece_index] - 1)
+
+    def set_availability(self, piece_index, availability):
+        if self.state[piece_index] == FREE and self.priority[piece_index] != SKIP:
+            self.discard_free(piece_index)
+            self.availability[piece_index] = availability
+            self.add_free(piece_index)
+        else:
+            self.availability[piece_index] = availability
+
+    def add_free(self, piece_index):
+        buckets = self.buckets[self.priority[piece_index]]
+        availability = self.availability[piece_index]
+        while len(buckets) <= availability:
+            buckets.append(set())
+        buckets[availability].add(piece_index)
+
+    def discard_free(self, piece_index):
+        self.buckets[self.priority[piece_index]][self.availability[piece_index]].discard(piece_index)
+
+    def is_free(self, piece_index):
+        return self.state[piece_index] == FREE and self.priority[piece_index] != SKIP
+
+    def mark_active(self, piece_index):
+        self.set_state(piece_index, ACTIVE)
+
+    def mark_free(self, piece_index):
+        self.set_state(piece_index, FREE)
+
+    def mark_complete(self, piece_index):
+        self.set_state(piece_index, COMPLETE)
+
+    def set_state(self, piece_index, state):
+        old_state = self.state[piece_index]
+        if old_state == state:
+            return
+        wanted = self.priority[piece_index] != SKIP
+        if old_state == FREE and wanted:
+            self.discard_free(piece_index)
+            self.num_free -= 1
+        elif state == FREE and wanted:
+            self.add_free(piece_index)
+            self.num_free += 1
+            self.sequential_cursor = min(self.sequential_cursor, piece_index)
+        if old_state == COMPLETE:
+            self.num_complete -= 1
+        elif state == COMPLETE:
+            self.num_complete += 1
+            self.deadlines.pop(piece_index, None)
+            self.deadline_holders.pop(piece_index, None)
+        self.state[piece_index] = state
+
+    def set_priority(self, piece_index, priority):
+        old_priority = self.priority[piece_index]
+        if old_priority == priority:
+            return
+        is_free = self.state[piece_index] == FREE
+        if old_priority != SKIP:
+            self.num_wanted -= 1
+            if is_free:
+                self.discard_free(piece_index)
+                self.num_free -= 1
+        self.priority[piece_index] = priority
+        if priority != SKIP:
+            self.num_wanted += 1
+            if is_free:
+                self.add_free(piece_index)
+                self.num_free += 1
+                self.sequential_cursor = min(self.sequential_cursor, piece_index)
+
+class PiecePickerError(Exception):
+    pass
@@ -0,0 +1,76 @@
+import bitarray
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class PieceBuffer():
+    def __init__(self, index, length, block_length):
+        self.index = index
+        self.length = length
+        self.block_length = block_length
+        self.num_blocks = (length + block_length - 1) // block_length
+
+        self.data = bytearray(length)
+        self.received = bitarray.bitarray(self.num_blocks)
+        self.received.setall(False)
+        self.requested = bitarray.bitarray(self.num_blocks)
+        self.requested.setall(False)
+        self.num_received = 0
+        self.num_requested = 0
+        self.unrequested = list(reversed(range(self.num_blocks)))
+        # The peer that sent each block, blamed if the piece fails its hash.
+        self.sources = [None] * self.num_blocks
+
+    def __repr__(self):
+        return ('PieceBuffer(index={index}, length={length}, '
+                'received={num_received}/{num_blocks})'.format(**self.__dict__))
+
+    def get_block_length(self, block):
+        return min(self.block_length, self.length - block * self.block_length)
+
+    def has_unrequested(self):
+        return bool(self.unrequested)
+
+    def num_outstanding(self):
+        return (self.requested & ~self.received).count()
+
+    def outstanding_requests(self):
+        for block in range(self.num_blocks):
+            if self.requested[block] and not self.received[block]:
+                yield (block * self.block_length, self.get_block_length(block))
+
+    def next_request(self):
+        block = self.unrequested.pop()
+        self.requested[block] = True
+        self.num_requested += 1
+        return (block * self.block_length, self.get_block_length(block))
+
+    def release(self, begin):
+        block = begin // self.block_length
+        if self.received[block] or not self.requested[block]:
+            return False
+        self.requested[block] = False
+        self.num_requested -= 1
+        self.unrequested.append(block)
+        return True
+
+    def add_block(self, begin, block_data):
+        (block, remainder) = divmod(begin, self.block_length)
+        if (remainder or block >= self.num_blocks
+                or len(block_data) != self.get_block_length(block)):
+            log.debug('%s: unexpected block begin=%d length=%d' % (self, begin, len(block_data)))
+            return False
+        if self.received[block]:
+            return False
+        self.data[begin:begin+len(block_data)] = block_data
+        self.received[block] = True
+        self.num_received += 1
+        if not self.requested[block]:
+            self.requested[block] = True
+            self.num_requested += 1
+            self.unrequested.remove(block)
+        return True
+
+    def is_complete(self):
+        return self.num_received == self.num_blocks
@@ -0,0 +1,53 @@
+import math
+import time
+
+
+class RateMeter():
+    def __init__(self, window=2.0):
+        self.window = window
+        self.value = 0.0
+        self.total = 0
+        self.last_update = time.monotonic()
+
+    def update(self, nbytes, now=None):
+        now = time.monotonic() if now is None else now
+        self.value = self.decayed(now) + nbytes / self.window
+        self.last_update = now
+        self.total += nbytes
+
+    def decayed(self, now):
+        elapsed = now - self.last_update
+        if elapsed <= 0:
+            return self.value
+        return self.value * math.exp(-elapsed / self.window)
+
+    def rate(self, now=None):
+        now = time.monotonic() if now is None else now
+        return self.decayed(now)
+
+
+class TokenBucket():
+    def __init__(self, rate=0, burst=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = self.get_burst()
+        self.last_update = time.monotonic()
+
+    def get_burst(self):
+        return self.burst if self.burst is not None else self.rate
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.tokens = min(self.tokens, self.get_burst())
+
+    def consume(self, nbytes, now=None):
+        if not self.rate:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.get_burst(), self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+        # Tokens may go negative; the caller waits until the debt is repaid.
+        self.tokens -= nbytes
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
@@ -0,0 +1,153 @@
+import time
+import heapq
+import logging
+import itertools
+
+from settings import SETTINGS
+from peer import Peer
+
+log = logging.getLogger(__name__)
+
+
+class PeerRegistry():
+    def __init__(self, torrent):
+        self.torrent = torrent
+        self.peers = {}
+        # Peers with a connection open or in progress.
+        self.active = set()
+        # Idle peers that may be connected now, and (retry_time, seq, peer)
+        # entries for those still backing off after a failed session.
+        self.ready = set()
+        self.waiting = []
+        self.seq = itertools.count()
+        self.suspect_pieces = {}
+        self.retry_timer = None
+
+    def __len__(self):
+        return len(self.peers)
+
+    def get(self, ip, port):
+        return self.peers.get((ip, port))
+
+    def add(self, ip, port, peer_id=None):
+        peer = self.peers.get((ip, port))
+        if peer is None:
+            peer = Peer(self.torrent, ip, port, peer_id)
+            self.peers[(ip, port)] = peer
+            self.ready.add(peer)
+        return peer
+
+    def stop(self):
+        if self.retry_timer:
+            self.retry_timer.cancel()
+            self.retry_timer = None
+
+    def score(self, peer):
+        throughput = peer.delivered / max(1.0, peer.connected_time)
+        return throughput / (1.0 + peer.hash_failures)
+
+    def handle_connecting(self, peer):
+        self.ready.discard(peer)
+        self.active.add(peer)
+        peer.session_start = time.monotonic()
+
+    def handle_stopped(self, peer):
+        if peer not in self.active:
+            return
+        self.active.discard(peer)
+        now = time.monotonic()
+        delivered = peer.download_rate.total
+        peer.delivered += delivered
+        peer.connected_time += now - peer.session_start
+        # A session that delivered data resets the backoff; repeated failures
+        # to connect or to get anything from the peer double it each time.
+        peer.failures = 0 if delivered else peer.failures + 1
+        if peer.is_banned or self.peers.get((peer.ip, peer.port)) is not peer:
+            return
+        if peer.listen_port is None:
+            # An incoming peer that never said where it listens: nobody
+            # answers on the port it came from.
+            del self.peers[(peer.ip, peer.port)]
+            return
+        delay = min(SETTINGS['peer_retry_interval'] * 2 ** peer.failures,
+                    SETTINGS['peer_max_retry_interval'])
+        heapq.heappush(self.waiting, (now + delay, next(self.seq), peer))
+
+    def handle_hash_failure(self, piece_buffer):
+        peers = set(p for p in piece_buffer.sources if p is not None)
+        for peer in peers:
+            peer.hash_failures += 1.0 / len(peers)
+        if len(peers) == 1:
+            self.handle_bad_piece(peers.pop())
+        else:
+            # Keep the bad copy; once the piece verifies, the blocks that
+            # differ from it show which peers sent corrupt data.
+            self.suspect_pieces[piece_buffer.index] = piece_buffer
+
+    def handle_piece_verified(self, piece_buffer):
+        suspect = self.suspect_pieces.pop(piece_buffer.index, None)
+        if suspect is None:
+            return
+        culprits = set()
+        for block in range(piece_buffer.num_blocks):
+            begin = block * piece_buffer.block_length
+            end = begin + piece_buffer.get_block_length(block)
+            if suspect.data[begin:end] != piece_buffer.data[begin:end] and suspect.sources[block]:
+                culprits.add(suspect.sources[block])
+        for peer in culprits:
+            self.handle_bad_piece(peer)
+
+    def handle_bad_piece(self, peer):
+        peer.bad_pieces += 1
+        if peer.bad_pieces >= SETTINGS['max_bad_pieces'] and not peer.is_banned:
+            log.info('%s: banned after %d bad pieces' % (peer, peer.bad_pieces))
+            peer.is_banned = True
+            self.ready.discard(peer)
+            if peer.conn or peer.is_connecting:
+                peer.disconnect()
+
+    def release_waiting(self, now):
+        while self.waiting and self.waiting[0][0] <= now:
+            (_, _, peer) = heapq.heappop(self.waiting)
+            if peer not in self.active and not peer.is_banned:
+                self.ready.add(peer)
+
+    def fill(self, max_peers):
+        num_free = max_peers - len(self.active)
+        if num_free <= 0:
+            return
+        self.release_waiting(time.monotonic())
+        for peer in heapq.nlargest(num_free, self.ready, key=self.score):
+            log.info('fill_peers: starting new peer: %s' % peer)
+            self.handle_connecting(peer)
+            peer.connect()
+            if len(self.active) >= max_peers:
+                return
+        if len(self.active) < max_peers and self.waiting and self.retry_timer is None:
+            delay = max(0.0, self.waiting[0][0] - time.monotonic())
+            self.retry_timer = self.torrent.conn_man.loop.call_later(delay, self.retry)
+
+    def retry(self):
+        self.retry_timer = None
+        self.torrent.fill_peers()
+
+    def accept(self, ip, port):
+        peer = self.add(ip, port)
+        if peer in self.active or peer.is_banned:
+            return None
+        peer.reset()
+        peer.is_incoming = True
+        peer.listen_port = None
+        self.handle_connecting(peer)
+        return peer
+
+    def handle_listen_port(self, peer):
+        # An incoming peer is keyed by the port it came from until its
+        # extended handshake tells where it listens. If another entry is
+        # already there, that one is kept and this one dropped once it stops.
+        if peer.listen_port == peer.port:
+            return
+        if self.peers.get((peer.ip, peer.port)) is peer:
+            del self.peers[(peer.ip, peer.port)]
+        if self.peers.setdefault((peer.ip, peer.listen_port), peer) is peer:
+            peer.port = peer.listen_port
@@ -0,0 +1,101 @@
+import os
+import time
+import asyncio
+import logging
+import bitarray
+import bencodepy
+
+log = logging.getLogger(__name__)
+
+
+class ResumeData():
+    def __init__(self, storage, metainfo):
+        self.storage = storage
+        self.metainfo = metainfo
+        self.path = os.path.join(storage.base_dir, os.path.basename(metainfo.name)) + '.resume'
+
+    def file_stats(self):
+        stats = []
+        for path in [f['path'] for f in self.storage.files] + [self.storage.part_file.path]:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                stats.append([0, 0])
+            else:
+                stats.append([st.st_size, st.st_mtime_ns])
+        return stats
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                content = bencodepy.decode(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, bencodepy.DecodingError) as e:
+            log.warning('%s: unreadable resume data: %s' % (self.path, e))
+            return None
+
+        if not isinstance(content, dict):
+            log.warning('%s: resume data is not a dictionary' % self.path)
+            return None
+        num_pieces = len(self.metainfo.info['pieces'])
+        if content.get(b'info_hash') != self.metainfo.info_hash:
+            log.info('%s: resume data is for another torrent' % self.path)
+            return None
+        if content.get(b'files') != self.file_stats():
+            log.info('%s: files changed since resume data was saved' % self.path)
+            return None
+        bitfield = content.get(b'bitfield')
+        if not isinstance(bitfield, bytes) or len(bitfield) != (num_pieces + 7) // 8:
+            log.warning('%s: missing or wrongly sized bitfield' % self.path)
+            return None
+        ba = bitarray.bitarray(endian='big')
+        ba.frombytes(bitfield)
+        return ba[:num_pieces]
+
+    def save(self, complete_pieces):
+        ba = bitarray.bitarray(complete_pieces, endian='big')
+        content = {
+            b'info_hash': self.metainfo.info_hash,
+            b'bitfield': ba.tobytes(),
+            b'files': self.file_stats(),
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(bencodepy.encode(content))
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+async def recheck(storage, metainfo, loop, executor, batch_size=64):
+    # The batches run on the executor, so the event loop keeps serving the
+    # other torrents meanwhile.
+    num_pieces = len(metainfo.info['pieces'])
+    maps = storage.map_files()
+    start = time.perf_counter()
+    futures = [loop.run_in_executor(executor, check_batch, storage, maps, range(i, min(i + batch_size, num_pieces)))
+               for i in range(0, num_pieces, batch_size)]
+    try:
+        results = await asyncio.gather(*futures)
+    except BaseException:
+        # Cancelled or failed: batches already running still read the maps,
+        # so they are left to be closed when collected.
+        for future in futures:
+            future.cancel()
+        raise
+    elapsed = time.perf_counter() - start
+    storage.unmap_files(maps)
+    complete_pieces = [v for batch in results for v in batch]
+    nbytes = sum(metainfo.get_piece_length(i) for i in range(num_pieces))
+    rate = nbytes / elapsed if elapsed > 0 else 0.0
+    log.info('recheck: %d/%d pieces valid, %.1f MB/s' % (sum(complete_pieces), num_pieces, rate / 2**20))
+    return (complete_pieces, rate)
+
+
+def check_batch(storage, maps, batch):
+    return [storage.check_piece(maps, i) for i in batch]
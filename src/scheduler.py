@@ -0,0 +1,79 @@
+import logging
+
+from settings import SETTINGS
+from rate import TokenBucket
+
+log = logging.getLogger(__name__)
+
+
+class Scheduler():
+    def __init__(self, client):
+        self.client = client
+        self.loop = client.conn_man.loop
+        self.download_bucket = TokenBucket(SETTINGS['download_rate_limit'])
+        self.upload_bucket = TokenBucket(SETTINGS['upload_rate_limit'])
+        self.timer = None
+
+    def start(self):
+        self.start_queued()
+        self.rebalance()
+        self.timer = self.loop.call_later(SETTINGS['rebalance_interval'], self.run)
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def run(self):
+        # Re-armed first so that an error in one round does not end them all.
+        self.timer = self.loop.call_later(SETTINGS['rebalance_interval'], self.run)
+        self.rebalance()
+
+    def start_queued(self):
+        while self.client.queued_torrent and len(self.client.active_torrent) < SETTINGS['max_active_torrents']:
+            torrent = self.client.queued_torrent.pop(0)
+            self.client.active_torrent.append(torrent)
+            log.info('%s: starting queued torrent' % torrent)
+            self.client.start_torrent(torrent)
+        self.rebalance()
+
+    def handle_torrent_completed(self, torrent):
+        self.start_queued()
+
+    def set_rate_limits(self, download_rate=None, upload_rate=None):
+        if download_rate is not None:
+            self.download_bucket.set_rate(download_rate)
+        if upload_rate is not None:
+            self.upload_bucket.set_rate(upload_rate)
+
+    def rebalance(self):
+        downloading = [t for t in self.client.active_torrent if not t.is_complete]
+        seeding = [t for t in self.client.active_torrent + self.client.finished_torrent
+                   if t.is_complete and SETTINGS['seed']]
+        num_torrents = len(downloading) + len(seeding)
+        if not num_torrents:
+            return
+        total = SETTINGS['max_connections']
+        floor = min(SETTINGS['min_peers_per_torrent'], total // num_torrents)
+        for torrent in seeding:
+            torrent.set_max_peers(floor)
+        if not downloading:
+            return
+
+        # Weight each downloading torrent by its progress per connection slot.
+        # Torrents without a measurement yet get the average so they can prove
+        # themselves before losing slots.
+        efficiency = {}
+        for torrent in downloading:
+            num_connected = torrent.num_connected()
+            rate = torrent.download_rate.rate()
+            efficiency[torrent] = rate / num_connected if num_connected and rate else None
+        measured = [v for v in efficiency.values() if v]
+        default = sum(measured) / len(measured) if measured else 1.0
+        weights = dict((t, efficiency[t] or default) for t in downloading)
+        total_weight = sum(weights.values())
+
+        spare = max(0, total - floor * num_torrents)
+        for torrent in downloading:
+            max_peers = floor + int(spare * weights[torrent] / total_weight)
+            torrent.set_max_peers(min(SETTINGS['max_peers'], max_peers))
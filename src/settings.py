@@ -1,5 +1,65 @@
 SETTINGS = {
     'peer_id': b'QQ-0000-000000000000',
     'block_length': 2**14,
-    'max_peers': 8
+    'recv_buffer_size': 2**16,
+    'max_peers': 30,
+    'connect_timeout': 3.0,
+    'min_request_queue': 2,
+    'max_request_queue': 64,
+    'piece_picker': 'rarest_first',
+    'random_first_pieces': 4,
+    'hash_workers': 4,
+    'hash_queue_depth': 16,
+    'resume_save_interval': 30.0,
+    'listen_port': 6881,
+    'seed': False,
+    'upload_slots': 4,
+    'choke_interval': 10.0,
+    'optimistic_unchoke_rounds': 3,
+    'max_request_length': 2**17,
+    'endgame': True,
+    'max_connections': 100,
+    'max_active_torrents': 4,
+    'min_peers_per_torrent': 4,
+    'download_rate_limit': 0,
+    'upload_rate_limit': 0,
+    'rebalance_interval': 10.0,
+    'tracker_timeout': 15.0,
+    'tracker_retry_interval': 60.0,
+    'tracker_max_interval': 1800.0,
+    'tracker_min_interval': 60.0,
+    'tracker_stop_timeout': 2.0,
+    'udp_tracker_timeout': 3.0,
+    'udp_tracker_retries': 3,
+    'peer_retry_interval': 10.0,
+    'peer_max_retry_interval': 600.0,
+    'max_bad_pieces': 3,
+    'snub_timeout': 60.0,
+    'loop_lag_interval': 0.5,
+    'stats_host': '127.0.0.1',
+    'stats_port': 0,
+    'fast_extension': True,
+    'allowed_fast_set_size': 10,
+    'max_suggested_pieces': 32,
+    'extension_protocol': True,
+    'client_version': b'TorrentClient 0.1',
+    'pex_interval': 60.0,
+    'max_pex_peers': 50,
+    'dht': True,
+    'dht_port': None,
+    'dht_bootstrap': [('router.bittorrent.com', 6881), ('dht.transmissionbt.com', 6881),
+                      ('router.utorrent.com', 6881)],
+    'dht_query_timeout': 2.0,
+    'dht_announce_interval': 900.0,
+    'dht_retry_interval': 60.0,
+    'stream_host': '127.0.0.1',
+    'stream_port': 0,
+    'stream_readahead': 2**23,
+    'stream_deadline_interval': 0.25,
+    'cache_size': 2**26,
+    'cache_flush_bytes': 2**24,
+    'cache_flush_interval': 5.0,
+    'allocation': 'sparse',
+    'worker_report_interval': 1.0,
+    'control_socket': None
 }
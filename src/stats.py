@@ -0,0 +1,191 @@
+import json
+import time
+import bisect
+import asyncio
+import logging
+
+from settings import SETTINGS
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+HASH_TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+LOOP_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram():
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # Bucket i counts values <= buckets[i]; the last one is +Inf.
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {
+            'buckets': list(self.buckets),
+            'counts': list(self.counts),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class LoopMonitor():
+    def __init__(self, loop, interval=None):
+        self.loop = loop
+        self.interval = interval or SETTINGS['loop_lag_interval']
+        self.lag = Histogram(LOOP_BUCKETS)
+        self.max_lag = 0.0
+        self.timer = None
+        self.expected = None
+
+    def start(self):
+        self.expected = time.monotonic() + self.interval
+        self.timer = self.loop.call_later(self.interval, self.tick)
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def tick(self):
+        # Anything that kept the loop busy past the deadline shows up as lag.
+        lag = max(0.0, time.monotonic() - self.expected)
+        self.lag.observe(lag)
+        self.max_lag = max(self.max_lag, lag)
+        self.start()
+
+
+class StatsServer():
+    def __init__(self, loop, get_stats):
+        self.loop = loop
+        self.get_stats = get_stats
+        self.server = None
+
+    def start(self, port):
+        self.loop.create_task(self.open_server(port))
+
+    async def open_server(self, port):
+        try:
+            self.server = await asyncio.start_server(self.handle_request, SETTINGS['stats_host'], port)
+        except OSError as e:
+            log.warning('Cannot serve stats on port %d: %s' % (port, e))
+
+    def stop(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+
+    async def handle_request(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.split()
+            path = parts[1].split(b'?')[0] if len(parts) > 1 else b''
+            if path == b'/metrics':
+                (status, content_type) = (b'200 OK', b'text/plain; version=0.0.4')
+                body = render_prometheus(self.get_stats()).encode('utf-8')
+            elif path == b'/stats':
+                (status, content_type) = (b'200 OK', b'application/json')
+                body = json.dumps(self.get_stats()).encode('utf-8')
+            else:
+                (status, content_type, body) = (b'404 Not Found', b'text/plain', b'not found\n')
+            writer.write(b'HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n'
+                         % (status, content_type, len(body)) + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, escape_label(v)) for (k, v) in labels)
+
+
+def render_prometheus(stats):
+    metrics = {}
+
+    def add(name, kind, labels, value):
+        if value is None:
+            return
+        if isinstance(value, bool):
+            value = int(value)
+        metrics.setdefault(name, (kind, []))[1].append((labels, value))
+
+    loop_stats = stats['loop']
+    add('torrentclient_loop_lag_seconds', 'histogram', [], loop_stats['lag'])
+    add('torrentclient_loop_callback_seconds', 'histogram', [], loop_stats['callback_time'])
+    add('torrentclient_loop_max_lag_seconds', 'gauge', [], loop_stats['max_lag'])
+    if stats.get('dht'):
+        add('torrentclient_dht_nodes', 'gauge', [], stats['dht']['nodes'])
+        add('torrentclient_dht_stored_peers', 'gauge', [], stats['dht']['stored_peers'])
+        add('torrentclient_dht_queries_sent_total', 'counter', [], stats['dht']['queries_sent'])
+        add('torrentclient_dht_queries_received_total', 'counter', [], stats['dht']['queries_received'])
+
+    cache = stats['cache']
+    add('torrentclient_cache_size_bytes', 'gauge', [], cache['size'])
+    add('torrentclient_cache_dirty_bytes', 'gauge', [], cache['dirty_bytes'])
+    add('torrentclient_cache_cached_bytes', 'gauge', [], cache['cached_bytes'])
+    add('torrentclient_cache_hits_total', 'counter', [], cache['hits'])
+    add('torrentclient_cache_misses_total', 'counter', [], cache['misses'])
+    add('torrentclient_cache_flushes_total', 'counter', [], cache['flushes'])
+    add('torrentclient_cache_writes_total', 'counter', [], cache['writes'])
+    add('torrentclient_cache_written_bytes_total', 'counter', [], cache['bytes_written'])
+    add('torrentclient_cache_flush_seconds', 'histogram', [], cache['flush_time'])
+    if stats.get('stream'):
+        add('torrentclient_stream_requests_total', 'counter', [], stats['stream']['requests'])
+        add('torrentclient_stream_sent_bytes_total', 'counter', [], stats['stream']['bytes_sent'])
+        add('torrentclient_stream_stalls_total', 'counter', [], stats['stream']['stalls'])
+        add('torrentclient_stream_stall_seconds_total', 'counter', [], stats['stream']['stall_time'])
+        add('torrentclient_stream_active', 'gauge', [], stats['stream']['streams'])
+        add('torrentclient_stream_first_byte_seconds', 'histogram', [], stats['stream']['first_byte_time'])
+
+    for t in stats['torrents']:
+        labels = [('torrent', t['name'])]
+        for key in ('downloaded', 'uploaded', 'hash_failures', 'pieces_hashed', 'pex_peers_received'):
+            add('torrentclient_torrent_%s_total' % key, 'counter', labels, t[key])
+        add('torrentclient_torrent_hash_seconds_total', 'counter', labels, t['hash_time'])
+        for key in ('pieces_complete', 'pieces_total', 'pieces_wanted', 'left', 'num_peers', 'known_peers'):
+            add('torrentclient_torrent_%s' % key, 'gauge', labels, t[key])
+        add('torrentclient_torrent_download_rate_bytes', 'gauge', labels, t['download_rate'])
+        add('torrentclient_torrent_endgame', 'gauge', labels, t['endgame'])
+        add('torrentclient_piece_latency_seconds', 'histogram', labels, t['piece_latency'])
+        add('torrentclient_piece_hash_seconds', 'histogram', labels, t['piece_hash_time'])
+        for p in t['peers']:
+            peer_labels = labels + [('peer', '%s:%d' % (p['ip'], p['port']))]
+            add('torrentclient_peer_download_rate_bytes', 'gauge', peer_labels, p['download_rate'])
+            add('torrentclient_peer_upload_rate_bytes', 'gauge', peer_labels, p['upload_rate'])
+            add('torrentclient_peer_downloaded_bytes_total', 'counter', peer_labels, p['downloaded'])
+            add('torrentclient_peer_uploaded_bytes_total', 'counter', peer_labels, p['uploaded'])
+            add('torrentclient_peer_requests_outstanding', 'gauge', peer_labels, p['requests_outstanding'])
+            add('torrentclient_peer_request_queue_depth', 'gauge', peer_labels, p['request_queue_depth'])
+            add('torrentclient_peer_rtt_seconds', 'gauge', peer_labels, p['rtt'])
+            add('torrentclient_peer_snubbed', 'gauge', peer_labels, p['snubbed'])
+            add('torrentclient_peer_choked', 'gauge', peer_labels, p['peer_choking'])
+
+    lines = []
+    for (name, (kind, samples)) in metrics.items():
+        lines.append('# TYPE %s %s' % (name, kind))
+        for (labels, value) in samples:
+            if kind != 'histogram':
+                lines.append('%s%s %s' % (name, format_labels(labels), value))
+                continue
+            cumulative = 0
+            for (bound, count) in zip(value['buckets'] + ['+Inf'], value['counts']):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels + [('le', bound)]), cumulative))
+            lines.append('%s_sum%s %s' % (name, format_labels(labels), value['sum']))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), value['count']))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,310 @@
+import os
+import mmap
+import struct
+import hashlib
+import logging
+
+from settings import SETTINGS
+
+log = logging.getLogger(__name__)
+
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+
+class Storage():
+    def __init__(self, metainfo, output_destination=None, allocation=None):
+        self.metainfo = metainfo
+        self.base_dir = os.path.expanduser(output_destination) if output_destination else ''
+        self.allocation = allocation or SETTINGS['allocation']
+        self.fds = []
+        self.found_data = False
+        self.read_maps = {}
+        self.files = [{'path': os.path.join(self.base_dir, f['path']),
+                       'length': f['length'],
+                       'offset': f['offset']}
+                      for f in metainfo.files]
+        self.part_file = PartFile(os.path.join(self.base_dir, os.path.basename(metainfo.name)) + '.parts',
+                                  len(metainfo.info['pieces']), metainfo.info['piece_length'])
+
+    def open(self, skipped_files=()):
+        # Skipped files are not created; the parts of their boundary pieces
+        # go to the partfile. One that already exists is used as it is.
+        self.fds = [None] * len(self.files)
+        self.part_file.open()
+        try:
+            self.allocate_files([i for (i, f) in enumerate(self.files)
+                                 if i not in skipped_files or os.path.exists(f['path'])])
+        except (OSError, StorageError):
+            self.close()
+            raise
+        if self.allocation != 'full':
+            self.check_free_space()
+
+    def open_file(self, file_index):
+        f = self.files[file_index]
+        dirname = os.path.dirname(f['path'])
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        fd = os.open(f['path'], os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(fd).st_size
+        if size:
+            self.found_data = True
+        if size > f['length']:
+            os.ftruncate(fd, f['length'])
+        try:
+            self.allocate(fd, f, size)
+        except OSError as e:
+            os.close(fd)
+            raise StorageError('Cannot allocate %d bytes for %s: %s' % (f['length'], f['path'], e.strerror))
+        self.fds[file_index] = fd
+
+    def allocate(self, fd, f, size):
+        # sparse sets the length so that files do not grow piece by piece;
+        # full also reserves the blocks, so a full disk fails here.
+        mode = self.allocation
+        if mode == 'full' and not hasattr(os, 'posix_fallocate'):
+            mode = 'sparse'
+        if mode == 'full' and f['length']:
+            os.posix_fallocate(fd, 0, f['length'])
+        elif mode == 'sparse' and size < f['length']:
+            os.ftruncate(fd, f['length'])
+
+    def check_free_space(self):
+        # Blocks of sparse and growing files are only taken as pieces are
+        # written, so running out of space is only warned about.
+        needed = 0
+        for (fd, f) in zip(self.fds, self.files):
+            if fd is not None:
+                needed += max(0, f['length'] - os.fstat(fd).st_blocks * 512)
+        st = os.statvfs(self.base_dir or '.')
+        if needed > st.f_bavail * st.f_frsize:
+            log.warning('%s needs %d MiB more but only %d MiB are free' % (
+                self.metainfo.name, needed // 2**20, st.f_bavail * st.f_frsize // 2**20))
+
+    def allocate_files(self, file_indexes):
+        # Only a file created here can have parts waiting in the partfile;
+        # skipped files that already existed took their writes directly.
+        for file_index in file_indexes:
+            if self.fds[file_index] is None:
+                exists = os.path.exists(self.files[file_index]['path'])
+                self.open_file(file_index)
+                if not exists:
+                    self.export_parts(file_index)
+
+    def export_parts(self, file_index):
+        # Move the parts of a newly allocated file out of the partfile, and
+        # free the pieces that no longer touch a skipped file.
+        for piece_index in list(self.part_file.slots):
+            pos = 0
+            in_part_file = False
+            for (seg_file_index, file_offset, seg_length) in self.metainfo.piece_segments(piece_index):
+                if seg_file_index == file_index:
+                    data = self.part_file.read(piece_index, pos, seg_length)
+                    if data is not None:
+                        self.pwrite(self.fds[file_index], memoryview(data), file_offset)
+                elif self.fds[seg_file_index] is None:
+                    in_part_file = True
+                pos += seg_length
+            if not in_part_file:
+                self.part_file.free(piece_index)
+
+    def close(self):
+        # Blocks still queued in transports keep their mmap alive, so the
+        # maps are dropped rather than closed.
+        self.read_maps = {}
+        for fd in self.fds:
+            if fd is not None:
+                os.close(fd)
+        self.fds = []
+        self.part_file.close()
+
+    def write_piece(self, piece_index, data):
+        return self.write_pieces(piece_index, [data])
+
+    def write_pieces(self, piece_index, buffers):
+        # A run of consecutive pieces, written with one pwritev per file it
+        # touches. Returns the number of writes.
+        views = [memoryview(b) for b in buffers]
+        length = sum(len(v) for v in views)
+        piece_length = self.metainfo.info['piece_length']
+        offset = piece_index * piece_length
+        pos = 0
+        num_writes = 0
+        for (file_index, file_offset, seg_length) in self.metainfo.segments(offset, length):
+            if self.fds[file_index] is None:
+                end = pos + seg_length
+                while pos < end:
+                    (part_index, begin) = divmod(offset + pos, piece_length)
+                    nbytes = min(piece_length - begin, end - pos)
+                    self.part_file.write(part_index, begin, memoryview(b''.join(gather(views, pos, nbytes))))
+                    pos += nbytes
+                    num_writes += 1
+                continue
+            self.pwritev(self.fds[file_index], gather(views, pos, seg_length), file_offset)
+            pos += seg_length
+            num_writes += 1
+        if pos != length:
+            raise StorageError('Pieces %d-%d extend past end of torrent' % (piece_index, piece_index + len(views) - 1))
+        return num_writes
+
+    def read_block(self, piece_index, begin, length):
+        views = []
+        pos = begin
+        for (file_index, file_offset, seg_length) in self.metainfo.piece_segments(piece_index, begin, length):
+            if self.fds[file_index] is None:
+                data = self.part_file.read(piece_index, pos, seg_length)
+                if data is None:
+                    raise StorageError('Piece %d is not in the partfile' % piece_index)
+                views.append(data)
+            else:
+                view = self.get_read_map(file_index, file_offset + seg_length)
+                views.append(view[file_offset:file_offset+seg_length])
+            pos += seg_length
+        if len(views) == 1:
+            return views[0]
+        return b''.join(views)
+
+    def get_read_map(self, file_index, min_size):
+        view = self.read_maps.get(file_index)
+        if view is None or len(view) < min_size:
+            size = os.fstat(self.fds[file_index]).st_size
+            if size < min_size:
+                raise StorageError('Read past end of %s' % self.files[file_index]['path'])
+            mm = mmap.mmap(self.fds[file_index], size, access=mmap.ACCESS_READ)
+            view = memoryview(mm)
+            self.read_maps[file_index] = view
+        return view
+
+    def has_data(self):
+        # Allocated files have their full size from the start, so only what
+        # was on disk before opening counts.
+        return bool(self.part_file.slots) or self.found_data
+
+    def map_files(self):
+        maps = []
+        for fd in self.fds:
+            if fd is None:
+                maps.append(None)
+                continue
+            size = os.fstat(fd).st_size
+            maps.append(mmap.mmap(fd, size, access=mmap.ACCESS_READ) if size else None)
+        return maps
+
+    @staticmethod
+    def unmap_files(maps):
+        for mm in maps:
+            if mm is not None:
+                mm.close()
+
+    def check_piece(self, maps, piece_index):
+        sha = hashlib.sha1()
+        pos = 0
+        for (file_index, file_offset, seg_length) in self.metainfo.piece_segments(piece_index):
+            mm = maps[file_index]
+            if self.fds[file_index] is None:
+                data = self.part_file.read(piece_index, pos, seg_length)
+                if data is None:
+                    return False
+                sha.update(data)
+            elif mm is None or file_offset + seg_length > len(mm):
+                return False
+            else:
+                with memoryview(mm) as view:
+                    sha.update(view[file_offset:file_offset+seg_length])
+            pos += seg_length
+        return sha.digest() == self.metainfo.info['pieces'][piece_index]
+
+    @staticmethod
+    def pwrite(fd, view, offset):
+        while view:
+            nbytes = os.pwrite(fd, view, offset)
+            view = view[nbytes:]
+            offset += nbytes
+
+    @staticmethod
+    def pwritev(fd, views, offset):
+        while views:
+            nbytes = os.pwritev(fd, views[:IOV_MAX], offset)
+            offset += nbytes
+            while views and nbytes >= len(views[0]):
+                nbytes -= len(views[0])
+                views.pop(0)
+            if nbytes:
+                views[0] = views[0][nbytes:]
+
+
+def gather(views, pos, length):
+    # Slices of views, taken as one buffer, covering pos to pos + length.
+    chunks = []
+    for view in views:
+        if pos >= len(view):
+            pos -= len(view)
+            continue
+        chunk = view[pos:pos+length]
+        chunks.append(chunk)
+        length -= len(chunk)
+        pos = 0
+        if not length:
+            break
+    return chunks
+
+
+class PartFile():
+    # Slots of one piece length after a header that maps each piece to its
+    # slot, stored as slot + 1 so that zero means none.
+    SLOT = struct.Struct('!L')
+
+    def __init__(self, path, num_pieces, piece_length):
+        self.path = path
+        self.piece_length = piece_length
+        self.header_size = num_pieces * self.SLOT.size
+        self.fd = None
+        self.slots = {}
+
+    def open(self):
+        if not os.path.exists(self.path):
+            return
+        self.fd = os.open(self.path, os.O_RDWR)
+        header = os.pread(self.fd, self.header_size, 0)
+        for (piece_index, (slot,)) in enumerate(self.SLOT.iter_unpack(header[:len(header) - len(header) % self.SLOT.size])):
+            if slot:
+                self.slots[piece_index] = slot - 1
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def write(self, piece_index, offset, view):
+        if self.fd is None:
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.ftruncate(self.fd, self.header_size)
+        slot = self.slots.get(piece_index)
+        if slot is None:
+            used = set(self.slots.values())
+            slot = next(i for i in range(len(used) + 1) if i not in used)
+            self.slots[piece_index] = slot
+            os.pwrite(self.fd, self.SLOT.pack(slot + 1), piece_index * self.SLOT.size)
+        Storage.pwrite(self.fd, view, self.header_size + slot * self.piece_length + offset)
+
+    def read(self, piece_index, offset, length):
+        slot = self.slots.get(piece_index)
+        if slot is None:
+            return None
+        data = os.pread(self.fd, length, self.header_size + slot * self.piece_length + offset)
+        return data if len(data) == length else None
+
+    def free(self, piece_index):
+        if self.slots.pop(piece_index, None) is None:
+            return
+        if self.slots:
+            os.pwrite(self.fd, self.SLOT.pack(0), piece_index * self.SLOT.size)
+            return
+        self.close()
+        os.remove(self.path)
+
+class StorageError(Exception):
+    pass
@@ -0,0 +1,234 @@
+import os
+import time
+import asyncio
+import logging
+
+from settings import SETTINGS
+from picker import SKIP, NORMAL
+from stats import Histogram, LATENCY_BUCKETS
+from torrent import file_paths, FilePriorityError, TorrentStoppedError
+
+log = logging.getLogger(__name__)
+
+
+class StreamServer():
+    # Serves the files of every torrent over HTTP with Range support. Reads
+    # wait for the pieces they cover and set deadlines on them so that the
+    # picker fetches them first.
+    def __init__(self, client):
+        self.client = client
+        self.server = None
+        self.port = None
+        self.requests = 0
+        self.bytes_sent = 0
+        self.num_streams = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.first_byte_time = Histogram(LATENCY_BUCKETS)
+
+    def start(self, port):
+        self.client.conn_man.loop.create_task(self.open_server(port))
+
+    async def open_server(self, port):
+        try:
+            self.server = await asyncio.start_server(self.handle_request, SETTINGS['stream_host'], port)
+        except OSError as e:
+            log.warning('Cannot serve streams on port %d: %s' % (port, e))
+            return
+        self.port = self.server.sockets[0].getsockname()[1]
+        log.info('Streaming on http://%s:%d/' % (SETTINGS['stream_host'], self.port))
+
+    def stop(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+
+    def find_torrent(self, info_hash_hex):
+        for torrent in self.client.active_torrent + self.client.finished_torrent + self.client.queued_torrent:
+            if torrent.metainfo.info_hash.hex() == info_hash_hex:
+                return torrent
+        return None
+
+    def file_urls(self):
+        urls = []
+        port = self.port or SETTINGS['stream_port']
+        for torrent in self.client.active_torrent + self.client.finished_torrent + self.client.queued_torrent:
+            for (file_index, path) in enumerate(file_paths(torrent.metainfo)):
+                urls.append('http://%s:%d/%s/%d/%s' % (SETTINGS['stream_host'], port,
+                                                       torrent.metainfo.info_hash.hex(), file_index,
+                                                       os.path.basename(path)))
+        return urls
+
+    async def handle_request(self, reader, writer):
+        start = time.monotonic()
+        self.requests += 1
+        try:
+            request_line = await reader.readline()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                (name, _, value) = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            parts = request_line.decode('latin-1').split()
+            (method, path) = (parts[0], parts[1].split('?')[0]) if len(parts) > 1 else ('', '')
+            if method not in ('GET', 'HEAD'):
+                self.send_error(writer, '405 Method Not Allowed')
+            elif path == '/':
+                body = ''.join(url + '\n' for url in self.file_urls()).encode('utf-8')
+                self.send_head(writer, '200 OK', [('Content-Type', 'text/plain; charset=utf-8'),
+                                                  ('Content-Length', len(body))])
+                if method == 'GET':
+                    writer.write(body)
+            else:
+                await self.handle_file(writer, method, path, headers.get('range'), start)
+            await writer.drain()
+        except (ConnectionError, TorrentStoppedError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_file(self, writer, method, path, range_header, start):
+        # /<info hash>/<file index>[/<name>]; the name is only there for players.
+        parts = path.strip('/').split('/')
+        torrent = self.find_torrent(parts[0]) if len(parts) >= 2 else None
+        if torrent is None or not parts[1].isdigit() or int(parts[1]) >= len(torrent.metainfo.files):
+            self.send_error(writer, '404 Not Found')
+            return
+        file_index = int(parts[1])
+        size = torrent.metainfo.files[file_index]['length']
+        try:
+            byte_range = parse_range(range_header, size)
+        except StreamRangeError:
+            self.send_error(writer, '416 Range Not Satisfiable', [('Content-Range', 'bytes */%d' % size)])
+            return
+        if torrent.file_priorities[file_index] == SKIP:
+            priorities = list(torrent.file_priorities)
+            priorities[file_index] = NORMAL
+            try:
+                self.client.set_file_priorities(torrent, priorities)
+            except FilePriorityError as e:
+                self.send_error(writer, '503 Service Unavailable')
+                log.info('Cannot stream %s: %s' % (path, e))
+                return
+
+        headers = [('Content-Type', 'application/octet-stream'), ('Accept-Ranges', 'bytes')]
+        if byte_range is None:
+            (first, last) = (0, size - 1)
+            status = '200 OK'
+        else:
+            (first, last) = byte_range
+            status = '206 Partial Content'
+            headers.append(('Content-Range', 'bytes %d-%d/%d' % (first, last, size)))
+        headers.append(('Content-Length', last - first + 1))
+        self.send_head(writer, status, headers)
+        if method == 'GET' and last >= first:
+            await self.send_range(writer, torrent, file_index, first, last, start)
+
+    async def send_range(self, writer, torrent, file_index, first, last, start):
+        piece_length = torrent.metainfo.info['piece_length']
+        offset = torrent.metainfo.files[file_index]['offset']
+        readahead = Readahead(torrent, (offset + last) // piece_length)
+        self.num_streams += 1
+        sent = 0
+        try:
+            pos = first
+            while pos <= last:
+                if torrent.is_stopped:
+                    raise TorrentStoppedError('%s was stopped' % torrent.metainfo.name)
+                piece_index = (offset + pos) // piece_length
+                readahead.move(piece_index)
+                if not torrent.complete_pieces[piece_index]:
+                    waited = time.monotonic()
+                    await torrent.wait_for_piece(piece_index)
+                    if sent:
+                        self.stalls += 1
+                        self.stall_time += time.monotonic() - waited
+                begin = offset + pos - piece_index * piece_length
+                length = min(torrent.metainfo.get_piece_length(piece_index) - begin, last + 1 - pos)
+                writer.write(torrent.read_block(piece_index, begin, length))
+                if not sent:
+                    self.first_byte_time.observe(time.monotonic() - start)
+                sent += length
+                self.bytes_sent += length
+                pos += length
+                await writer.drain()
+        finally:
+            readahead.close()
+            self.num_streams -= 1
+
+    @staticmethod
+    def send_head(writer, status, headers):
+        lines = ['HTTP/1.1 %s' % status] + ['%s: %s' % header for header in headers] + ['Connection: close', '', '']
+        writer.write('\r\n'.join(lines).encode('latin-1'))
+
+    def send_error(self, writer, status, headers=()):
+        body = (status + '\n').encode('latin-1')
+        self.send_head(writer, status, [('Content-Type', 'text/plain'), ('Content-Length', len(body))] + list(headers))
+        writer.write(body)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'streams': self.num_streams,
+            'bytes_sent': self.bytes_sent,
+            'stalls': self.stalls,
+            'stall_time': self.stall_time,
+            'first_byte_time': self.first_byte_time.snapshot(),
+        }
+
+
+class Readahead():
+    # The deadlines one reader holds: the piece under its cursor is due now
+    # and the ones after it, up to stream_readahead bytes, follow at
+    # stream_deadline_interval apart.
+    def __init__(self, torrent, last_piece):
+        self.torrent = torrent
+        self.last_piece = last_piece
+        self.cursor = None
+        self.pieces = []
+
+    def move(self, piece_index):
+        if piece_index == self.cursor:
+            return
+        self.cursor = piece_index
+        picker = self.torrent.picker
+        num_pieces = max(1, SETTINGS['stream_readahead'] // self.torrent.metainfo.info['piece_length'])
+        window = range(piece_index, min(piece_index + num_pieces, self.last_piece + 1))
+        for p in self.pieces:
+            if p not in window:
+                picker.clear_deadline(p, self)
+        now = time.monotonic()
+        for (i, p) in enumerate(window):
+            picker.set_deadline(p, now + i * SETTINGS['stream_deadline_interval'], self)
+        self.pieces = window
+        self.torrent.resume_idle_peers()
+
+    def close(self):
+        for p in self.pieces:
+            self.torrent.picker.clear_deadline(p, self)
+        self.pieces = []
+
+
+def parse_range(value, size):
+    # A single byte range as (first, last), or None to send the whole file.
+    # Other forms are ignored, which RFC 7233 allows.
+    if not value or not value.startswith('bytes=') or ',' in value:
+        return None
+    (first, _, last) = value[len('bytes='):].strip().partition('-')
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0 or not size:
+                raise StreamRangeError('Empty suffix range')
+            return (max(0, size - suffix), size - 1)
+        (first, last) = (int(first), int(last) if last else size - 1)
+    except ValueError:
+        return None
+    if first >= size or last < first:
+        raise StreamRangeError('Range %s outside %d bytes' % (value, size))
+    return (first, min(last, size - 1))
+
+class StreamRangeError(Exception):
+    pass
@@ -0,0 +1,271 @@
+import asyncio
+import logging
+import multiprocessing
+
+from settings import SETTINGS
+from client import Client
+from metainfo import Metainfo
+from storage import StorageError
+from stats import Histogram, LOOP_BUCKETS, StatsServer
+
+log = logging.getLogger(__name__)
+
+
+class Supervisor():
+    # Runs torrents in worker processes, each with its own Client, so that
+    # hashing and parsing spread over several cores. Workers report their
+    # stats over a pipe and get back their share of the global limits.
+    def __init__(self, torrents, num_workers, output_destination=None, file_rules=()):
+        self.loop = asyncio.new_event_loop()
+        self.output_destination = output_destination
+        self.file_rules = file_rules
+        self.workers = [Worker(i) for i in range(min(num_workers, len(torrents)))]
+        self.assign(torrents)
+        self.stats_server = StatsServer(self.loop, self.stats)
+        self.timer = None
+
+    def assign(self, torrents):
+        # Largest first, each to the worker with the fewest bytes so far.
+        sizes = dict((filename, torrent_size(filename)) for filename in torrents)
+        for filename in sorted(torrents, key=sizes.get, reverse=True):
+            worker = min(self.workers, key=lambda w: w.size)
+            worker.torrents.append(filename)
+            worker.size += sizes[filename]
+
+    def run(self):
+        # Spawned workers do not inherit the event loop or threads of this
+        # process; their settings are passed along instead.
+        context = multiprocessing.get_context('spawn')
+        weights = [len(w.torrents) for w in self.workers]
+        active = share_limit(SETTINGS['max_active_torrents'], weights, floor=1)
+        download = share_limit(SETTINGS['download_rate_limit'], weights)
+        upload = share_limit(SETTINGS['upload_rate_limit'], weights)
+        connections = share_limit(SETTINGS['max_connections'], weights, floor=1)
+        for (i, worker) in enumerate(self.workers):
+            worker.limits = (download[i], upload[i], connections[i])
+            settings = dict(SETTINGS, max_active_torrents=active[i], download_rate_limit=download[i],
+                            upload_rate_limit=upload[i], max_connections=connections[i])
+            (worker.conn, child_conn) = context.Pipe()
+            worker.process = context.Process(target=run_worker,
+                                             args=(worker.index, worker.torrents, settings,
+                                                   self.output_destination, self.file_rules, child_conn))
+            worker.process.start()
+            child_conn.close()
+            self.loop.add_reader(worker.conn.fileno(), self.handle_message, worker)
+        if SETTINGS['stats_port']:
+            self.stats_server.start(SETTINGS['stats_port'])
+        self.timer = self.loop.call_later(SETTINGS['worker_report_interval'], self.run_limits)
+        try:
+            self.loop.run_forever()
+        finally:
+            if self.timer:
+                self.timer.cancel()
+            self.stats_server.stop()
+            for worker in self.workers:
+                if worker.conn:
+                    self.loop.remove_reader(worker.conn.fileno())
+                    worker.conn.close()
+                worker.process.join(SETTINGS['tracker_stop_timeout'] + 5.0)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+            self.loop.close()
+
+    def handle_message(self, worker):
+        try:
+            (kind, value) = worker.conn.recv()
+        except (EOFError, OSError):
+            self.handle_worker_exit(worker)
+            return
+        if kind in ('stats', 'done'):
+            worker.stats = value
+        if kind == 'done':
+            self.handle_worker_exit(worker)
+
+    def handle_worker_exit(self, worker):
+        self.loop.remove_reader(worker.conn.fileno())
+        worker.conn.close()
+        worker.conn = None
+        log.info('worker %d finished' % worker.index)
+        if all(w.conn is None for w in self.workers):
+            self.loop.stop()
+            return
+        self.run_limits(reschedule=False)
+
+    def run_limits(self, reschedule=True):
+        if reschedule:
+            self.timer = self.loop.call_later(SETTINGS['worker_report_interval'], self.run_limits)
+        workers = [w for w in self.workers if w.conn is not None]
+        demand = [w.demand() for w in workers]
+        download = share_limit(SETTINGS['download_rate_limit'], [d[0] for d in demand])
+        upload = share_limit(SETTINGS['upload_rate_limit'], [d[1] for d in demand])
+        connections = share_limit(SETTINGS['max_connections'], [d[2] for d in demand], floor=1)
+        for (worker, limits) in zip(workers, zip(download, upload, connections)):
+            if limits == worker.limits:
+                continue
+            worker.limits = limits
+            try:
+                worker.conn.send(('limits', limits))
+            except OSError:
+                pass
+
+    def stats(self):
+        stats = aggregate_stats([w.stats for w in self.workers if w.stats])
+        stats['workers'] = [{
+            'index': w.index,
+            'pid': w.process.pid if w.process else None,
+            'running': w.conn is not None,
+            'torrents': w.torrents,
+            'limits': w.limits,
+        } for w in self.workers]
+        return stats
+
+
+class Worker():
+    def __init__(self, index):
+        self.index = index
+        self.torrents = []
+        self.size = 0
+        self.process = None
+        self.conn = None
+        self.stats = None
+        self.limits = None
+
+    def demand(self):
+        # (download rate, upload rate, torrents still downloading)
+        if not self.stats:
+            return (0.0, 0.0, len(self.torrents))
+        torrents = self.stats['torrents']
+        download = sum(t['download_rate'] for t in torrents)
+        upload = sum(p['upload_rate'] or 0.0 for t in torrents for p in t['peers'])
+        downloading = sum(1 for t in torrents if t['left']) + len(self.stats['queued'])
+        return (download, upload, downloading)
+
+
+def torrent_size(filename):
+    with open(filename, 'rb') as f:
+        metainfo = Metainfo(f.read())
+    return sum(f['length'] for f in metainfo.files)
+
+
+def share_limit(total, weights, floor=0):
+    # Half of a limit is split evenly and half by what each worker used, so
+    # a worker that is held back by its share can still grow it. 0 is no
+    # limit.
+    if not total or not weights:
+        return [total] * len(weights)
+    even = total / 2.0 / len(weights)
+    spare = total - even * len(weights)
+    total_weight = sum(weights)
+    return [max(floor, int(even + (spare * w / total_weight if total_weight else spare / len(weights))))
+            for w in weights]
+
+
+def merge_histograms(snapshots, buckets):
+    merged = Histogram(buckets)
+    for snapshot in snapshots:
+        merged.counts = [a + b for (a, b) in zip(merged.counts, snapshot['counts'])]
+        merged.sum += snapshot['sum']
+        merged.count += snapshot['count']
+    return merged.snapshot()
+
+
+def aggregate_stats(reports):
+    # One Client.stats() shaped dict for all workers.
+    caches = [r['cache'] for r in reports]
+    cache = dict((key, sum(c[key] for c in caches))
+                 for key in ('size', 'dirty_bytes', 'cached_bytes', 'hits', 'misses', 'flushes', 'writes',
+                             'bytes_written'))
+    lookups = cache['hits'] + cache['misses']
+    cache['hit_rate'] = cache['hits'] / lookups if lookups else None
+    cache['flush_time'] = merge_histograms([c['flush_time'] for c in caches], LOOP_BUCKETS)
+    dhts = [r['dht'] for r in reports if r['dht']]
+    dht = None
+    if dhts:
+        dht = dict((key, sum(d[key] for d in dhts))
+                   for key in ('nodes', 'torrents', 'stored_peers', 'queries_sent', 'queries_received'))
+    return {
+        'loop': {
+            'lag': merge_histograms([r['loop']['lag'] for r in reports], LOOP_BUCKETS),
+            'max_lag': max([r['loop']['max_lag'] for r in reports] or [0.0]),
+            'callback_time': merge_histograms([r['loop']['callback_time'] for r in reports], LOOP_BUCKETS),
+        },
+        'torrents': [t for r in reports for t in r['torrents']],
+        'queued': [name for r in reports for name in r['queued']],
+        'dht': dht,
+        'stream': None,
+        'cache': cache,
+    }
+
+
+def run_worker(index, torrents, settings, output_destination, file_rules, conn):
+    SETTINGS.update(settings)
+    # Each worker listens on its own ports.
+    if SETTINGS['listen_port']:
+        SETTINGS['listen_port'] += index
+    if SETTINGS['dht_port']:
+        SETTINGS['dht_port'] += index
+    SETTINGS['stats_port'] = 0
+    client = Client(output_destination=output_destination)
+    try:
+        for filename in torrents:
+            client.add_torrent(filename, file_rules)
+    except StorageError as e:
+        log.error('%s: %s' % (filename, e))
+        conn.close()
+        return
+    link = WorkerLink(client, conn)
+    link.start()
+    try:
+        client.start_torrents()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        link.stop()
+
+
+class WorkerLink():
+    # The worker end of the pipe: stats go up, limits come down.
+    def __init__(self, client, conn):
+        self.client = client
+        self.conn = conn
+        self.loop = client.conn_man.loop
+        self.timer = None
+
+    def start(self):
+        self.loop.add_reader(self.conn.fileno(), self.handle_message)
+        self.timer = self.loop.call_later(SETTINGS['worker_report_interval'], self.report)
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.conn.closed:
+            return
+        self.loop.remove_reader(self.conn.fileno())
+        try:
+            self.conn.send(('done', self.client.stats()))
+        except OSError:
+            pass
+        self.conn.close()
+
+    def report(self):
+        try:
+            self.conn.send(('stats', self.client.stats()))
+        except OSError:
+            return
+        self.timer = self.loop.call_later(SETTINGS['worker_report_interval'], self.report)
+
+    def handle_message(self):
+        try:
+            (kind, value) = self.conn.recv()
+        except (EOFError, OSError):
+            # The supervisor is gone.
+            self.loop.remove_reader(self.conn.fileno())
+            self.conn.close()
+            self.client.on_all_torrent_completed()
+            return
+        if kind == 'limits':
+            (download, upload, connections) = value
+            self.client.scheduler.set_rate_limits(download, upload)
+            SETTINGS['max_connections'] = connections
+            self.client.scheduler.rebalance()
@@ -1,118 +1,534 @@
-import hashlib
+import time
+import fnmatch
 import logging
+import bitarray
+import collections
 
 from settings import SETTINGS
-from peer import Peer
-from tracker import Tracker
+from peer import PeerNoUnrequestedPiecesError
+from picker import PiecePicker, PRIORITIES, SKIP, NORMAL
+from registry import PeerRegistry
+from choker import Choker
+from rate import RateMeter
+from stats import Histogram, LATENCY_BUCKETS, HASH_TIME_BUCKETS
+from piece import PieceBuffer
+from resume import ResumeData, recheck
+from tracker import TrackerManager
+from pex import PeerExchange
 
 log = logging.getLogger(__name__)
 
 class Torrent():
-    def __init__(self, conn_man, metainfo, torrent_on_completed=None, piece_on_complete=None):
+    def __init__(self, conn_man, metainfo, storage, verifier, scheduler, torrent_on_completed=None, piece_on_complete=None,
+                 dht=None, file_priorities=None, cache=None, torrent_on_rechecked=None):
         self.metainfo = metainfo
         self.conn_man = conn_man
-        self.active_peers = []
-        self.peers = []
+        self.storage = storage
+        self.verifier = verifier
+        self.cache = cache
+        self.scheduler = scheduler
+        self.max_peers = SETTINGS['max_peers']
+        self.registry = PeerRegistry(self)
         self.tracker = None
+        self.dht = dht
+        self.pex = PeerExchange(self)
         self.is_complete = False
+        self.is_stopped = False
 
         self.torrent_on_completed = torrent_on_completed
         self.piece_on_complete = piece_on_complete
+        self.torrent_on_rechecked = torrent_on_rechecked
 
-        self.piece_blocks = [[] for _ in self.metainfo.info['pieces']]
-        self.piece_requests = [[] for _ in self.metainfo.info['pieces']]
-        self.complete_pieces = [None for _ in self.metainfo.info['pieces']]
+        self.piece_buffers = {}
+        self.partial_pieces = set()
+        self.piece_waiters = {}
+        self.picker = PiecePicker(len(self.metainfo.info['pieces']))
+        self.complete_pieces = bitarray.bitarray(len(self.metainfo.info['pieces']), endian='big')
+        self.complete_pieces.setall(False)
+        self.file_priorities = list(file_priorities or [NORMAL] * len(metainfo.files))
+        # Pieces we still want: not complete and overlapping a file that is
+        # not skipped.
+        self.wanted_pieces = None
+        self.apply_file_priorities()
+        self.pieces_hashed = 0
+        self.hash_failures = 0
+        self.hash_time = 0.0
+        self.recheck_rate = None
+        self.recheck_task = None
+        self.resume = ResumeData(storage, metainfo)
+        self.resume_timer = None
+        self.choker = Choker(self)
+        self.uploaded = 0
+        self.downloaded = 0
+        self.download_rate = RateMeter()
+
+        self.endgame_started = None
+        self.piece_start_times = {}
+        # Completion latency of the most recent 1% of pieces; once the
+        # torrent is done this is the tail that endgame mode targets.
+        num_tail = max(1, len(self.complete_pieces) // 100)
+        self.tail_latencies = collections.deque(maxlen=num_tail)
+        self.piece_latency = Histogram(LATENCY_BUCKETS)
+        self.piece_hash_time = Histogram(HASH_TIME_BUCKETS)
 
     def start_torrent(self):
-        self.tracker = Tracker(self, self.metainfo.announce)
-        self.tracker.announce_request()
-        for peer in self.peers[:SETTINGS['max_peers']]:
-            peer.connect()
+        complete_pieces = self.resume.load()
+        if complete_pieces is None and self.storage.has_data():
+            # Off the event loop; the torrent starts once it is done.
+            self.recheck_task = self.conn_man.loop.create_task(
+                recheck(self.storage, self.metainfo, self.conn_man.loop, self.verifier.executor))
+            self.recheck_task.add_done_callback(self.handle_recheck_done)
+            return
+        self.load_complete_pieces(complete_pieces)
+        self.start_transfers()
+
+    def handle_recheck_done(self, task):
+        if task.cancelled() or task is not self.recheck_task:
+            return
+        self.recheck_task = None
+        if task.exception():
+            log.error('%s: recheck failed: %r' % (self, task.exception()))
+            return
+        (complete_pieces, self.recheck_rate) = task.result()
+        self.load_complete_pieces(complete_pieces)
+        if self.torrent_on_rechecked:
+            self.torrent_on_rechecked(self)
+        self.start_transfers()
+
+    def start_transfers(self):
+        if not self.wanted_pieces.any():
+            self.handle_completed_torrent()
+            if not SETTINGS['seed']:
+                return
+        else:
+            self.schedule_resume_save()
+        self.choker.start()
+        self.tracker = TrackerManager(self)
+        self.tracker.start()
+        self.pex.start()
+        if self.dht:
+            self.dht.add_torrent(self)
+
+    def load_complete_pieces(self, complete_pieces):
+        if complete_pieces is None:
+            return
+        for (piece_index, complete) in enumerate(complete_pieces):
+            if complete:
+                self.complete_pieces[piece_index] = True
+                self.picker.mark_complete(piece_index)
+                # Readers that asked before the recheck finished.
+                for future in self.piece_waiters.pop(piece_index, ()):
+                    if not future.done():
+                        future.set_result(None)
+        self.wanted_pieces &= ~self.complete_pieces
+
+    def schedule_resume_save(self):
+        self.resume_timer = self.conn_man.loop.call_later(SETTINGS['resume_save_interval'], self.save_resume)
+
+    def save_resume(self):
+        # Pieces still waiting in the cache are not on disk yet.
+        complete_pieces = bitarray.bitarray(self.complete_pieces, endian='big')
+        for piece_index in self.cache.pending_pieces(self.storage):
+            complete_pieces[piece_index] = False
+        self.resume.save(complete_pieces)
+        self.schedule_resume_save()
+
+    def stop_torrent(self):
+        self.choker.stop()
+        self.registry.stop()
+        self.pex.stop()
+        if self.dht:
+            self.dht.remove_torrent(self)
+        if self.tracker:
+            self.tracker.stop()
+        if self.resume_timer:
+            self.resume_timer.cancel()
+            self.resume_timer = None
+        self.cache.flush_storage(self.storage)
+        if self.recheck_task:
+            # Nothing is known about the pieces yet, so the resume data is
+            # left as it was.
+            self.recheck_task.cancel()
+            self.recheck_task = None
+            return
+        self.resume.save(self.complete_pieces)
+
+    def close_torrent(self):
+        # Stops the torrent for good while the event loop keeps running for
+        # the others: peers are dropped and the files closed.
+        self.stop_torrent()
+        self.is_stopped = True
+        self.fail_piece_waiters()
+        for p in list(self.registry.active):
+            p.disconnect()
+        self.cache.close_storage(self.storage)
+        self.storage.close()
 
     def add_peer(self, peer_dict):
-        peer = self.find_peer(**peer_dict)
-        if peer:
-            return peer
-        peer = Peer(self, **peer_dict)
-        self.peers.append(peer)
-        return peer
-
-    def find_peer(self, ip, port, **kwargs):
-        for peer_list in (self.active_peers, self.peers):
-            for v in peer_list:
-                if v.ip == ip and v.port == port:
-                    return v
+        return self.registry.add(**peer_dict)
+
+    def handle_incoming_connection(self, ip, port):
+        if self.recheck_task or self.num_connected() >= self.max_peers:
+            return None
+        return self.registry.accept(ip, port)
+
+    def next_request(self, peer):
+        peer_pieces = peer.requestable_pieces()
+        if self.picker.deadlines:
+            request = self.next_deadline_request(peer, peer_pieces)
+            if request is not None:
+                return request
+        for piece_index in self.partial_pieces:
+            if peer_pieces[piece_index]:
+                break
+        else:
+            piece_index = self.pick_suggested(peer, peer_pieces)
+            if piece_index is None:
+                piece_index = self.picker.pick(peer_pieces)
+            if piece_index is None:
+                return self.next_endgame_request(peer, peer_pieces)
+            self.start_piece(piece_index)
+
+        piece_buffer = self.piece_buffers[piece_index]
+        (begin, length) = piece_buffer.next_request()
+        if not piece_buffer.has_unrequested():
+            self.partial_pieces.discard(piece_index)
+        return (piece_index, begin, length)
+
+    def next_deadline_request(self, peer, peer_pieces):
+        # Blocks of the most urgent pieces go first. Once a piece is overdue,
+        # blocks still outstanding at other peers are asked for again.
+        now = time.monotonic()
+        for piece_index in self.picker.urgent_pieces():
+            if not peer_pieces[piece_index]:
+                continue
+            piece_buffer = self.piece_buffers.get(piece_index)
+            if piece_buffer is None:
+                if not self.picker.is_free(piece_index):
+                    continue
+                self.start_piece(piece_index)
+                piece_buffer = self.piece_buffers[piece_index]
+            if piece_buffer.has_unrequested():
+                (begin, length) = piece_buffer.next_request()
+                if not piece_buffer.has_unrequested():
+                    self.partial_pieces.discard(piece_index)
+                return (piece_index, begin, length)
+            if self.picker.deadlines[piece_index] <= now and not piece_buffer.is_complete():
+                for (begin, length) in piece_buffer.outstanding_requests():
+                    if (piece_index, begin) not in peer.outstanding_requests:
+                        return (piece_index, begin, length)
         return None
 
+    def pick_suggested(self, peer, peer_pieces):
+        while peer.suggested_pieces:
+            piece_index = peer.suggested_pieces.popleft()
+            if peer_pieces[piece_index] and self.picker.is_free(piece_index):
+                return piece_index
+        return None
+
+    def in_endgame(self):
+        # Endgame starts once every remaining block has been requested.
+        return SETTINGS['endgame'] and self.picker.num_free == 0 and not self.partial_pieces
+
+    def next_endgame_request(self, peer, peer_pieces):
+        if not self.in_endgame():
+            raise PeerNoUnrequestedPiecesError
+        if self.endgame_started is None:
+            self.endgame_started = time.monotonic()
+            log.info('%s: entering endgame with %d pieces in flight' % (self, len(self.piece_buffers)))
+            self.resume_idle_peers()
+        for (piece_index, piece_buffer) in self.piece_buffers.items():
+            if not peer_pieces[piece_index] or piece_buffer.is_complete():
+                continue
+            for (begin, length) in piece_buffer.outstanding_requests():
+                if (piece_index, begin) not in peer.outstanding_requests:
+                    return (piece_index, begin, length)
+        raise PeerNoUnrequestedPiecesError
+
+    def cancel_duplicate_requests(self, peer, piece_index, begin, length):
+        for p in list(self.registry.active):
+            if p is not peer and (piece_index, begin) in p.outstanding_requests:
+                p.cancel_request(piece_index, begin, length)
+
+    def start_piece(self, piece_index):
+        piece_length = self.metainfo.get_piece_length(piece_index)
+        self.piece_buffers[piece_index] = PieceBuffer(piece_index, piece_length, SETTINGS['block_length'])
+        self.partial_pieces.add(piece_index)
+        self.picker.mark_active(piece_index)
+        self.piece_start_times.setdefault(piece_index, time.monotonic())
+
+    def release_requests(self, peer):
+        for (piece_index, begin) in peer.outstanding_requests:
+            self.release_request(piece_index, begin)
+
+    def release_request(self, piece_index, begin):
+        piece_buffer = self.piece_buffers.get(piece_index)
+        if piece_buffer is not None and piece_buffer.release(begin):
+            self.partial_pieces.add(piece_index)
+
     def handle_block(self, peer, piece_index, begin, block):
-        if self.complete_pieces[piece_index]:
+        piece_buffer = self.piece_buffers.get(piece_index)
+        if piece_buffer is None:
             return
-        for v in self.piece_blocks[piece_index]:
-            if v[0] == begin:
-                peer.request_new_block(piece_index, begin)
-                return
-        self.piece_blocks[piece_index].append((begin, block))
-
-        expected_length = self.metainfo.get_piece_length(piece_index)
-        piece_length = sum(len(v[1]) for v in self.piece_blocks[piece_index])
-        if piece_length == expected_length:
+        self.downloaded += len(block)
+        self.download_rate.update(len(block))
+        if not piece_buffer.add_block(begin, block):
+            return
+        # A released block may arrive from another peer that was also asked
+        # for it, leaving nothing to request.
+        if not piece_buffer.has_unrequested():
+            self.partial_pieces.discard(piece_index)
+        piece_buffer.sources[begin // piece_buffer.block_length] = peer
+        if self.endgame_started is not None or piece_index in self.picker.deadlines:
+            self.cancel_duplicate_requests(peer, piece_index, begin, len(block))
+        if piece_buffer.is_complete():
             self.handle_completed_piece(peer, piece_index)
-        else:
-            peer.request_new_block(piece_index, begin)
 
     def handle_completed_piece(self, peer, piece_index):
-        if self.complete_pieces[piece_index] is not None:
+        if self.complete_pieces[piece_index]:
             log.warning('Piece %d already completed' % piece_index)
             return
-        self.piece_blocks[piece_index].sort(key=lambda v: v[0])
-        blocks = [v[1] for v in self.piece_blocks[piece_index]]
-        piece = bytes(v for block in blocks for v in block)
-        piece_sha = hashlib.sha1(piece).digest()
-        isSame_sha = self.metainfo.info['pieces'][piece_index]
-        if piece_sha != isSame_sha:
-            raise TorrentPieceError('Piece %d sha mismatch')
-        self.complete_pieces[piece_index] = piece
-        self.piece_blocks[piece_index] = None
-        for p in self.piece_requests[piece_index]:
-            if p.requested_piece == piece_index:
-                p.requested_piece = None
-            if p != peer:
-                pass
-        self.piece_requests[piece_index] = None
+        piece = self.piece_buffers[piece_index].data
+        expected_sha = self.metainfo.info['pieces'][piece_index]
+        self.verifier.submit(piece, expected_sha,
+                             lambda is_valid, hash_time: self.handle_piece_verified(peer, piece_index, is_valid, hash_time))
+
+    def handle_piece_verified(self, peer, piece_index, is_valid, hash_time):
+        self.pieces_hashed += 1
+        self.hash_time += hash_time
+        self.piece_hash_time.observe(hash_time)
+        if self.is_complete or self.is_stopped or piece_index not in self.piece_buffers:
+            return
+        if not is_valid:
+            self.handle_failed_piece(peer, piece_index)
+            return
+        self.cache.write_piece(self.storage, piece_index, self.piece_buffers[piece_index].data)
+        self.registry.handle_piece_verified(self.piece_buffers[piece_index])
+        self.complete_pieces[piece_index] = True
+        self.wanted_pieces[piece_index] = False
+        self.picker.mark_complete(piece_index)
+        del self.piece_buffers[piece_index]
+        self.partial_pieces.discard(piece_index)
+        latency = time.monotonic() - self.piece_start_times.pop(piece_index)
+        self.tail_latencies.append(latency)
+        self.piece_latency.observe(latency)
         log.debug('handle_completed_piece: %d' % piece_index)
+        for future in self.piece_waiters.pop(piece_index, ()):
+            if not future.done():
+                future.set_result(None)
+        for p in list(self.registry.active):
+            p.handle_piece_completed(piece_index)
         if self.piece_on_complete:
             self.piece_on_complete(self)
-        peer.run_download()
-        if not any(v is None for v in self.complete_pieces):
+        if not self.wanted_pieces.any():
             self.handle_completed_torrent()
 
-    def progress_bar(self):
-        num_complete = sum(v is not None for v in self.complete_pieces)
+    def read_block(self, piece_index, begin, length):
+        return self.cache.read_block(self.storage, piece_index, begin, length)
+
+    def fail_piece_waiters(self):
+        # Readers still waiting would otherwise hang once nothing downloads.
+        for futures in self.piece_waiters.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(TorrentStoppedError('%s was stopped' % self.metainfo.name))
+        self.piece_waiters = {}
+
+    def wait_for_piece(self, piece_index):
+        future = self.conn_man.loop.create_future()
+        self.piece_waiters.setdefault(piece_index, []).append(future)
+        return future
+
+    def handle_failed_piece(self, peer, piece_index):
+        log.info('handle_failed_piece: %d sha mismatch, last block from %s' % (piece_index, peer))
+        self.hash_failures += 1
+        piece_buffer = self.piece_buffers.pop(piece_index)
+        self.partial_pieces.discard(piece_index)
+        self.picker.mark_free(piece_index)
+        self.registry.handle_hash_failure(piece_buffer)
+        self.resume_idle_peers()
+
+    def resume_idle_peers(self):
+        for p in list(self.registry.active):
+            if (p.conn and p.is_started and (not p.peer_choking or p.supports_fast)
+                    and not p.outstanding_requests):
+                p.request_blocks()
+
+    def peer_is_interesting(self, peer):
+        return (peer.peer_pieces & self.wanted_pieces).any()
+
+    def piece_priorities(self):
+        # A piece gets the highest priority of the files it overlaps, so
+        # pieces shared with a skipped file are still fetched for the other.
+        piece_length = self.metainfo.info['piece_length']
+        priorities = bytearray(len(self.complete_pieces))
+        for (f, priority) in zip(self.metainfo.files, self.file_priorities):
+            if priority == SKIP or not f['length']:
+                continue
+            first = f['offset'] // piece_length
+            last = (f['offset'] + f['length'] - 1) // piece_length
+            for piece_index in range(first, last + 1):
+                if priorities[piece_index] < priority:
+                    priorities[piece_index] = priority
+        return priorities
+
+    def apply_file_priorities(self):
+        priorities = self.piece_priorities()
+        for (piece_index, priority) in enumerate(priorities):
+            self.picker.set_priority(piece_index, priority)
+        self.wanted_pieces = bitarray.bitarray([p != SKIP for p in priorities], endian='big')
+        self.wanted_pieces &= ~self.complete_pieces
+
+    def set_file_priorities(self, file_priorities):
+        if len(file_priorities) != len(self.file_priorities):
+            raise FilePriorityError('%d priorities for %d files' % (len(file_priorities), len(self.file_priorities)))
+        if self.is_complete and not SETTINGS['seed']:
+            raise FilePriorityError('%s has finished and closed its files' % self)
+        if self.recheck_task:
+            # The recheck reads the files that this would open.
+            raise FilePriorityError('%s is still rechecking its files' % self)
+        self.file_priorities = list(file_priorities)
+        self.cache.flush_storage(self.storage)
+        self.storage.allocate_files([i for (i, p) in enumerate(self.file_priorities) if p != SKIP])
+        self.apply_file_priorities()
+        if self.tracker is None:
+            return
+        if not self.wanted_pieces.any():
+            if not self.is_complete:
+                self.handle_completed_torrent()
+            return
+        if self.is_complete:
+            log.info('%s: downloading again for newly wanted files' % self)
+            self.is_complete = False
+            self.endgame_started = None
+            self.schedule_resume_save()
+        for p in list(self.registry.active):
+            if p.conn and p.is_started and not p.outstanding_requests:
+                p.run_download()
+        self.fill_peers()
+
+    def bytes_left(self):
         num_pieces = len(self.complete_pieces)
-        pct_complete = 100.0 * num_complete / num_pieces
+        piece_length = self.metainfo.info['piece_length']
+        left = (num_pieces - self.complete_pieces.count()) * piece_length
+        if not self.complete_pieces[num_pieces - 1]:
+            left -= piece_length - self.metainfo.get_piece_length(num_pieces - 1)
+        return left
+
+    def bitfield_bytes(self):
+        return self.complete_pieces.tobytes()
+
+    def stats(self):
+        return {
+            'name': self.metainfo.name,
+            'pieces_complete': self.picker.num_complete,
+            'pieces_total': len(self.complete_pieces),
+            'pieces_wanted': self.picker.num_wanted,
+            'pieces_hashed': self.pieces_hashed,
+            'hash_failures': self.hash_failures,
+            'hash_time': self.hash_time,
+            'recheck_rate': self.recheck_rate,
+            'uploaded': self.uploaded,
+            'downloaded': self.downloaded,
+            'left': self.bytes_left(),
+            'download_rate': self.download_rate.rate(),
+            'num_peers': self.num_connected(),
+            'known_peers': len(self.registry),
+            'pex_peers_received': self.pex.peers_received,
+            'endgame': self.endgame_started is not None,
+            'tail_piece_latency': (sum(self.tail_latencies) / len(self.tail_latencies)
+                                   if self.tail_latencies else None),
+            'tail_piece_latency_max': max(self.tail_latencies) if self.tail_latencies else None,
+            'piece_latency': self.piece_latency.snapshot(),
+            'piece_hash_time': self.piece_hash_time.snapshot(),
+            'peers': [p.stats() for p in self.registry.active if p.conn],
+        }
+
+    def progress_bar(self):
+        num_pieces = self.picker.num_wanted
+        num_complete = num_pieces - self.wanted_pieces.count()
+        pct_complete = 100.0 * num_complete / num_pieces if num_pieces else 100.0
         return('%s / %s (%02.1f%%) complete' % (num_complete, num_pieces, pct_complete))
 
     def handle_completed_torrent(self):
         log.info('%s: handle_completed_torrent' % (self))
         self.is_complete = True
-        data = bytes(v for piece in self.complete_pieces for v in piece)
-        for p in self.peers:
+        for p in list(self.registry.active):
             p.handle_torrent_completed()
+        if self.resume_timer:
+            self.resume_timer.cancel()
+            self.resume_timer = None
+        self.cache.flush_storage(self.storage)
+        if self.recheck_task:
+            # Nothing is known about the pieces yet, so the resume data is
+            # left as it was.
+            self.recheck_task.cancel()
+            self.recheck_task = None
+            return
+        self.resume.save(self.complete_pieces)
+        # Only a full download is reported as completed to the tracker.
+        if self.tracker and self.complete_pieces.all():
+            self.tracker.handle_completed()
+        if not SETTINGS['seed']:
+            self.choker.stop()
+            self.registry.stop()
+            self.pex.stop()
+            if self.dht:
+                self.dht.remove_torrent(self)
+            self.cache.close_storage(self.storage)
+            self.storage.close()
         if self.torrent_on_completed:
-            self.torrent_on_completed(self, data)
+            self.torrent_on_completed(self)
 
     def handle_peer_stopped(self, peer):
-        if self.is_complete:
+        self.registry.handle_stopped(peer)
+        self.release_requests(peer)
+        peer.outstanding_requests.clear()
+        self.picker.remove_peer_pieces(peer.peer_pieces)
+        peer.peer_pieces.setall(False)
+        if self.is_complete or self.is_stopped:
             return
-        num_active = sum(1 for p in self.peers if p.is_started and not p.conn_failed)
-        if num_active >= SETTINGS['max_peers']:
-            return
-        for p in self.peers[SETTINGS['max_peers']:]:
-            if p.conn or p.is_started or p.conn_failed:
-                continue
-            log.info('handle_peer_stopped: starting new peer: %s' % p)
-            p.connect()
-            break
+        self.resume_idle_peers()
+        self.fill_peers()
 
-class TorrentPieceError(Exception):
+    def num_connected(self):
+        return len(self.registry.active)
+
+    def fill_peers(self):
+        self.registry.fill(self.max_peers)
+
+    def set_max_peers(self, max_peers):
+        self.max_peers = max_peers
+        connected = [p for p in self.registry.active if p.conn]
+        if len(connected) > max_peers:
+            connected.sort(key=lambda p: p.download_rate.rate() + p.upload_rate.rate())
+            for p in connected[:len(connected) - max_peers]:
+                log.info('set_max_peers: dropping slow peer: %s' % p)
+                p.disconnect()
+        elif not self.is_complete:
+            self.fill_peers()
+
+
+def file_paths(metainfo):
+    # Paths inside the torrent, without the torrent's own directory.
+    if metainfo.info['format'] == 'SINGLE_FILE':
+        return [f['path'] for f in metainfo.files]
+    return [f['path'] for f in metainfo.info['files']]
+
+
+def match_file_priorities(metainfo, rules, file_priorities=None):
+    # Rules are (pattern, priority) pairs applied in order; a pattern is a
+    # file index or a glob over the paths inside the torrent.
+    priorities = list(file_priorities or [NORMAL] * len(metainfo.files))
+    for (pattern, priority) in rules:
+        if priority not in PRIORITIES:
+            raise FilePriorityError('Unknown priority: %s' % priority)
+        for (file_index, path) in enumerate(file_paths(metainfo)):
+            if pattern == str(file_index) or fnmatch.fnmatch(path, pattern):
+                priorities[file_index] = PRIORITIES[priority]
+    return priorities
+
+class FilePriorityError(Exception):
+    pass
+class TorrentStoppedError(Exception):
     pass
@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import argparse
+
+from control import call, ControlError, DEFAULT_SOCKET
+from main import parse_file_rule
+
+
+def print_torrents(torrents):
+    for t in torrents:
+        wanted = t['pieces_wanted']
+        done = 100.0 * t['pieces_complete'] / t['pieces_total'] if t['pieces_total'] else 100.0
+        print('%s  %-11s %5.1f%%  %8.1f KiB/s  %3d peers  %s' % (
+            t['info_hash'][:12], t['state'], done, t['download_rate'] / 1024, t['num_peers'], t['name']))
+        if wanted != t['pieces_total']:
+            print('%14s%d of %d pieces wanted' % ('', wanted, t['pieces_total']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Control a TorrentClient started with --daemon')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='control socket of the daemon')
+    parser.add_argument('--json', action='store_true', help='print the raw result')
+    commands = parser.add_subparsers(dest='command', required=True)
+    add = commands.add_parser('add', help='add .torrent files')
+    add.add_argument('torrents', nargs='+')
+    add.add_argument('--priority', type=parse_file_rule, action='append', default=[], metavar='FILE=PRIORITY')
+    for name in ('remove', 'pause', 'resume'):
+        command = commands.add_parser(name, help='%s torrents by info hash (or a prefix of it) or name' % name)
+        command.add_argument('torrents', nargs='+')
+    priority = commands.add_parser('priority', help='change file priorities of a torrent')
+    priority.add_argument('torrent')
+    priority.add_argument('rules', type=parse_file_rule, nargs='+', metavar='FILE=PRIORITY')
+    limits = commands.add_parser('limits', help='show or change the limits')
+    limits.add_argument('--download-limit', type=int, help='KiB/s, 0 for none')
+    limits.add_argument('--upload-limit', type=int, help='KiB/s, 0 for none')
+    limits.add_argument('--max-connections', type=int)
+    limits.add_argument('--max-active', type=int)
+    commands.add_parser('list', help='list the torrents')
+    commands.add_parser('stats', help='print the stats as JSON')
+    commands.add_parser('shutdown', help='stop the daemon')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'add':
+            result = [call(args.socket, 'add', {'path': os.path.abspath(path), 'file_rules': args.priority})
+                      for path in args.torrents]
+        elif args.command in ('remove', 'pause', 'resume'):
+            result = [call(args.socket, args.command, {'torrent': t}) for t in args.torrents]
+        elif args.command == 'priority':
+            result = [call(args.socket, 'priorities', {'torrent': args.torrent, 'file_rules': args.rules})]
+        elif args.command == 'limits':
+            params = {
+                'download_rate': args.download_limit * 1024 if args.download_limit is not None else None,
+                'upload_rate': args.upload_limit * 1024 if args.upload_limit is not None else None,
+                'max_connections': args.max_connections,
+                'max_active': args.max_active,
+            }
+            result = call(args.socket, 'limits', params)
+        else:
+            result = call(args.socket, args.command)
+    except (ControlError, OSError) as e:
+        sys.exit('torrentctl: %s' % e)
+
+    if args.json or args.command in ('stats', 'limits', 'shutdown', 'remove'):
+        print(json.dumps(result, indent=2))
+    else:
+        print_torrents(result)
+
+if __name__ == '__main__':
+    main()
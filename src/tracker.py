@@ -1,45 +1,176 @@
+import time
+import random
 import struct
+import asyncio
+import logging
+import functools
+import urllib.parse
 import requests
 import bencodepy
-import logging
 
 from settings import SETTINGS
 
 log = logging.getLogger(__name__)
 
+EVENTS = {None: 0, 'completed': 1, 'started': 2, 'stopped': 3}
 
-class Tracker():
-    def __init__(self, torrent, announce):
+UDP_PROTOCOL_ID = 0x41727101980
+UDP_CONNECT = 0
+UDP_ANNOUNCE = 1
+UDP_ERROR = 3
+UDP_HEADER = struct.Struct('!LL')
+UDP_CONNECT_REQUEST = struct.Struct('!QLL')
+UDP_CONNECT_RESPONSE = struct.Struct('!LLQ')
+UDP_ANNOUNCE_REQUEST = struct.Struct('!QLL20s20sQQQLLLlH')
+UDP_ANNOUNCE_RESPONSE = struct.Struct('!LLLLL')
+# A connection id may be used for one minute after it was received (BEP 15).
+UDP_CONNECTION_ID_TTL = 60.0
+
+
+class TrackerManager():
+    def __init__(self, torrent):
         self.torrent = torrent
-        self.announce = announce
-        self.tracker_id = None
+        self.loop = torrent.conn_man.loop
+        self.key = random.getrandbits(32)
+        self.tiers = []
+        for urls in torrent.metainfo.announce_list:
+            urls = list(urls)
+            random.shuffle(urls)
+            tier = [t for t in (create_tracker(self, url) for url in urls) if t]
+            if tier:
+                self.tiers.append(tier)
+        self.tasks = []
 
-    def announce_request(self):
-        http_resp = requests.get(self.announce, {
-            'info_hash': self.torrent.metainfo.info_hash,
-            'peer_id': SETTINGS['peer_id'],
-            'port': 6881,
-            'uploaded': '0',
-            'downloaded': '0',
-            'left': str(self.torrent.metainfo.info['length'])
-        })
-        self.announce_response(http_resp)
-    
-    def announce_response(self, http_resp):
-        resp = bencodepy.decode(http_resp.content)
-        d = self.decode_announce_response(resp)
-        for peer_dict in d['peers']:
+    def start(self, event='started'):
+        self.stop()
+        self.tasks = [self.loop.create_task(self.run_tier(tier, event)) for tier in self.tiers]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def handle_completed(self):
+        self.start('completed')
+
+    async def announce_stopped(self):
+        self.stop()
+        tasks = [self.loop.create_task(tier[0].announce('stopped')) for tier in self.tiers]
+        if not tasks:
+            return
+        (_, pending) = await asyncio.wait(tasks, timeout=SETTINGS['tracker_stop_timeout'])
+        for task in pending:
+            task.cancel()
+        for task in tasks:
+            if not task.cancelled() and task.done():
+                task.exception()
+
+    async def run_tier(self, tier, event):
+        failures = 0
+        while True:
+            resp = await self.announce_tier(tier, event)
+            if resp is None:
+                failures += 1
+                interval = min(SETTINGS['tracker_retry_interval'] * 2 ** (failures - 1),
+                               SETTINGS['tracker_max_interval'])
+            else:
+                failures = 0
+                event = None
+                # A tracker asking for 0 seconds must not make us spin.
+                interval = max(resp['interval'], resp['min_interval'] or 0, SETTINGS['tracker_min_interval'])
+                self.handle_response(resp)
+            await asyncio.sleep(interval)
+
+    async def announce_tier(self, tier, event):
+        for tracker in list(tier):
+            try:
+                resp = await tracker.announce(event)
+            except (AnnounceFailureError, AnnounceDecodeError, bencodepy.DecodingError,
+                    requests.RequestException, OSError, asyncio.TimeoutError) as e:
+                log.info('%s: announce failed: %r' % (tracker, e))
+                continue
+            # BEP 12: a tracker that answers moves to the front of its tier.
+            tier.remove(tracker)
+            tier.insert(0, tracker)
+            return resp
+        return None
+
+    def handle_response(self, resp):
+        for peer_dict in resp['peers']:
             if peer_dict['ip'] and peer_dict['port'] > 0:
                 self.torrent.add_peer(peer_dict)
-   
+        if not self.torrent.is_complete:
+            self.torrent.fill_peers()
+
+    def announce_params(self, event):
+        return {
+            'info_hash': self.torrent.metainfo.info_hash,
+            'peer_id': SETTINGS['peer_id'],
+            'port': SETTINGS['listen_port'] or 0,
+            'uploaded': self.torrent.uploaded,
+            'downloaded': self.torrent.downloaded,
+            'left': self.torrent.bytes_left(),
+            'event': event,
+            'key': self.key,
+        }
+
+
+def create_tracker(manager, url):
+    scheme = urllib.parse.urlsplit(url).scheme
+    if scheme in ('http', 'https'):
+        return HTTPTracker(manager, url)
+    if scheme == 'udp':
+        return UDPTracker(manager, url)
+    log.warning('Unsupported tracker scheme: %s' % url)
+    return None
+
+
+class Tracker():
+    def __init__(self, manager, announce):
+        self.manager = manager
+        self.announce_url = announce
+        self.tracker_id = None
+        self.last_announce = None
+        self.last_error = None
+        self.num_peers = 0
+
+    def __repr__(self):
+        return 'Tracker(%s)' % self.announce_url
+
+    async def announce(self, event):
+        try:
+            resp = await self.announce_request(self.manager.announce_params(event))
+        except Exception as e:
+            self.last_error = e
+            raise
+        self.last_announce = time.monotonic()
+        self.last_error = None
+        self.num_peers = len(resp['peers'])
+        log.debug('%s: %d peers, interval %d' % (self, self.num_peers, resp['interval']))
+        return resp
+
     @classmethod
     def decode_announce_response(cls, resp):
+        # Any malformed field is an AnnounceDecodeError, which the tier
+        # handles like an unreachable tracker.
+        if not isinstance(resp, dict):
+            raise AnnounceDecodeError('Announce response is not a dictionary')
+        try:
+            return cls.decode_announce_fields(resp)
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            raise AnnounceDecodeError('Malformed announce response: %r' % e) from e
+
+    @classmethod
+    def decode_announce_fields(cls, resp):
+        if b'failure reason' in resp:
+            raise AnnounceFailureError(resp[b'failure reason'].decode('utf-8', 'replace'))
         d = {}
         d['interval'] = int(resp[b'interval'])
+        d['min_interval'] = int(resp[b'min interval']) if b'min interval' in resp else None
         d['complete'] = int(resp[b'complete']) if b'complete' in resp else None
         d['incomplete'] = (int(resp[b'incomplete']) if b'incomplete' in resp else None)
         try:
-            d['tracker_id'] = resp[b'tracker id'].decode('utf-8')
+            d['tracker_id'] = resp[b'tracker id'].decode('utf-8', 'replace')
         except KeyError:
             d['tracker_id'] = None
 
@@ -55,12 +186,11 @@ class Tracker():
 
     @staticmethod
     def decode_dict_model_peers(peers_dicts):
-        # print(x)
         return [{'ip': d[b'ip'].decode('utf-8'),
-                 'port': d[b'port'],
+                 'port': int(d[b'port']),
                  'peer_id': d.get(b'peer id')}
                 for d in peers_dicts]
-    
+
     @staticmethod
     def decode_binary_model_peers(peers_bytes):
         fmt = '!BBBBH'
@@ -71,6 +201,139 @@ class Tracker():
                  for ofs in range(0, len(peers_bytes), fmt_size)]
         return [{'ip': '%d.%d.%d.%d' % p[:4], 'port': int(p[4])} for p in peers]
 
+
+class HTTPTracker(Tracker):
+    # One session for every HTTP tracker so announces reuse keep-alive
+    # connections; requests' connection pool is safe to share across the
+    # executor threads.
+    session = requests.Session()
+
+    async def announce_request(self, params):
+        query = {
+            'info_hash': params['info_hash'],
+            'peer_id': params['peer_id'],
+            'port': params['port'],
+            'uploaded': params['uploaded'],
+            'downloaded': params['downloaded'],
+            'left': params['left'],
+            'key': '%08x' % params['key'],
+            'compact': 1,
+        }
+        if params['event']:
+            query['event'] = params['event']
+        if self.tracker_id:
+            query['trackerid'] = self.tracker_id
+        http_resp = await self.manager.loop.run_in_executor(None, functools.partial(
+            self.session.get, self.announce_url, params=query, timeout=SETTINGS['tracker_timeout']))
+        http_resp.raise_for_status()
+        d = self.decode_announce_response(bencodepy.decode(http_resp.content))
+        if d['tracker_id']:
+            self.tracker_id = d['tracker_id']
+        return d
+
+
+class UDPTracker(Tracker):
+    def __init__(self, manager, announce):
+        super().__init__(manager, announce)
+        parts = urllib.parse.urlsplit(announce)
+        self.address = (parts.hostname, parts.port or 80)
+        self.connection_id = None
+        self.connection_time = 0.0
+
+    async def announce_request(self, params):
+        loop = self.manager.loop
+        (transport, protocol) = await loop.create_datagram_endpoint(
+            lambda: UDPTrackerProtocol(loop), remote_addr=self.address)
+        try:
+            connection_id = await self.get_connection_id(protocol)
+            transaction_id = random.getrandbits(32)
+            request = UDP_ANNOUNCE_REQUEST.pack(
+                connection_id, UDP_ANNOUNCE, transaction_id,
+                params['info_hash'], params['peer_id'],
+                params['downloaded'], params['left'], params['uploaded'],
+                EVENTS[params['event']], 0, params['key'], -1, params['port'])
+            data = await self.transact(protocol, request, transaction_id)
+        finally:
+            transport.close()
+        if len(data) < UDP_ANNOUNCE_RESPONSE.size:
+            raise AnnounceDecodeError('Short UDP announce response')
+        (action, _, interval, leechers, seeders) = UDP_ANNOUNCE_RESPONSE.unpack_from(data)
+        if action != UDP_ANNOUNCE:
+            raise AnnounceDecodeError('Unexpected UDP action %d' % action)
+        return {
+            'interval': interval,
+            'min_interval': None,
+            'complete': seeders,
+            'incomplete': leechers,
+            'tracker_id': None,
+            'peers': self.decode_binary_model_peers(data[UDP_ANNOUNCE_RESPONSE.size:]),
+        }
+
+    async def get_connection_id(self, protocol):
+        if self.connection_id is not None and time.monotonic() - self.connection_time < UDP_CONNECTION_ID_TTL:
+            return self.connection_id
+        transaction_id = random.getrandbits(32)
+        request = UDP_CONNECT_REQUEST.pack(UDP_PROTOCOL_ID, UDP_CONNECT, transaction_id)
+        data = await self.transact(protocol, request, transaction_id)
+        if len(data) < UDP_CONNECT_RESPONSE.size:
+            raise AnnounceDecodeError('Short UDP connect response')
+        (action, _, connection_id) = UDP_CONNECT_RESPONSE.unpack_from(data)
+        if action != UDP_CONNECT:
+            raise AnnounceDecodeError('Unexpected UDP action %d' % action)
+        self.connection_id = connection_id
+        self.connection_time = time.monotonic()
+        return connection_id
+
+    async def transact(self, protocol, request, transaction_id):
+        # BEP 15 retransmits after 15 * 2 ** n seconds; the base timeout and
+        # retry count are settings so a dead tracker does not hold up its tier.
+        for attempt in range(SETTINGS['udp_tracker_retries'] + 1):
+            waiter = protocol.expect(transaction_id)
+            protocol.transport.sendto(request)
+            try:
+                data = await asyncio.wait_for(
+                    waiter, SETTINGS['udp_tracker_timeout'] * 2 ** attempt)
+            except asyncio.TimeoutError:
+                log.debug('%s: retransmitting after timeout (attempt %d)' % (self, attempt + 1))
+                continue
+            finally:
+                protocol.waiters.pop(transaction_id, None)
+            (action, _) = UDP_HEADER.unpack_from(data)
+            if action == UDP_ERROR:
+                self.connection_id = None
+                raise AnnounceFailureError(data[UDP_HEADER.size:].decode('utf-8', 'replace'))
+            return data
+        self.connection_id = None
+        raise asyncio.TimeoutError()
+
+
+class UDPTrackerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, loop):
+        self.loop = loop
+        self.transport = None
+        self.waiters = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def expect(self, transaction_id):
+        waiter = self.loop.create_future()
+        self.waiters[transaction_id] = waiter
+        return waiter
+
+    def datagram_received(self, data, addr):
+        if len(data) < UDP_HEADER.size:
+            return
+        (_, transaction_id) = UDP_HEADER.unpack_from(data)
+        waiter = self.waiters.get(transaction_id)
+        if waiter and not waiter.done():
+            waiter.set_result(data)
+
+    def error_received(self, exc):
+        for waiter in self.waiters.values():
+            if not waiter.done():
+                waiter.set_exception(exc)
+
 class AnnounceFailureError(Exception):
     pass
 
@@ -0,0 +1,50 @@
+import time
+import hashlib
+import logging
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from settings import SETTINGS
+
+log = logging.getLogger(__name__)
+
+
+class PieceVerifier():
+    def __init__(self, loop):
+        self.loop = loop
+        # hashlib releases the GIL while hashing large buffers, so pieces
+        # are verified in parallel without blocking the event loop.
+        self.executor = ThreadPoolExecutor(max_workers=SETTINGS['hash_workers'],
+                                           thread_name_prefix='verifier')
+        self.waiting = collections.deque()
+        self.num_running = 0
+
+    def submit(self, data, expected_sha, callback):
+        if self.num_running < SETTINGS['hash_queue_depth']:
+            self.start_job(data, expected_sha, callback)
+        else:
+            self.waiting.append((data, expected_sha, callback))
+
+    def start_job(self, data, expected_sha, callback):
+        self.num_running += 1
+        future = self.loop.run_in_executor(self.executor, self.hash_piece, data)
+        future.add_done_callback(lambda f: self.handle_job_done(f, expected_sha, callback))
+
+    def handle_job_done(self, future, expected_sha, callback):
+        self.num_running -= 1
+        if self.waiting:
+            self.start_job(*self.waiting.popleft())
+        if future.cancelled():
+            return
+        (piece_sha, hash_time) = future.result()
+        callback(piece_sha == expected_sha, hash_time)
+
+    def shutdown(self):
+        self.waiting.clear()
+        self.executor.shutdown(wait=False)
+
+    @staticmethod
+    def hash_piece(data):
+        start = time.perf_counter()
+        piece_sha = hashlib.sha1(data).digest()
+        return (piece_sha, time.perf_counter() - start)